@@ -1,11 +1,12 @@
-from flask import Flask, render_template, Response, request, jsonify, session, redirect, url_for
+from flask import Flask, Request, render_template, Response, request, jsonify, session, redirect, url_for, g
 import os
 import sys
-import importlib.util
-import io
-import contextlib
+import gzip
+import json
+import time
+import hashlib
 import logging
-from dotenv import load_dotenv
+import tempfile
 
 # Determine the project root directory
 # api/index.py is in /api, so root is one level up
@@ -14,13 +15,22 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Prepend root to path so we can import local modules
 sys.path.append(BASE_DIR)
 
-# Import services
-from scripts import analytics
-from scripts import sips_service
+# Services (analytics, sips_service, scripts.runner, scripts.jobs) are imported
+# inside the routes that use them, so cold starts on /login and the static pages
+# don't pay for requests/supabase/openpyxl.
+# Run `python profile_imports.py` to check the cold-start import budget.
+
+# Modules the scripts import from each other (metrics, analytics, sips_service...)
+# are imported top-level here too, as the scripts do: importing them as scripts.X
+# as well would create a second copy with its own caches, locks and rate limiters.
+# profile_imports.py fails if any module ends up loaded under both names.
+sys.path.append(os.path.join(BASE_DIR, 'scripts'))
+import metrics
 
 # Load environment variables
 env_path = os.path.join(BASE_DIR, '.env')
 if os.path.exists(env_path):
+    from dotenv import load_dotenv
     load_dotenv(env_path)
 
 # Initialize Flask
@@ -30,6 +40,45 @@ app = Flask(__name__,
 
 app.secret_key = os.environ.get("SECRET_KEY", "default-dev-key") # Change in PROD
 
+# Uploads are capped at MAX_UPLOAD_MB and streamed into a spooled buffer: kept in
+# memory up to UPLOAD_SPOOL_MEMORY_MB, rolled over to an anonymous temp file
+# beyond that. The buffer is handed to the script as a file-like object, so
+# nothing is written under a fixed name in /tmp and it is freed after the run.
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "50"))
+UPLOAD_SPOOL_MEMORY_MB = float(os.getenv("UPLOAD_SPOOL_MEMORY_MB", "16"))
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_UPLOAD_MB * 1024 * 1024)
+
+class UploadSpool(tempfile.SpooledTemporaryFile):
+    """Upload buffer that outlives the request once handed to a script run."""
+    handed_off = False
+
+    def close(self):
+        # Werkzeug closes request files when the request ends, while the
+        # streamed run or the background job may still be reading it.
+        if not self.handed_off:
+            super().close()
+
+    def release(self):
+        self.handed_off = False
+        self.close()
+
+class SpooledUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(max_size=int(UPLOAD_SPOOL_MEMORY_MB * 1024 * 1024), mode="rb+")
+
+app.request_class = SpooledUploadRequest
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return f"Error: File too large (max {MAX_UPLOAD_MB:g} MB)", 413
+
+def _hand_off_upload(file):
+    """Detach the uploaded buffer from the request so the script run can own it."""
+    spool = file.stream
+    spool.handed_off = True
+    spool.seek(0)
+    return spool
+
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("EnexAPI")
@@ -43,9 +92,39 @@ USER_CREDENTIALS = {
 if not USER_CREDENTIALS["username"] or not USER_CREDENTIALS["password"]:
     logger.warning("⚠️ CREDENTIALS NOT SET: APP_USERNAME or APP_PASSWORD missing. Login disabled or insecure.")
 
+# === METRICS ===
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_route_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('enex_route_seconds', time.perf_counter() - start,
+                        route=route, method=request.method, status=response.status_code)
+    return response
+
+ADMIN_USERS = [u.strip() for u in os.environ.get("ADMIN_USERS", os.environ.get("APP_USERNAME") or "").split(",") if u.strip()]
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    # Admin session, or "Authorization: Bearer $METRICS_TOKEN" for scrapers
+    token = os.environ.get("METRICS_TOKEN")
+    authorized = session.get('user') in ADMIN_USERS or (
+        token and request.headers.get('Authorization') == f"Bearer {token}")
+    if not authorized:
+        return jsonify({"error": "Forbidden"}), 403
+
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(metrics.snapshot())
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.before_request
 def require_login():
-    allowed_routes = ['login', 'static']
+    allowed_routes = ['login', 'static', 'metrics_endpoint']
     if request.endpoint and request.endpoint not in allowed_routes and 'user' not in session:
         return redirect(url_for('login'))
 
@@ -80,7 +159,7 @@ def logout():
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', jobs_enabled=JOBS_ENABLED)
 
 @app.route('/billing')
 def billing():
@@ -96,30 +175,282 @@ def sips_page():
 
 # === API ENDPOINTS (Delegated to Services) ===
 
+# Browser copies are always revalidated (cheap 304s). Shared/edge caching is opt-in
+# because Vercel's edge would then serve the data without passing through require_login.
+if os.environ.get("ANALYTICS_EDGE_CACHE") == "1":
+    ANALYTICS_CACHE_CONTROL = "public, max-age=0, s-maxage={s_maxage}, stale-while-revalidate={swr}".format(
+        s_maxage=os.environ.get("ANALYTICS_S_MAXAGE", "60"),
+        swr=os.environ.get("ANALYTICS_STALE_WHILE_REVALIDATE", "600"))
+else:
+    ANALYTICS_CACHE_CONTROL = "private, no-cache"
+
+# Payloads below this size are sent uncompressed
+COMPRESS_MIN_BYTES = 1024
+
+def _compress(response):
+    """gzip/brotli-encode a response body according to Accept-Encoding."""
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    accepted = request.accept_encodings
+    if accepted['br']:
+        try:
+            import brotli
+            response.set_data(brotli.compress(data, quality=5))
+            response.headers['Content-Encoding'] = 'br'
+            return response
+        except ImportError:
+            pass
+    if accepted['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def _error_json(result):
+    result = dict(result)
+    status = result.pop('status', 200)
+    retry_after = result.pop('retry_after', None)
+    response = jsonify(result)
+    response.status_code = status
+    response.headers['Cache-Control'] = 'no-store'
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def cached_json(version_fn, build_fn):
+    """
+    JSON response with ETag/Last-Modified derived from the dataset version.
+    Replies 304 (without building the payload) when the client's copy is current.
+    Error results ({"error": ...}) are sent uncached and without ETag, with their
+    optional "status" code and "retry_after" seconds.
+    """
+    version, last_modified = version_fn()
+    if version is None:
+        result = build_fn()
+        if isinstance(result, dict) and result.get('error'):
+            return _error_json(result)
+        response = jsonify(result)
+        response.headers['Cache-Control'] = 'no-store'
+        return _compress(response)
+
+    etag = hashlib.sha1(f"{request.full_path}|{version}".encode()).hexdigest()
+    response = Response(status=304)
+    if not (request.if_none_match.contains(etag) or
+            (not request.if_none_match and request.if_modified_since and
+             last_modified.replace(microsecond=0) <= request.if_modified_since)):
+        result = build_fn()
+        if isinstance(result, dict) and result.get('error'):
+            return _error_json(result)
+        response = _compress(jsonify(result))
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = ANALYTICS_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/api/billing-data')
 def billing_data():
-    result = analytics.get_billing_data(BASE_DIR)
-    return jsonify(result)
+    import analytics
+    version = {}
+
+    def get_version():
+        version['value'], last_modified = analytics.get_dataset_version(BASE_DIR)
+        return version['value'], last_modified
+
+    # The version is reused to pick the invoice snapshot, without a second count query
+    return cached_json(get_version, lambda: analytics.get_billing_data(BASE_DIR, version['value']))
 
 @app.route('/api/ranking-data')
 def ranking_data():
-    result = analytics.get_ranking_data(BASE_DIR)
-    return jsonify(result)
+    import analytics
+    version = {}
+
+    def get_version():
+        version['value'], last_modified = analytics.get_dataset_version(BASE_DIR, include_competitors=True)
+        return version['value'], last_modified
+
+    # Served from the snapshot materialised for this dataset version (see sync_divakia_sales)
+    return cached_json(get_version, lambda: analytics.get_ranking_snapshot(BASE_DIR, version['value']))
+
+@app.route('/api/aggregate')
+def aggregate_api():
+    """Group-by/filter/measure queries over the invoices (see scripts/aggregate.py)."""
+    import aggregate, analytics
+    try:
+        query = aggregate.parse_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    version = {}
+
+    def get_version():
+        version['value'], last_modified = analytics.get_dataset_version(BASE_DIR)
+        return version['value'], last_modified
+
+    return cached_json(get_version, lambda: aggregate.run_aggregate(query, version['value'], analytics.ANALYTICS_BACKEND))
+
+@app.route('/api/margins')
+def margins_api():
+    """Gross margin over ATR grouped by month, client, cups or invoice (?by=)."""
+    import analytics, margin_engine
+    by = request.args.get('by', 'month')
+    if by not in margin_engine.GROUPS:
+        return jsonify({"error": f"by debe ser uno de: {', '.join(margin_engine.GROUPS)}"}), 400
+
+    version = {'value': None}
+
+    def get_version():
+        dataset, last_modified = analytics.get_dataset_version(BASE_DIR)
+        purchases = margin_engine.get_purchases_version()
+        if dataset is None or purchases is None:
+            return None, None
+        # ATR purchases live in their own table (materialised after each sync)
+        version['value'] = f"{dataset}|{purchases}"
+        return version['value'], last_modified
+
+    return cached_json(get_version, lambda: margin_engine.get_margins(version['value'], by))
 
 @app.route('/api/sips/search', methods=['POST'])
 def sips_search_api():
+    import sips_service
     data = request.get_json()
     cups = data.get('cups')
-    
-    result, status_code = sips_service.search_cups_data(cups)
+    refresh = str(data.get('refresh') or request.args.get('refresh', '')).lower() in ('1', 'true')
+    lean = str(data.get('lean') or request.args.get('lean', '')).lower() in ('1', 'true')
+    try:
+        sections = sips_service.parse_fields(data.get('fields') or request.args.get('fields'), lean=lean)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    result, status_code = sips_service.search_cups_data(cups, refresh=refresh)
+    if status_code == 200:
+        result = sips_service.project_fields(result, sections)
+    response = _compress(jsonify(result))
+    response.vary.add('Accept-Encoding')
+    return response, status_code
+
+def _batch_cups_from_request():
+    """CUPS list from a JSON body, pasted text or an uploaded CSV. Returns (cups_list, refresh, error)."""
+    import sips_service
+
+    if request.is_json:
+        data = request.get_json() or {}
+        cups = data.get('cups') or []
+        text = "\n".join(cups) if isinstance(cups, list) else str(cups)
+        refresh = bool(data.get('refresh'))
+    else:
+        text = request.form.get('cups', '')
+        file = request.files.get('file')
+        if file and file.filename:
+            text += "\n" + file.read().decode('utf-8-sig', errors='replace')
+        refresh = request.form.get('refresh', '').lower() in ('1', 'true')
+
+    cups_list = sips_service.parse_cups_list(text)
+    if not cups_list:
+        return None, refresh, "No se encontraron CUPS válidos"
+    if len(cups_list) > sips_service.SIPS_BATCH_MAX:
+        return None, refresh, f"Máximo {sips_service.SIPS_BATCH_MAX} CUPS por lote (recibidos {len(cups_list)})"
+    return cups_list, refresh, None
+
+@app.route('/api/sips/batch', methods=['POST'])
+def sips_batch_api():
+    """NDJSON stream: one line per CUPS as soon as its lookup finishes, then a summary line."""
+    import sips_service
+    cups_list, refresh, error = _batch_cups_from_request()
+    if error:
+        return jsonify({"error": error}), 400
+    full = request.args.get('full', '').lower() in ('1', 'true')
+    try:
+        sections = sips_service.parse_fields(request.args.get('fields'),
+                                             lean=request.args.get('lean', '').lower() in ('1', 'true'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        ok = 0
+        for cups, result, status_code in sips_service.search_cups_batch(cups_list, refresh=refresh):
+            line = {"cups": cups, "status": status_code, "summary": sips_service.summary_row(cups, result, status_code)}
+            if full and status_code == 200:
+                line["data"] = sips_service.project_fields(result, sections)
+            ok += status_code == 200
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        yield json.dumps({"done": True, "total": len(cups_list), "ok": ok}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/sips/batch/export', methods=['POST'])
+def sips_batch_export_api():
+    import sips_service
+    cups_list, refresh, error = _batch_cups_from_request()
+    if error:
+        return jsonify({"error": error}), 400
+
+    rows = {cups: sips_service.summary_row(cups, result, status_code)
+            for cups, result, status_code in sips_service.search_cups_batch(cups_list, refresh=refresh)}
+    content = sips_service.build_batch_xlsx([rows[c] for c in cups_list])
+    return Response(content,
+                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    headers={'Content-Disposition': 'attachment; filename=sips_lote.xlsx'})
+
+@app.route('/api/sips/portfolio')
+def sips_portfolio_api():
+    import sips_service
+    cups = request.args.get('cups')
+    return cached_json(
+        sips_service.get_snapshots_version,
+        lambda: sips_service.get_portfolio(cups))
+
+@app.route('/api/tariffs/simulate', methods=['POST'])
+def tariff_simulate_api():
+    """One CUPS against an offer catalogue: {"cups": "...", "offers": [...]}."""
+    import sips_service
+    data = request.get_json() or {}
+    cups = sips_service.normalize_cups(data.get('cups'))
+    if not cups:
+        return jsonify({"error": "CUPS no proporcionado"}), 400
+
+    result, status_code = sips_service.simulate_offers(data.get('offers'), [cups], refresh=bool(data.get('refresh')))
+    if status_code == 200 and result["errores"]:
+        # The lookup's own status (404 unknown CUPS, 400 invalid...); 502 only for upstream failures
+        error = dict(result["errores"][0])
+        status_code = error.pop("status", None) or 502
+        return jsonify(error), 502 if status_code >= 500 else status_code
     return jsonify(result), status_code
 
+@app.route('/api/tariffs/simulate-batch', methods=['POST'])
+def tariff_simulate_batch_api():
+    """Many CUPS ({"cups": [...]}) or the whole portfolio ({"portfolio": true}) against an offer catalogue."""
+    import sips_service
+    data = request.get_json() or {}
+    portfolio = bool(data.get('portfolio'))
+    cups_list = None
+    if not portfolio:
+        cups = data.get('cups') or []
+        cups_list = sips_service.parse_cups_list("\n".join(cups) if isinstance(cups, list) else str(cups))
+        if not cups_list:
+            return jsonify({"error": "No se encontraron CUPS válidos"}), 400
+        if len(cups_list) > sips_service.SIPS_BATCH_MAX:
+            return jsonify({"error": f"Máximo {sips_service.SIPS_BATCH_MAX} CUPS por lote"}), 400
+
+    result, status_code = sips_service.simulate_offers(data.get('offers'), cups_list, portfolio=portfolio,
+                                                        refresh=bool(data.get('refresh')))
+    response = _compress(jsonify(result))
+    response.vary.add('Accept-Encoding')
+    return response, status_code
+
+@app.route('/api/sips/cache-stats')
+def sips_cache_stats_api():
+    import sips_service
+    return jsonify(sips_service.sips_cache.stats())
+
 # === SCRIPT EXECUTION (Legacy/Admin) ===
 
+ALLOWED_SCRIPTS = ['omie_holded.py', 'divakia_atr.py', 'facturas_emitidas.py', 'sync_holded_sales.py', 'sync_divakia_sales.py', 'cierre_mensual.py', 'sips_prefetch.py']
+
 @app.route('/run/<script_name>')
 def run_script(script_name):
-    ALLOWED_SCRIPTS = ['omie_holded.py', 'divakia_atr.py', 'facturas_emitidas.py', 'sync_holded_sales.py', 'sync_divakia_sales.py']
-    
     if script_name not in ALLOWED_SCRIPTS:
         return f"Error: {script_name} is not allowed.", 403
 
@@ -127,8 +458,6 @@ def run_script(script_name):
 
 @app.route('/run-upload/<script_name>', methods=['POST'])
 def run_upload_script(script_name):
-    ALLOWED_SCRIPTS = ['omie_holded.py', 'divakia_atr.py', 'facturas_emitidas.py', 'sync_holded_sales.py', 'sync_divakia_sales.py']
-    
     if script_name not in ALLOWED_SCRIPTS:
         return f"Error: {script_name} is not allowed.", 403
 
@@ -140,19 +469,98 @@ def run_upload_script(script_name):
         return "Error: No selected file", 400
 
     if file:
-        temp_dir = "/tmp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir, exist_ok=True)
-            
-        filename = file.filename
-        file_path = os.path.join(temp_dir, filename)
-        file.save(file_path)
-        
-        os.environ['INPUT_FILE_PATH'] = file_path
-        
-        return Response(generate_output(script_name), mimetype='text/plain')
+        params = {'input_filename': os.path.basename(file.filename)}
+        input_files = {'file': _hand_off_upload(file)}
+        return Response(generate_output(script_name, params=params, input_files=input_files), mimetype='text/plain')
+
+# === BACKGROUND JOBS ===
+# Jobs run in a thread pool after the response and are stored in a local SQLite
+# file, so they need a long-lived server. On serverless deployments (Vercel
+# freezes the function after responding and each instance has its own /tmp) the
+# dashboard keeps streaming through /run. Enable with JOBS_ENABLED=1.
+JOBS_ENABLED = os.getenv("JOBS_ENABLED", "").lower() in ("1", "true")
 
-def generate_output(script_name):
+@app.before_request
+def require_jobs_enabled():
+    if request.endpoint in ('submit_job', 'list_jobs', 'job_status', 'job_stream') and not JOBS_ENABLED:
+        return jsonify({"error": "Background jobs are disabled (JOBS_ENABLED)."}), 404
+
+def _job_manager():
+    from scripts import jobs
+    return jobs.get_manager(os.path.join(BASE_DIR, 'scripts'))
+
+def _job_payload(job, offset=None):
+    # offset=None returns only the status, without log lines
+    log = _job_manager().read_log(job['id'], offset) if offset is not None else []
+    return {
+        "job_id": job['id'],
+        "script": job['script'],
+        "status": job['status'],
+        "created_at": job['created_at'],
+        "started_at": job['started_at'],
+        "finished_at": job['finished_at'],
+        "error": job['error'],
+        "log": log,
+        "next_offset": (offset or 0) + len(log)
+    }
+
+@app.route('/jobs/submit/<script_name>', methods=['POST'])
+def submit_job(script_name):
+    if script_name not in ALLOWED_SCRIPTS:
+        return jsonify({"error": f"{script_name} is not allowed."}), 403
+
+    params = {}
+    input_files = None
+    file = request.files.get('file')
+    if file and file.filename:
+        spool = _hand_off_upload(file)
+        # The content hash makes re-submitting the same file join the running job
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: spool.read(1024 * 1024), b""):
+            digest.update(chunk)
+        spool.seek(0)
+        params['input_filename'] = os.path.basename(file.filename)
+        params['input_sha256'] = digest.hexdigest()
+        input_files = {'file': spool}
+
+    job, coalesced = _job_manager().submit(script_name, params, input_files=input_files)
+    if coalesced and input_files:
+        input_files['file'].release()
+    return jsonify({"job_id": job['id'], "status": job['status'], "coalesced": coalesced}), 202
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([_job_payload(j) for j in _job_manager().list()])
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = _job_manager().get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    offset = request.args.get('offset', 0, type=int)
+    return jsonify(_job_payload(job, offset))
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    from scripts import jobs
+    manager = _job_manager()
+    if not manager.get(job_id):
+        return "Error: Job not found", 404
+
+    def follow():
+        offset = 0
+        while True:
+            job = manager.get(job_id)
+            lines = manager.read_log(job_id, offset)
+            offset += len(lines)
+            yield from lines
+            if job['status'] not in jobs.ACTIVE_STATUSES:
+                break
+            time.sleep(0.5)
+
+    return Response(follow(), mimetype='text/plain')
+
+def generate_output(script_name, params=None, input_files=None):
     script_path = os.path.join(BASE_DIR, 'scripts', script_name)
     
     if not os.path.exists(script_path):
@@ -160,38 +568,11 @@ def generate_output(script_name):
         return
 
     yield f"Iniciando {script_name}...\n"
-    
-    scripts_dir = os.path.dirname(script_path)
-    if scripts_dir not in sys.path:
-        sys.path.insert(0, scripts_dir)
-        
-    output_capture = io.StringIO()
-    
-    try:
-        spec = importlib.util.spec_from_file_location("dynamic_script", script_path)
-        module = importlib.util.module_from_spec(spec)
-        
-        with contextlib.redirect_stdout(output_capture), contextlib.redirect_stderr(output_capture):
-            try:
-                spec.loader.exec_module(module)
-                if hasattr(module, 'main'):
-                    module.main()
-                else:
-                    print("⚠️ Script execution: main() function not found.")
-            except SystemExit:
-                pass
-            except Exception as e:
-                print(f"Error executing script: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        yield output_capture.getvalue()
-        yield "\n[EXITO] Proceso finalizado."
 
-    except Exception as e:
-        yield f"\n[CRITICAL FAIL] {str(e)}"
-    finally:
-        output_capture.close()
+    from scripts import runner
+
+    # Each line is flushed to the client as soon as the script prints it
+    yield from runner.stream_script(script_path, params=params, input_files=input_files)
 
 if __name__ == '__main__':
     app.run(debug=True, use_reloader=False, port=5000)
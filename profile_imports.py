@@ -0,0 +1,106 @@
+import os
+import re
+import sys
+import subprocess
+
+# Cold-start import budget for the serverless entry point (api/index.py).
+# Exits with status 1 when the budget is exceeded or a heavy module is imported
+# eagerly, so it can run as a check before deploying:
+#   python profile_imports.py            -> report + check
+#   python profile_imports.py --top 40   -> longer report
+BUDGET_MS = float(os.getenv("COLD_START_BUDGET_MS", "300"))
+
+# Modules that must only be imported by the routes that need them
+FORBIDDEN_AT_COLD_START = ["requests", "supabase", "openpyxl", "analytics", "sips_service"]
+
+# Modules the routes import, and scripts run as jobs that share modules with them.
+# After loading them all, no module may exist both as `X` and `scripts.X`: two
+# copies would mean two caches, locks and rate limiters (e.g. sips_service's).
+ROUTE_MODULES = ["analytics", "aggregate", "margin_engine", "sips_service", "scripts.jobs", "scripts.runner"]
+JOB_SCRIPTS = ["sips_prefetch.py", "sync_divakia_sales.py", "local_replica.py", "invoice_snapshot.py"]
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def profile_cold_start():
+    """
+    Import api/index.py in a fresh interpreter with -X importtime.
+    Returns a list of (module, self_us, cumulative_us, depth).
+    """
+    code = f"import sys; sys.path.insert(0, {os.path.join(ROOT_DIR, 'api')!r}); import index"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Import of api/index.py failed:\n{result.stderr[-2000:]}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+def find_duplicate_modules():
+    """
+    Import api/index.py, the route modules and the job scripts (as runner loads
+    them) in a fresh interpreter. Returns the module names loaded twice.
+    """
+    code = f"""
+import sys, importlib
+sys.path.insert(0, {os.path.join(ROOT_DIR, 'api')!r})
+import index
+for name in {ROUTE_MODULES!r}:
+    importlib.import_module(name)
+from scripts import runner
+for script in {JOB_SCRIPTS!r}:
+    runner.load_script({os.path.join(ROOT_DIR, 'scripts')!r} + '/' + script)
+print(' '.join(sorted(n[len('scripts.'):] for n in sys.modules
+                      if n.startswith('scripts.') and n[len('scripts.'):] in sys.modules)))
+"""
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Import of the route modules failed:\n{result.stderr[-2000:]}")
+    return result.stdout.split()
+
+def main():
+    top = 25
+    if "--top" in sys.argv:
+        top = int(sys.argv[sys.argv.index("--top") + 1])
+
+    print("--- Cold-start import profile (api/index.py) ---")
+    modules = profile_cold_start()
+
+    # Top-level modules (depth 0) add up to the total cold-start import cost
+    total_ms = sum(cum for _, _, cum, depth in modules if depth == 0) / 1000
+
+    print(f"\n{'Module':<45} {'Self ms':>9} {'Cumul. ms':>10}")
+    for name, self_us, cumulative_us, _ in sorted(modules, key=lambda m: m[2], reverse=True)[:top]:
+        print(f"{name:<45} {self_us / 1000:>9.1f} {cumulative_us / 1000:>10.1f}")
+
+    print(f"\nTotal import time: {total_ms:.1f} ms (budget {BUDGET_MS:.0f} ms)")
+
+    failures = []
+    if total_ms > BUDGET_MS:
+        failures.append(f"Cold-start import time {total_ms:.1f} ms exceeds budget of {BUDGET_MS:.0f} ms")
+
+    imported = {name for name, _, _, _ in modules}
+    eager = [m for m in FORBIDDEN_AT_COLD_START if m in imported]
+    if eager:
+        failures.append(f"Heavy modules imported at cold start: {', '.join(eager)}")
+
+    duplicates = find_duplicate_modules()
+    if duplicates:
+        failures.append(f"Modules loaded both as X and scripts.X: {', '.join(duplicates)}")
+
+    if failures:
+        for f in failures:
+            print(f"❌ {f}")
+        sys.exit(1)
+
+    print("✅ Cold-start import budget OK, one copy of each shared module.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import threading
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+import local_replica
+from cache import TTLCache
+
+# Ad-hoc aggregations over the expanded invoice schema (/api/aggregate): group by
+# any dimension, filter, and sum/avg/min/max any cost or volume column. Queries
+# are compiled to SQL (whitelisted columns, bound values) and run on the local
+# SQLite replica, brought up to date with Supabase before the first query of each
+# dataset version (incremental pull; cold loads and full reconciles run in the
+# background, see _refresh_replica). Results are cached per (dataset version, query).
+#
+#   group_by=province,month
+#   measures=count,sum:fc_energy_cost,avg:consumption_kwh
+#   province=Sevilla,Cádiz&access_tariff=2.0TD     (any dimension, comma = OR)
+#   from=2025-01&to=2025-06-30                      (issue_date range)
+#   sort=-sum:fc_energy_cost&limit=50
+
+DIMENSIONS = {
+    "province": "province",
+    "municipality": "municipality",
+    "distributor": "distributor",
+    "access_tariff": "access_tariff",
+    "price_type": "price_type",
+    "payment_method": "payment_method",
+    "self_consumption_type": "self_consumption_type",
+    "cnae": "cnae",
+    "status": "status",
+    "invoice_type": "fc_invoice_type",
+    "client_name": "client_name",
+    "nif": "nif",
+    "cups": "cups",
+    "year": "substr(issue_date, 1, 4)",
+    "month": "substr(issue_date, 1, 7)",
+}
+
+MEASURE_COLUMNS = (
+    "amount", "consumption_kwh",
+    "p1_kw", "p2_kw", "p3_kw", "p4_kw", "p5_kw", "p6_kw", "fc_days",
+    "fc_energy_cost", "fc_power_cost", "fc_rental_cost", "fc_tax_electricity", "fc_iva_cost",
+    "fc_total_energy", "fc_total_power", "fc_excess_power", "fc_excess_reactive",
+    "fc_surplus_energy", "fc_surplus_compens", "fc_virtual_battery", "fc_social_bonus",
+    "fc_other_services", "fc_invoice_total",
+)
+FUNCTIONS = ("sum", "avg", "min", "max")
+
+DEFAULT_MEASURES = ("count", "sum:amount", "sum:consumption_kwh")
+AGGREGATE_MAX_ROWS = int(os.getenv("AGGREGATE_MAX_ROWS", "10000"))
+# Seconds a client should wait while an empty replica is loaded (Retry-After)
+REPLICA_LOADING_RETRY_AFTER = 10
+
+aggregate_cache = TTLCache("aggregate", maxsize=int(os.getenv("AGGREGATE_CACHE_SIZE", "256")), ttl=int(os.getenv("AGGREGATE_CACHE_TTL", "86400")))
+
+_replica_version = {"value": None}
+_refresh_lock = threading.Lock()
+
+def _split(value):
+    return [v.strip() for v in str(value or "").split(",") if v.strip()]
+
+def _date_bound(value, end=False):
+    """'2025', '2025-03' or '2025-03-15' -> ISO date bound (inclusive)."""
+    value = value.strip()
+    if len(value) == 4 and value.isdigit():
+        return f"{value}-12-31" if end else f"{value}-01-01"
+    if len(value) == 7 and value[4] == "-":
+        return f"{value}-31" if end else f"{value}-01"
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        return value
+    raise ValueError(f"Fecha no válida: {value} (AAAA, AAAA-MM o AAAA-MM-DD)")
+
+def parse_query(args):
+    """Validate request args into a normalised query dict. Raises ValueError."""
+    group_by = _split(args.get("group_by"))
+    for dim in group_by:
+        if dim not in DIMENSIONS:
+            raise ValueError(f"Dimensión no válida: {dim}. Disponibles: {', '.join(DIMENSIONS)}")
+
+    measures = list(dict.fromkeys(_split(args.get("measures")))) or list(DEFAULT_MEASURES)
+    for measure in measures:
+        if measure == "count":
+            continue
+        func, _, column = measure.partition(":")
+        if func not in FUNCTIONS or column not in MEASURE_COLUMNS:
+            raise ValueError(f"Medida no válida: {measure} (count o {'|'.join(FUNCTIONS)}:<columna>)")
+
+    filters = {}
+    for dim in DIMENSIONS:
+        values = _split(args.get(dim))
+        if values:
+            filters[dim] = sorted(values)
+
+    date_from = _date_bound(args["from"]) if args.get("from") else None
+    date_to = _date_bound(args["to"], end=True) if args.get("to") else None
+
+    sort = args.get("sort") or ""
+    if sort and sort.lstrip("-") not in group_by + measures:
+        raise ValueError(f"sort debe ser una dimensión o medida de la consulta: {sort}")
+
+    try:
+        limit = min(int(args.get("limit") or AGGREGATE_MAX_ROWS), AGGREGATE_MAX_ROWS)
+    except ValueError:
+        raise ValueError("limit debe ser un número")
+    if limit < 1:
+        raise ValueError("limit debe ser mayor que 0")
+
+    return {
+        "group_by": group_by,
+        "measures": measures,
+        "filters": filters,
+        "from": date_from,
+        "to": date_to,
+        "sort": sort,
+        "limit": limit,
+    }
+
+def _measure_sql(measure):
+    if measure == "count":
+        return "COUNT(*)"
+    func, _, column = measure.partition(":")
+    return f"{func.upper()}({column})"
+
+def build_sql(query):
+    """(sql, params, totals_sql) for a parsed query. Only whitelisted names reach the SQL text."""
+    where, params = [], []
+    for dim, values in query["filters"].items():
+        where.append(f"{DIMENSIONS[dim]} IN ({', '.join('?' for _ in values)})")
+        params.extend(values)
+    if query["from"]:
+        where.append("issue_date >= ?")
+        params.append(query["from"])
+    if query["to"]:
+        where.append("issue_date <= ?")
+        params.append(query["to"])
+    where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+
+    columns = [f'{DIMENSIONS[d]} AS "{d}"' for d in query["group_by"]]
+    columns += [f'{_measure_sql(m)} AS "{m}"' for m in query["measures"]]
+    sql = f"SELECT {', '.join(columns)} FROM invoices{where_sql}"
+    totals_sql = f"SELECT {', '.join(columns[len(query['group_by']):])} FROM invoices{where_sql}"
+
+    if query["group_by"]:
+        sql += f" GROUP BY {', '.join(DIMENSIONS[d] for d in query['group_by'])}"
+        sort = query["sort"]
+        if sort:
+            sql += f' ORDER BY "{sort.lstrip("-")}" {"DESC" if sort.startswith("-") else "ASC"}'
+        else:
+            sql += f" ORDER BY {', '.join(str(i + 1) for i in range(len(query['group_by'])))}"
+        sql += f" LIMIT {int(query['limit']) + 1}"
+    return sql, params, totals_sql
+
+def _round(row):
+    return {k: round(v, 2) if isinstance(v, float) else v for k, v in row.items()}
+
+def _refresh_replica(version):
+    """
+    Pull changes from Supabase into the replica once per dataset version. An
+    empty replica is loaded in the background and False is returned meanwhile;
+    a due full reconcile (deleted rows) is started in the background too.
+    """
+    if version is not None and _replica_version["value"] == version:
+        return True
+    with _refresh_lock:
+        if version is not None and _replica_version["value"] == version:
+            return True
+        replica = local_replica.get_replica()
+        if replica.count() == 0:
+            local_replica.pull_in_background(full=True)
+            return False
+        if replica.reconcile_due():
+            local_replica.pull_in_background(full=True)
+        supabase = common.get_supabase_client()
+        if not supabase:
+            return True
+        replica.pull(supabase)
+        _replica_version["value"] = version
+        return True
+
+def run_aggregate(query, version=None, backend="supabase"):
+    """
+    Execute a parsed query. `version` is the dataset version (cache key and
+    replica refresh marker). `backend` follows ANALYTICS_BACKEND: with "local"
+    the replica is used as is, with "auto" a failed refresh falls back to it.
+    Errors are {"error", "status"} dicts (503 with "retry_after" while the
+    replica loads, 502 if Supabase fails, 500 for the query) and are not cached.
+    """
+    key = f"{version}|{json.dumps(query, sort_keys=True)}"
+    if version is not None:
+        cached = aggregate_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if backend != "local":
+        try:
+            if not _refresh_replica(version):
+                return {"error": "La réplica local de facturas se está cargando desde Supabase. Reintenta en unos segundos.",
+                        "status": 503, "retry_after": REPLICA_LOADING_RETRY_AFTER}
+        except Exception as e:
+            if backend != "auto":
+                return {"error": f"Error actualizando la réplica local: {e}", "status": 502}
+            print(f"Error actualizando la réplica local, se usa la copia existente: {e}")
+
+    try:
+        sql, params, totals_sql = build_sql(query)
+        replica = local_replica.get_replica()
+        rows = [_round(r) for r in replica.query(sql, params)]
+        totals = _round(replica.query(totals_sql, params)[0])
+    except Exception as e:
+        return {"error": str(e), "status": 500}
+
+    result = {
+        "group_by": query["group_by"],
+        "measures": query["measures"],
+        "filters": query["filters"],
+        "rows": rows[:query["limit"]],
+        "truncated": len(rows) > query["limit"],
+        "totals": totals,
+    }
+    if version is not None:
+        aggregate_cache.set(key, result)
+    return result
@@ -1,72 +1,226 @@
-import json
 import os
 import sys
-from datetime import datetime
+import json
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timezone
 
 # Ensure we can import common
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import common
+import metrics
+import local_replica
+import invoice_snapshot
+from competitors import get_competitor_index, get_monthly_index, MONTHLY_FILE
+
+# Where analytics reads invoices from:
+#   supabase  the `invoices` table (default)
+#   local     the SQLite replica kept by scripts/local_replica.py (offline / dev)
+#   auto      Supabase, falling back to the replica when it's unreachable
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "supabase").lower()
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _read_supabase_rows(supabase, columns='*'):
+    # Fetch all invoices using pagination to overcome limits (usually 1000 per request)
+    all_rows = []
+    offset = 0
+    limit = 1000
+    more = True
+
+    while more:
+        with metrics.upstream("supabase_read"):
+            response = supabase.table('invoices').select(columns).range(offset, offset + limit - 1).execute()
+        batch = response.data
+
+        if batch:
+            all_rows.extend(batch)
+            offset += limit
+            if len(batch) < limit:
+                more = False
+        else:
+            more = False
+    return all_rows
+
+LEGACY_COLUMNS = ("id", "issue_date", "amount", "consumption_kwh", "status", "client_name")
+
+def _read_local_rows(columns=LEGACY_COLUMNS):
+    return local_replica.get_replica().select(columns)
+
+def _fetch_rows(columns=None):
+    if ANALYTICS_BACKEND == "local":
+        return _read_local_rows(columns or LEGACY_COLUMNS)
 
-def _fetch_invoices():
-    """
-    Fetch invoices from Supabase and transform to legacy format.
-    """
     supabase = common.get_supabase_client()
     if not supabase:
+        if ANALYTICS_BACKEND == "auto":
+            return _read_local_rows(columns or LEGACY_COLUMNS)
         # Fallback to local file if Supabase fails or not configured (dev mode)
         # Or just return empty/error. Let's return empty list but log error.
         print("Error: Supabase client not initialized in analytics.")
         return []
-        
+
     try:
-        # Fetch all invoices using pagination to overcome limits (usually 1000 per request)
-        all_rows = []
-        offset = 0
-        limit = 1000
-        more = True
-        
-        while more:
-            response = supabase.table('invoices').select('*').range(offset, offset + limit - 1).execute()
-            batch = response.data
-            
-            if batch:
-                all_rows.extend(batch)
-                offset += limit
-                if len(batch) < limit:
-                    more = False
-            else:
-                more = False
-                
-        invoices = []
-        for r in all_rows:
-            # Transform YYYY-MM-DD -> DD/MM/YYYY for legacy compatibility
-            date_legacy = ""
-            if r.get('issue_date'):
-                try:
-                    date_legacy = datetime.strptime(r['issue_date'], "%Y-%m-%d").strftime("%d/%m/%Y")
-                except: 
-                    pass
-            
-            # Map fields
-            inv = {
-                "id": r.get('id'),
-                "date": date_legacy,
-                "total": float(r.get('amount') or 0),
-                "consumption": float(r.get('consumption_kwh') or 0),
-                "status": r.get('status'),
-                "client": r.get('client_name')
-            }
-            invoices.append(inv)
-            
-        return invoices
-        
+        return _read_supabase_rows(supabase, ",".join(columns) if columns else '*')
     except Exception as e:
         print(f"Error fetching from Supabase: {e}")
+        # Drop the pooled client if its connections went bad
+        common.supabase_health_check()
+        if ANALYTICS_BACKEND == "auto":
+            print("Usando la réplica local de facturas.")
+            return _read_local_rows(columns or LEGACY_COLUMNS)
         return []
 
-def get_billing_data(base_dir):
+def _invoices_part(version):
+    """'<count>|<latest updated_at>' part of a dataset version (competitor file hashes may follow)."""
+    return "|".join(version.split("|")[:2])
+
+def _snapshot_invoices(version=None):
+    """
+    Legacy invoices from the binary snapshot written at sync time, if it matches
+    the dataset version (one count query instead of paging the table). `version`
+    is the one get_dataset_version already computed, when the caller has it.
+    """
+    if ANALYTICS_BACKEND == "local":
+        return None
+    if not os.path.exists(invoice_snapshot.INVOICE_SNAPSHOT_PATH):
+        return None
+    if version is None:
+        try:
+            counted = _invoices_version()
+        except Exception as e:
+            print(f"Error reading dataset version: {e}")
+            return None
+        if counted is None:
+            return None
+        version = "%s|%s" % counted
+    snapshot = invoice_snapshot.find_snapshot(_invoices_part(version))
+    if snapshot is None:
+        return None
+    try:
+        return snapshot.to_legacy()
+    except ValueError as e:
+        # Replaced by a newer sync while we were reading it: page the table this time
+        print(f"Error reading invoice snapshot: {e}")
+        return None
+
+def fetch_invoice_rows(columns):
+    """Invoice rows with the given Supabase columns, from the configured backend."""
+    return _fetch_rows(columns)
+
+def _fetch_invoices(version=None):
+    """
+    Fetch invoices (Supabase or the local replica, see ANALYTICS_BACKEND) and
+    transform to legacy format.
+    """
+    invoices = _snapshot_invoices(version)
+    if invoices is not None:
+        return invoices
+
+    invoices = []
+    for r in _fetch_rows():
+        # Transform YYYY-MM-DD -> DD/MM/YYYY for legacy compatibility
+        date_legacy = ""
+        if r.get('issue_date'):
+            try:
+                date_legacy = datetime.strptime(r['issue_date'], "%Y-%m-%d").strftime("%d/%m/%Y")
+            except: 
+                pass
+
+        # Map fields
+        inv = {
+            "id": r.get('id'),
+            "date": date_legacy,
+            "total": float(r.get('amount') or 0),
+            "consumption": float(r.get('consumption_kwh') or 0),
+            "status": r.get('status'),
+            "client": r.get('client_name')
+        }
+        invoices.append(inv)
+
+    return invoices
+
+def _invoices_version():
+    """(row count, latest updated_at) of the configured backend. Raises on Supabase errors."""
+    supabase = None if ANALYTICS_BACKEND == "local" else common.get_supabase_client()
+    if not supabase:
+        if ANALYTICS_BACKEND == "supabase":
+            return None
+        return local_replica.get_replica().version()
+
+    try:
+        with metrics.upstream("supabase_read"):
+            response = (
+                supabase.table('invoices').select('updated_at', count='exact')
+                .order('updated_at', desc=True).limit(1).execute()
+            )
+    except Exception:
+        if ANALYTICS_BACKEND == "auto":
+            return local_replica.get_replica().version()
+        raise
+    latest = response.data[0]['updated_at'] if response.data else ""
+    return response.count or 0, latest or ""
+
+_file_hashes = {}  # path -> (mtime, size, content hash)
+
+def _file_hash(path):
+    """Content hash of a competitor file, recomputed only when its mtime or size changes."""
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    _file_hashes[path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+def get_dataset_version(base_dir, include_competitors=False):
+    """
+    Cheap fingerprint of the data behind the analytics endpoints, used for
+    ETag/Last-Modified validation without fetching the full invoice table.
+    Returns (version, last_modified_utc) or (None, None) if it can't be determined.
+    """
+    try:
+        version = _invoices_version()
+        if version is None:
+            return None, None
+        count, latest = version
+        parts = [str(count), latest]
+
+        last_modified = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        if latest:
+            last_modified = datetime.strptime(latest[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+
+        if include_competitors:
+            for name in ('competitors_ranking.json', MONTHLY_FILE):
+                ranking_path = os.path.join(base_dir, name)
+                if os.path.exists(ranking_path):
+                    # By content, not mtime: the same file on another machine or
+                    # deploy must give the same version (shared ranking snapshots)
+                    parts.append(_file_hash(ranking_path))
+                    mtime = os.path.getmtime(ranking_path)
+                    last_modified = max(last_modified, datetime.fromtimestamp(int(mtime), tz=timezone.utc))
+
+        return "|".join(parts), last_modified
+
+    except Exception as e:
+        print(f"Error reading dataset version: {e}")
+        return None, None
+
+def materialize_invoice_snapshot():
+    """Write the binary invoice snapshot for the current dataset version (run after each sync)."""
+    version = _invoices_version()
+    if version is None:
+        return 0
+    rows = _fetch_rows()
+    if not rows:
+        return 0
+    return invoice_snapshot.write_snapshot(rows, version="%s|%s" % version)
+
+def get_billing_data(base_dir, version=None):
     try:
-        invoices = _fetch_invoices()
+        invoices = _fetch_invoices(version)
         
         if not invoices:
             return {"labels": [], "values": [], "last_sync": "No data (Supabase empty or error)"}
@@ -143,18 +297,17 @@ def get_billing_data(base_dir):
     except Exception as e:
         return {"error": str(e)}
 
-def get_ranking_data(base_dir):
+def get_ranking_data(base_dir, version=None):
     try:
-        # 1. Load Competitors using BASE_DIR
-        ranking_path = os.path.join(base_dir, 'competitors_ranking.json')
-        if not os.path.exists(ranking_path):
+        # 1. Load Competitors (process-wide index, reloaded only when the file changes)
+        competitors = get_competitor_index(base_dir)
+        if competitors is None:
             return {"error": "Ranking data not found"}
-            
-        with open(ranking_path, 'r', encoding='utf-8') as f:
-            competitors = json.load(f)
-            
+        # Monthly competitor volumes, when imported, give the true rank per month
+        monthly = get_monthly_index(base_dir)
+
         # 2. Load User Data using Supabase Helper
-        user_invoices = _fetch_invoices()
+        user_invoices = _fetch_invoices(version)
         
         # 3. Process Invoices into Monthly Buckets
         monthly_map = {}
@@ -219,9 +372,10 @@ def get_ranking_data(base_dir):
             # Convert to GWh
             rolling_val = window_sum / 1_000_000
             
-            # Find Simulated Rank (User Rolling vs Approx Competitor Static)
-            better_competitors = [c for c in competitors if c.get('sales_2024', 0) > rolling_val]
-            rank = len(better_competitors) + 1
+            # Rank against competitors' rolling 12M for that month, or the static annual figure
+            rank = monthly.rank_of(month_str, rolling_val) if monthly else None
+            if rank is None:
+                rank = competitors.rank_of(rolling_val)
             
             evolution_labels.append(month_str)
             evolution_gwh.append(rolling_val)
@@ -255,19 +409,9 @@ def get_ranking_data(base_dir):
             "is_user": True,
             "rank": 0 # Will be calc below
         }
-        
-        all_entities = competitors + [user_entry]
-        all_entities.sort(key=lambda x: x.get('sales_2024', 0), reverse=True)
-        
-        final_ranking = []
-        user_rank_table = 0
-        
-        for i, entity in enumerate(all_entities):
-            rank = i + 1
-            entity['rank'] = rank
-            final_ranking.append(entity)
-            if entity.get('is_user'):
-                user_rank_table = rank
+
+        # Binary-search the user's position; cached competitor rows are not modified
+        final_ranking, user_rank_table = competitors.table_with(user_entry)
 
         return {
             "user_stats": {
@@ -275,7 +419,7 @@ def get_ranking_data(base_dir):
                 "gwh": current_gwh,
                 "gwh_prev": gwh_2023,
                 "change_pct": pct_change,
-                "total_competitors": len(competitors)
+                "total_competitors": competitors.count
             },
             "ranking_table": final_ranking, 
             "evolution": {
@@ -287,3 +431,104 @@ def get_ranking_data(base_dir):
 
     except Exception as e:
         return {"error": str(e)}
+
+# === RANKING SNAPSHOTS ===
+# The ranking response only depends on the invoices and the competitor files, so
+# it is materialised once per dataset version (after each sync) and served as is.
+# Lookup order: process memory -> local file -> Supabase `ranking_snapshots` -> rebuild.
+RANKING_SNAPSHOT_TABLE = "ranking_snapshots"
+RANKING_SNAPSHOT_PATH = os.getenv("RANKING_SNAPSHOT_PATH") or os.path.join(tempfile.gettempdir(), "enex_ranking_snapshot.json")
+
+_ranking_snapshot = {"version": None, "data": None}
+_ranking_snapshot_lock = threading.Lock()
+
+def _snapshot_key(version):
+    return hashlib.sha1(version.encode()).hexdigest()[:16]
+
+def _read_local_snapshot(key):
+    try:
+        with open(RANKING_SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return snapshot["data"] if snapshot.get("version") == key else None
+
+def _read_remote_snapshot(key):
+    supabase = common.get_supabase_client()
+    if not supabase:
+        return None
+    try:
+        with metrics.upstream("supabase_read"):
+            rows = (
+                supabase.table(RANKING_SNAPSHOT_TABLE).select("payload")
+                .eq("name", "ranking").eq("version", key).limit(1).execute().data
+            )
+    except Exception as e:
+        print(f"Error reading ranking snapshot: {e}")
+        return None
+    return rows[0]["payload"] if rows else None
+
+def _store_snapshot(key, data, remote=True):
+    _ranking_snapshot.update(version=key, data=data)
+
+    tmp_path = f"{RANKING_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": key, "created_at": datetime.now(timezone.utc).isoformat(), "data": data}, f)
+        os.replace(tmp_path, RANKING_SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"Error writing local ranking snapshot: {e}")
+
+    supabase = common.get_supabase_client() if remote else None
+    if supabase:
+        try:
+            with metrics.upstream("supabase_upsert"):
+                supabase.table(RANKING_SNAPSHOT_TABLE).upsert({
+                    "name": "ranking",
+                    "version": key,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "payload": data,
+                }).execute()
+        except Exception as e:
+            print(f"Error writing ranking snapshot to Supabase: {e}")
+
+def materialize_ranking_snapshot(base_dir, version=None):
+    """Compute the ranking response and store it for the current dataset version."""
+    if version is None:
+        version, _ = get_dataset_version(base_dir, include_competitors=True)
+    data = get_ranking_data(base_dir, version)
+    if version is not None and not data.get("error"):
+        with _ranking_snapshot_lock:
+            _store_snapshot(_snapshot_key(version), data)
+    return data
+
+def get_ranking_snapshot(base_dir, version):
+    """
+    Ranking response for `version` (from get_dataset_version). Only recomputed
+    when no snapshot exists for it, i.e. invoices or competitor data changed.
+    """
+    if version is None:
+        return get_ranking_data(base_dir)
+
+    key = _snapshot_key(version)
+    if _ranking_snapshot["version"] == key:
+        return _ranking_snapshot["data"]
+
+    with _ranking_snapshot_lock:
+        if _ranking_snapshot["version"] == key:
+            return _ranking_snapshot["data"]
+
+        data = _read_local_snapshot(key)
+        if data is not None:
+            _ranking_snapshot.update(version=key, data=data)
+            return data
+
+        data = _read_remote_snapshot(key)
+        if data is not None:
+            _store_snapshot(key, data, remote=False)
+            return data
+
+        data = get_ranking_data(base_dir, version)
+        if not data.get("error"):
+            _store_snapshot(key, data)
+        return data
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import zipfile
+import concurrent.futures
+from datetime import datetime, timedelta
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+import divakia_atr
+import omie_holded
+import facturas_emitidas
+
+# Load config
+common.load_config()
+
+# Días extra consultados en Holded antes de la ventana de cada extracción
+# (facturas con fecha de documento algo anterior a la de emisión en Orka)
+HOLDED_MARGEN_DIAS = 31
+
+def _ts():
+    # timestamp seguro para nombres de archivo en Windows
+    return datetime.now().strftime("%Y%m%d_%H-%M-%S")
+
+def _ventana_holded(dias):
+    """(starttmp, endtmp) de Holded para los últimos `dias` días más el margen."""
+    desde = datetime.now() - timedelta(days=dias + HOLDED_MARGEN_DIAS)
+    hasta = datetime.now() + timedelta(days=1)
+    return int(desde.timestamp()), int(hasta.timestamp())
+
+def _numeros_holded(future_docs, extraer=None):
+    """Devuelve un callable que extrae los números de documento de una descarga Holded compartida."""
+    def obtener():
+        if extraer:
+            return extraer(future_docs.result())
+        return {d.get("docNumber") for d in future_docs.result() if d.get("docNumber")}
+    return obtener
+
+def _dias_compras(ruta_zip):
+    """Días de compras a descargar de Holded: la ventana ATR, ampliada hasta la compra OMIE más antigua del ZIP."""
+    dias = divakia_atr.VENTANA_DIAS
+    if ruta_zip:
+        fecha = omie_holded.fecha_mas_antigua(ruta_zip)
+        if fecha:
+            dias = max(dias, (datetime.now() - fecha).days + 1)
+    return dias
+
+def _medir(nombre, funcion, *args, **kwargs):
+    """Ejecuta una extracción capturando resultado, duración y errores."""
+    inicio = time.time()
+    resumen = {"nombre": nombre, "estado": "OK", "facturas": 0, "archivo": None, "error": None}
+    try:
+        with common.span(nombre):
+            resultado = funcion(*args, **kwargs)
+        resumen["facturas"] = resultado["facturas"]
+        resumen["archivo"] = resultado["archivo"]
+        if not resultado["archivo"]:
+            resumen["estado"] = "SIN DATOS"
+    except Exception as e:
+        resumen["estado"] = "ERROR"
+        resumen["error"] = str(e)
+        print(f"❌ Error en {nombre}: {e}")
+    resumen["segundos"] = round(time.time() - inicio, 2)
+    return resumen
+
+def generar_resumen(resumenes, segundos_total):
+    lineas = [
+        f"Cierre mensual generado el {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+        f"Duración total: {segundos_total:.2f} s",
+        "",
+        f"{'Extracción':<20} {'Estado':<10} {'Facturas':>8} {'Segundos':>9}  Archivo",
+    ]
+    for r in resumenes:
+        archivo = os.path.basename(r["archivo"]) if r["archivo"] else "-"
+        lineas.append(f"{r['nombre']:<20} {r['estado']:<10} {r['facturas']:>8} {r['segundos']:>9.2f}  {archivo}")
+        if r["error"]:
+            lineas.append(f"    Error: {r['error']}")
+    return "\n".join(lineas) + "\n"
+
+def cerrar_mes(ctx=None):
+    inicio = time.time()
+
+    # Un único login en Orka compartido por las tres extracciones
+    with common.span("orka_login"):
+        token = common.get_orka_token()
+    if not token:
+        print("❌ No se pudo obtener token de ORKA. Verifica credenciales en .env.")
+        return
+
+    try:
+        ruta_zip = omie_holded.localizar_zip(ctx)
+    except FileNotFoundError:
+        ruta_zip = None
+        print("⚠️ No se encontró ZIP de OMIE. Se omitirá la extracción OMIE.")
+
+    carpeta = os.path.join(common.get_downloads_dir(), f"cierre_mensual_{_ts()}")
+    os.makedirs(carpeta, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        # Una única descarga de Holded por tipo de documento, limitada a la ventana
+        # de las extracciones que la usan (common.in_context keeps worker output in this run's log)
+        compras_holded = executor.submit(
+            common.in_context(common.get_holded_documents), "purchase", *_ventana_holded(_dias_compras(ruta_zip)))
+        ventas_holded = executor.submit(
+            common.in_context(common.get_holded_documents), "invoice", *_ventana_holded(facturas_emitidas.VENTANA_DIAS))
+
+        tareas = [
+            executor.submit(
+                common.in_context(_medir), "ATR", divakia_atr.ejecutar,
+                token=token,
+                obtener_holded=_numeros_holded(compras_holded),
+                archivo_salida=os.path.join(carpeta, "facturas_resultados.xlsx"),
+            ),
+            executor.submit(
+                common.in_context(_medir), "Facturas emitidas", facturas_emitidas.ejecutar,
+                token=token,
+                obtener_holded=_numeros_holded(ventas_holded),
+                out_path=os.path.join(carpeta, "facturas_emitidas.csv"),
+            ),
+        ]
+        if ruta_zip:
+            # Las compras de OMIE salen de la misma descarga, filtradas por contacto
+            tareas.append(executor.submit(
+                common.in_context(_medir), "OMIE", omie_holded.ejecutar,
+                ruta_zip=ruta_zip,
+                obtener_holded=_numeros_holded(compras_holded, omie_holded.numeros_de_contacto),
+                output_filename=os.path.join(carpeta, "compras_omie.xlsx"),
+            ))
+
+        resumenes = [t.result() for t in tareas]
+
+    resumen_txt = generar_resumen(resumenes, time.time() - inicio)
+    print("\n" + resumen_txt)
+
+    ruta_bundle = carpeta + ".zip"
+    with zipfile.ZipFile(ruta_bundle, "w", zipfile.ZIP_DEFLATED) as bundle:
+        for r in resumenes:
+            if r["archivo"]:
+                bundle.write(r["archivo"], os.path.basename(r["archivo"]))
+        bundle.writestr("resumen.txt", resumen_txt)
+
+    print(f"📦 Paquete de cierre generado: {ruta_bundle}")
+    common.trigger_download_via_stdout(ruta_bundle)
+    print("✅ Cierre mensual finalizado.")
+
+def main(ctx=None):
+    print("Iniciando cierre mensual (ATR + OMIE + Facturas emitidas en paralelo)...")
+
+    with common.trace_run("cierre_mensual"):
+        cerrar_mes(ctx)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,21 @@
 import os
 import sys
+import json
+import time
+import uuid
 import base64
 import logging
-import requests
+import functools
+import threading
+import contextlib
 from datetime import datetime
-from dotenv import load_dotenv
+
+# Ensure sibling modules resolve even when imported as scripts.common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import metrics
+
+# requests, dotenv and supabase are imported inside the functions that use them
+# so that importing common (e.g. from analytics) stays cheap on cold starts.
 
 # Configure Logging
 logging.basicConfig(
@@ -14,10 +25,264 @@ logging.basicConfig(
 )
 logger = logging.getLogger("EnexCommon")
 
+# === EXECUTION CONTEXT ===
+# Each script run carries its own parameters, input files and output sink.
+# The context is bound to the running thread, and sys.stdout/sys.stderr are
+# replaced by routers that send print() output to the sink of the current
+# thread's context, so several runs can share one process without mixing output.
+
+_local = threading.local()
+_router_lock = threading.Lock()
+
+class ExecutionContext:
+    """
+    Per-run state passed to a script's main(ctx).
+    params: dict of run parameters.
+    input_files: dict name -> path or file-like object.
+    output: file-like sink for everything the run prints (None = process stdout).
+    """
+
+    def __init__(self, params=None, input_files=None, output=None):
+        self.params = params or {}
+        self.input_files = input_files or {}
+        self.output = output
+        self.tracer = None
+
+    @classmethod
+    def from_env(cls):
+        """Context for command-line runs (INPUT_FILE_PATH as the uploaded file)."""
+        input_files = {}
+        if os.getenv("INPUT_FILE_PATH"):
+            input_files["file"] = os.getenv("INPUT_FILE_PATH")
+        return cls(input_files=input_files)
+
+    def input_file(self, name="file"):
+        return self.input_files.get(name)
+
+    def close_inputs(self):
+        """Free the file-like inputs handed to this run (spooled uploads)."""
+        for f in self.input_files.values():
+            # Spooled uploads expose release(); plain paths have nothing to close
+            close = getattr(f, "release", None) or getattr(f, "close", None)
+            if close:
+                close()
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Bind this context to the current thread."""
+        previous = getattr(_local, "context", None)
+        _local.context = self
+        try:
+            yield self
+        finally:
+            _local.context = previous
+
+def current_context():
+    return getattr(_local, "context", None)
+
+def in_context(fn):
+    """
+    Wrap `fn` so it runs under the caller's execution context, e.g. when
+    submitting work to a ThreadPoolExecutor from inside a script.
+    """
+    ctx = current_context()
+    if ctx is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with ctx.activate():
+            return fn(*args, **kwargs)
+    return wrapper
+
+class _ContextRoutedStream:
+    """Stand-in for sys.stdout/sys.stderr that writes to the current context's output."""
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+
+    def _target(self):
+        ctx = current_context()
+        if ctx is not None and ctx.output is not None:
+            return ctx.output
+        return self._fallback
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._fallback, name)
+
+def install_output_router():
+    """Route sys.stdout/sys.stderr through the execution context (idempotent)."""
+    with _router_lock:
+        if not isinstance(sys.stdout, _ContextRoutedStream):
+            sys.stdout = _ContextRoutedStream(sys.stdout)
+        if not isinstance(sys.stderr, _ContextRoutedStream):
+            sys.stderr = _ContextRoutedStream(sys.stderr)
+
+# === TRACING ===
+# Timing spans for script phases (fetch, transform, filter, write). A run opened
+# with trace_run() writes one JSON line per finished span to TRACE_DIR and prints
+# a per-phase summary table at the end.
+
+class _Span:
+    def __init__(self, name, attrs, parent_id):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = dict(attrs)
+        self.parent_id = parent_id
+        self.started_at = datetime.now().isoformat(timespec="milliseconds")
+        self._start = time.perf_counter()
+        self.duration_ms = None
+
+    def set(self, **attrs):
+        """Attach attributes discovered while the span runs (e.g. row counts)."""
+        self.attrs.update(attrs)
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+class Tracer:
+    """Collects the spans of one run and writes them as JSON lines."""
+
+    def __init__(self, run_name, trace_dir=None):
+        self.run_name = run_name
+        self.run_id = uuid.uuid4().hex[:12]
+        trace_dir = trace_dir or os.getenv("TRACE_DIR") or os.path.join(get_downloads_dir(), "traces")
+        os.makedirs(trace_dir, exist_ok=True)
+        self.path = os.path.join(trace_dir, f"{run_name}_{datetime.now():%Y%m%d_%H-%M-%S}_{self.run_id}.jsonl")
+        self.spans = []
+        self._lock = threading.Lock()
+        self._stacks = threading.local()
+        self._root_id = None
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _stack(self):
+        if not hasattr(self._stacks, "spans"):
+            self._stacks.spans = []
+        return self._stacks.spans
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        stack = self._stack()
+        # Spans opened from worker threads hang from the run's root span
+        parent_id = stack[-1].id if stack else self._root_id
+        current = _Span(name, attrs, parent_id)
+        if self._root_id is None:
+            self._root_id = current.id
+        stack.append(current)
+        status, error = "ok", None
+        try:
+            yield current
+        except BaseException as e:
+            status, error = "error", str(e)
+            raise
+        finally:
+            stack.pop()
+            current.duration_ms = round((time.perf_counter() - current._start) * 1000, 3)
+            self._record(current, status, error)
+
+    def _record(self, current, status, error):
+        record = {
+            "run": self.run_name,
+            "run_id": self.run_id,
+            "span_id": current.id,
+            "parent_id": current.parent_id,
+            "name": current.name,
+            "start": current.started_at,
+            "duration_ms": current.duration_ms,
+            "status": status,
+            "attrs": current.attrs,
+        }
+        if error:
+            record["error"] = error
+        with self._lock:
+            self.spans.append(current)
+            self._file.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def summary_table(self):
+        """Total time per span name, as a share of the whole run."""
+        with self._lock:
+            spans = list(self.spans)
+        root = next((sp for sp in spans if sp.id == self._root_id), None)
+        total_ms = root.duration_ms if root else sum(sp.duration_ms for sp in spans)
+
+        totals = {}
+        for sp in spans:
+            if sp is root:
+                continue
+            count, ms = totals.get(sp.name, (0, 0.0))
+            totals[sp.name] = (count + 1, ms + sp.duration_ms)
+
+        lines = [f"⏱️ Tiempos de {self.run_name} ({total_ms / 1000:.2f} s)",
+                 f"{'Fase':<32} {'N':>4} {'ms':>10} {'%':>6}"]
+        for name, (count, ms) in sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True):
+            pct = (ms / total_ms * 100) if total_ms else 0
+            lines.append(f"{name:<32} {count:>4} {ms:>10.1f} {pct:>5.1f}%")
+        lines.append(f"Traza: {self.path}")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+@contextlib.contextmanager
+def trace_run(run_name):
+    """
+    Trace a whole script run. Nested inside another traced run (e.g. cierre_mensual)
+    it becomes a span of that run instead of opening a new trace file.
+    """
+    ctx = current_context()
+    if ctx is None:
+        # Command-line run: trace under a context built from the environment
+        with ExecutionContext.from_env().activate():
+            with trace_run(run_name) as tracer:
+                yield tracer
+        return
+
+    if ctx.tracer is not None:
+        with ctx.tracer.span(run_name):
+            yield ctx.tracer
+        return
+
+    tracer = Tracer(run_name)
+    ctx.tracer = tracer
+    try:
+        with tracer.span(run_name):
+            yield tracer
+    finally:
+        ctx.tracer = None
+        tracer.close()
+        print(tracer.summary_table())
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Time a phase of the current traced run:
+        with common.span("fetch", source="orka") as sp:
+            ...
+            sp.set(rows=len(rows))
+    Outside a traced run it is a no-op.
+    """
+    ctx = current_context()
+    if ctx is None or ctx.tracer is None:
+        yield _NoopSpan()
+        return
+    with ctx.tracer.span(name, **attrs) as current:
+        yield current
+
 def load_config():
     """
     Load environment variables from .env file using absolute paths.
     """
+    from dotenv import load_dotenv
+
     # .../scripts/common.py -> .../scripts -> .../Enex_Antigravity
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.dirname(current_dir)
@@ -60,6 +325,8 @@ def get_orka_token():
     """
     Authenticate with Orka Manager and return access token.
     """
+    import requests
+
     login_url = "https://www.orkamanager.com/orkapi/login"
     encoded_user, encoded_password = get_orka_credentials()
     
@@ -74,7 +341,8 @@ def get_orka_token():
     try:
         # Orka requires standard form data or json? The original scripts used data=payload (form-urlencoded)
         # but one script manually set a dict. Let's stick to requests default which is form-urlencoded when data is dict.
-        response = requests.post(login_url, data=payload, timeout=15)
+        with metrics.upstream("orka_login"):
+            response = requests.post(login_url, data=payload, timeout=15)
         response.raise_for_status()
         
         token = response.json().get("access_token")
@@ -88,24 +356,182 @@ def get_orka_token():
         logger.error(f"Error during Orka login: {e}")
         return None
 
-def get_supabase_client():
+ORKA_FACTURAS_URL = "https://www.orkamanager.com/orkapi/facturas/find"
+
+def fetch_orka_invoices(token, fecha_desde, fecha_hasta, limit=1000, max_workers=None):
     """
-    Initialize and return Supabase client.
+    Fetch every client invoice issued between fecha_desde and fecha_hasta (DD/MM/YYYY).
+    The first page is requested alone; if it comes back full, the following pages
+    are requested in waves of `max_workers` concurrent calls until a short page
+    is returned. Raises RuntimeError if any page fails, so callers never take a
+    partial download for the full window.
+    """
+    import requests
+    import concurrent.futures
+
+    if max_workers is None:
+        max_workers = int(os.getenv("ORKA_PAGE_WORKERS", "4"))
+    max_workers = max(1, max_workers)
+
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+
+    def fetch_page(offset):
+        payload = {
+            "fecha_emision_factura_cliente_desde": fecha_desde,
+            "fecha_emision_factura_cliente_hasta": fecha_hasta,
+            "limite": limit,
+            "offset": offset
+        }
+        print(f"  Solicitando offset={offset} limit={limit}...")
+        with metrics.upstream("orka_facturas_page"):
+            response = requests.post(ORKA_FACTURAS_URL, headers=headers, json=payload, timeout=45)
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+        return response.json().get("facturas", [])
+
+    print(f"Consultando facturas desde {fecha_desde} hasta {fecha_hasta}...")
+
+    all_facturas = []
+    next_offset = 0
+    wave_size = 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            offsets = [next_offset + i * limit for i in range(wave_size)]
+            futures = [executor.submit(in_context(fetch_page), o) for o in offsets]
+
+            last_page_reached = False
+            for offset, future in zip(offsets, futures):
+                # Keep page order; anything after a short page is discarded
+                try:
+                    page_results = future.result()
+                except Exception as e:
+                    raise RuntimeError(f"Error al consultar facturas (offset={offset}): {e}") from e
+
+                all_facturas.extend(page_results)
+                if page_results:
+                    print(f"  Recibidas {len(page_results)} facturas. Total acumulado: {len(all_facturas)}")
+                if len(page_results) < limit:
+                    last_page_reached = True
+                    break
+
+            if last_page_reached:
+                break
+
+            next_offset = offsets[-1] + limit
+            wave_size = max_workers
+
+    return all_facturas
+
+# Process-wide Supabase clients keyed by (url, key), reused across requests and scripts
+_supabase_clients = {}
+_supabase_lock = threading.Lock()
+
+def _build_supabase_client(url, key):
+    from supabase import create_client
+
+    pool_size = int(os.getenv("SUPABASE_POOL_SIZE", "10"))
+    try:
+        import httpx
+        from supabase import ClientOptions
+    except ImportError:
+        # Older supabase versions don't accept a custom httpx client
+        logger.warning("Supabase client: default (unpooled) client, this supabase version has no ClientOptions.")
+        return create_client(url, key)
+
+    # httpx only speaks HTTP/2 with the optional `h2` package (httpx[http2])
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    # Keep-alive pool shared by every table()/rpc() call on this client
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(float(os.getenv("SUPABASE_TIMEOUT", "120"))),
+        follow_redirects=True,
+        http2=http2
+    )
+    try:
+        client = create_client(url, key, options=ClientOptions(httpx_client=http_client))
+    except TypeError:
+        http_client.close()
+        logger.warning("Supabase client: default (unpooled) client, ClientOptions does not accept httpx_client.")
+        return create_client(url, key)
+    logger.info(f"Supabase client: pooled httpx ({pool_size} connections, {'HTTP/2' if http2 else 'HTTP/1.1, h2 not installed'}).")
+    return client
+
+def get_supabase_client(refresh=False):
+    """
+    Return the cached Supabase client for SUPABASE_URL/SUPABASE_KEY, creating it
+    on first use (or when refresh=True). Thread-safe.
     """
-    from supabase import create_client, Client
-    
     url = os.getenv("SUPABASE_URL", "").strip()
     key = os.getenv("SUPABASE_KEY", "").strip()
     
     if not url or not key:
         logger.error("SUPABASE_URL or SUPABASE_KEY not found in environment.")
         return None
-        
+
+    with _supabase_lock:
+        client = _supabase_clients.get((url, key))
+        if client is not None and not refresh:
+            return client
+        try:
+            client = _build_supabase_client(url, key)
+        except Exception as e:
+            logger.error(f"Failed to initialize Supabase client: {e}")
+            return None
+        _supabase_clients[(url, key)] = client
+        return client
+
+def supabase_health_check():
+    """
+    Run a trivial query on the cached client; rebuild it if the query fails.
+    Returns the (possibly new) client, or None if Supabase is unavailable.
+    """
+    client = get_supabase_client()
+    if client is None:
+        return None
     try:
-        return create_client(url, key)
+        client.table("invoices").select("id").limit(1).execute()
+        return client
     except Exception as e:
-        logger.error(f"Failed to initialize Supabase client: {e}")
-        return None
+        logger.warning(f"Supabase health check failed ({e}). Rebuilding client.")
+        return get_supabase_client(refresh=True)
+
+HOLDED_DOCUMENTS_URL = "https://api.holded.com/api/invoicing/v1/documents"
+
+def get_holded_documents(doc_type, starttmp=1526979494, endtmp=2000000000):
+    """
+    Download the full list of Holded documents of a given type ('invoice', 'purchase', ...).
+    Returns a list of document dicts (empty on error or missing HOLDED_API_KEY).
+    """
+    import requests
+
+    api_key = os.getenv("HOLDED_API_KEY")
+    if not api_key:
+        logger.warning("HOLDED_API_KEY not found in environment.")
+        return []
+
+    url = f"{HOLDED_DOCUMENTS_URL}/{doc_type}"
+    headers = {"accept": "application/json", "key": api_key}
+    params = {"starttmp": starttmp, "endtmp": endtmp}
+
+    try:
+        with metrics.upstream("holded_documents"):
+            response = requests.get(url, headers=headers, params=params, timeout=30)
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, list):
+            logger.info(f"Holded '{doc_type}': {len(data)} documents.")
+            return data
+        logger.warning(f"Unexpected Holded response for '{doc_type}' (not a list).")
+        return []
+    except Exception as e:
+        logger.error(f"Error fetching Holded '{doc_type}' documents: {e}")
+        return []
 
 def clean_float(value):
     """
@@ -157,6 +583,7 @@ def trigger_download_via_stdout(file_path):
         if filename.endswith(".csv"): mime = "text/csv"
         elif filename.endswith(".xlsx"): mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         elif filename.endswith(".json"): mime = "application/json"
+        elif filename.endswith(".zip"): mime = "application/zip"
         
         with open(file_path, "rb") as f:
             data = f.read()
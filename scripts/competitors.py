@@ -0,0 +1,123 @@
+import os
+import json
+import bisect
+import threading
+
+# Competitor data loaded once per process into sorted indexes, rebuilt only when
+# the file's mtime changes. Entries are shared between requests and must be
+# treated as read-only.
+#   competitors_ranking.json   annual snapshot (ranking table)
+#   competitors_monthly.json   monthly volumes per company (evolution chart),
+#                              written by scripts/import_competitors_monthly.py
+
+COMPETITORS_FILE = "competitors_ranking.json"
+MONTHLY_FILE = "competitors_monthly.json"
+
+# Months of monthly data summed to compare against our rolling 12-month volume
+ROLLING_MONTHS = 12
+
+class CompetitorIndex:
+    def __init__(self, competitors, mtime):
+        self.mtime = mtime
+        ordered = sorted(competitors, key=lambda c: c.get("sales_2024", 0), reverse=True)
+        self.count = len(ordered)
+        # Ascending sales vector for bisect
+        self._sales_asc = tuple(sorted(c.get("sales_2024", 0) for c in ordered))
+        # Table rows with their rank precomputed for both sides of the user's row:
+        # above the user a competitor keeps rank i + 1, below it moves down to i + 2.
+        self._above = tuple(dict(c, rank=i + 1) for i, c in enumerate(ordered))
+        self._below = tuple(dict(c, rank=i + 2) for i, c in enumerate(ordered))
+
+    def count_above(self, value):
+        """Competitors with sales strictly greater than `value`."""
+        return self.count - bisect.bisect_right(self._sales_asc, value)
+
+    def count_at_or_above(self, value):
+        """Competitors with sales greater than or equal to `value`."""
+        return self.count - bisect.bisect_left(self._sales_asc, value)
+
+    def rank_of(self, value):
+        """Market rank a company with `value` GWh would have (ties rank ahead)."""
+        return self.count_above(value) + 1
+
+    def table_with(self, user_entry):
+        """
+        Ranking table with `user_entry` inserted after every competitor with
+        equal or higher sales. Returns (table, user_rank); no cached row is modified.
+        """
+        position = self.count_at_or_above(user_entry.get("sales_2024", 0))
+        user_row = dict(user_entry, rank=position + 1)
+        table = list(self._above[:position])
+        table.append(user_row)
+        table.extend(self._below[position:])
+        return table, position + 1
+
+class MonthlyCompetitorIndex:
+    """
+    Per-month sorted vectors of competitors' rolling 12-month volume (GWh), built
+    from the columnar monthly store. Only months with a full trailing window are ranked.
+    """
+
+    def __init__(self, store, mtime):
+        self.mtime = mtime
+        self.months = tuple(store.get("months") or ())
+        columns = store.get("columns") or {}
+        size = len(store.get("names") or ())
+
+        self._rolling_asc = {}
+        for i in range(ROLLING_MONTHS - 1, len(self.months)):
+            window = self.months[i - ROLLING_MONTHS + 1:i + 1]
+            if not _consecutive(window):
+                continue
+            totals = [0.0] * size
+            reported = [False] * size
+            for month in window:
+                for j, value in enumerate(columns.get(month) or ()):
+                    if value is not None:
+                        totals[j] += value
+                        reported[j] = True
+            self._rolling_asc[self.months[i]] = tuple(sorted(t for t, r in zip(totals, reported) if r))
+
+    def rank_of(self, month, value):
+        """Rank of `value` GWh (rolling 12 months to `month`) or None if the month isn't covered."""
+        vector = self._rolling_asc.get(month)
+        if vector is None:
+            return None
+        return len(vector) - bisect.bisect_right(vector, value) + 1
+
+def _consecutive(months):
+    for prev, cur in zip(months, months[1:]):
+        y, m = int(prev[:4]), int(prev[5:7])
+        if (y + m // 12, m % 12 + 1) != (int(cur[:4]), int(cur[5:7])):
+            return False
+    return True
+
+_indexes = {}  # path -> index
+_lock = threading.Lock()
+
+def _load(path, build):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    index = _indexes.get(path)
+    if index and index.mtime == mtime:
+        return index
+
+    with _lock:
+        index = _indexes.get(path)
+        if index and index.mtime == mtime:
+            return index
+        with open(path, "r", encoding="utf-8") as f:
+            index = build(json.load(f), mtime)
+        _indexes[path] = index
+        return index
+
+def get_competitor_index(base_dir):
+    """Index for base_dir/competitors_ranking.json (None if the file is missing)."""
+    return _load(os.path.join(base_dir, COMPETITORS_FILE), CompetitorIndex)
+
+def get_monthly_index(base_dir):
+    """Index for base_dir/competitors_monthly.json (None if the file is missing)."""
+    return _load(os.path.join(base_dir, MONTHLY_FILE), MonthlyCompetitorIndex)
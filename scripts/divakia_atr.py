@@ -8,11 +8,11 @@ from datetime import datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 
 import unicodedata
-import openpyxl
 
 # Ensure we can import common
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import common
+import metrics
 
 # Load configuration first
 common.load_config()
@@ -39,6 +39,9 @@ PROVEEDORES = {
 }
 PROVEEDOR_DEFAULT = {"nombre": "Desconocido", "nif": "NA"}
 
+# Ventana (días) de facturas ATR a contabilizar y de compras Holded consultadas
+VENTANA_DIAS = 90
+
 # IVA fijo solicitado
 IVA_PORCENTAJE = Decimal("21")
 IVA_FACTOR = Decimal("1") + (IVA_PORCENTAJE / Decimal("100"))
@@ -64,7 +67,8 @@ def obtener_facturas(token):
     }
     
     try:
-        response = requests.post(FACTURAS_URL, headers=headers, json=payload, timeout=20)
+        with metrics.upstream("orka_facturas_page"):
+            response = requests.post(FACTURAS_URL, headers=headers, json=payload, timeout=20)
         response.raise_for_status()
         logger.info("Facturas obtenidas exitosamente.")
         return response.json()
@@ -88,7 +92,7 @@ def obtener_compras_holded(api_key):
     }
     
     try:
-        tres_meses_atras = datetime.now() - timedelta(days=90)
+        tres_meses_atras = datetime.now() - timedelta(days=VENTANA_DIAS)
         timestamp_inicio = int(tres_meses_atras.timestamp())
         
         hoy = datetime.now()
@@ -100,13 +104,15 @@ def obtener_compras_holded(api_key):
             "endtmp": timestamp_fin
         }
 
-        response = requests.get(HOLDED_API_URL, headers=headers, params=params, timeout=20)
+        with metrics.upstream("holded_documents"):
+            response = requests.get(HOLDED_API_URL, headers=headers, params=params, timeout=20)
         
         if response.status_code == 400:
             logger.warning("Fallo con timestamp en segundos. Intentando con milisegundos...")
             params["starttmp"] = timestamp_inicio * 1000
             params["endtmp"] = timestamp_fin * 1000
-            response = requests.get(HOLDED_API_URL, headers=headers, params=params, timeout=20)
+            with metrics.upstream("holded_documents"):
+                response = requests.get(HOLDED_API_URL, headers=headers, params=params, timeout=20)
 
         response.raise_for_status()
         
@@ -196,11 +202,50 @@ def procesar_datos(data):
         
     return registros
 
+def procesar_compras(facturas):
+    """
+    Compras ATR con su periodo facturado, para cruzarlas con las ventas (margin_engine).
+    Devuelve dicts con id, cups, fecha_desde/fecha_hasta (YYYY-MM-DD), tipo e importe
+    sin IVA (importe_total_atr_euros menos IVA; si no viene desglosado, / IVA_FACTOR).
+    """
+    compras = []
+    for factura in facturas:
+        factura_atr = factura.get("factura_atr") or {}
+        num_factura = factura.get("codigo_factura_atr") or factura_atr.get("codigo_factura_atr")
+        if not factura_atr or not num_factura:
+            continue
+
+        importe_total = safe_decimal(factura_atr.get("importe_total_atr_euros"))
+        iva = safe_decimal(factura_atr.get("iva_euros")) + safe_decimal(factura_atr.get("iva_reducido_euros"))
+        importe_neto = importe_total - iva if iva else importe_total / IVA_FACTOR
+
+        compras.append({
+            "id": num_factura,
+            "cups": factura.get("cups"),
+            "fecha_desde": _fecha_iso(factura_atr.get("fecha_desde")),
+            "fecha_hasta": _fecha_iso(factura_atr.get("fecha_hasta")),
+            "tipo": factura_atr.get("tipo_factura_atr"),
+            "importe": float(importe_neto.quantize(Decimal("0.00"), rounding=ROUND_HALF_UP)),
+        })
+    return compras
+
+def _fecha_iso(valor):
+    if not valor:
+        return None
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%Y/%m/%d"):
+        try:
+            return datetime.strptime(valor, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
 def guardar_en_excel(datos, archivo_salida):
-    """Guarda los datos en un archivo XLSX usando openpyxl."""
+    """Guarda los datos en un archivo XLSX usando openpyxl. Devuelve True si se escribió."""
+    import openpyxl
+
     if not datos:
         print("Lista de datos vacía, no se generará archivo XLSX.")
-        return
+        return False
 
     try:
         output_dir = os.path.dirname(archivo_salida)
@@ -229,30 +274,42 @@ def guardar_en_excel(datos, archivo_salida):
             
         wb.save(archivo_salida)
         print(f"Archivo XLSX guardado exitosamente en: {archivo_salida}")
+        return True
 
     except Exception as e:
         print(f"Error al guardar el archivo XLSX: {e}")
+        return False
 
 
 # === PROGRAMA PRINCIPAL ===
 import concurrent.futures
 
-# === PROGRAMA PRINCIPAL ===
-def main():
-    print("Iniciando proceso de extracción de facturas ATR...")
-    
-    # 1. Configuración de Salida
-    archivo_salida = os.path.join(common.get_downloads_dir(), "facturas_resultados.xlsx")
+def ejecutar(token=None, obtener_holded=None, archivo_salida=None):
+    """
+    Extrae las facturas ATR, filtra las ya contabilizadas en Holded y genera el XLSX.
+    `obtener_holded` es un callable que devuelve el set de números de documento
+    existentes (por defecto se consultan las compras de Holded de los últimos 3 meses).
+    Retorna un dict con 'archivo' (None si no se generó) y 'facturas'.
+    """
+    resultado = {"archivo": None, "facturas": 0}
 
-    # 2. Configuración Holded
-    holded_key = os.getenv("HOLDED_API_KEY")
+    if not archivo_salida:
+        archivo_salida = os.path.join(common.get_downloads_dir(), "facturas_resultados.xlsx")
+
+    if obtener_holded is None:
+        holded_key = os.getenv("HOLDED_API_KEY")
+        if holded_key:
+            obtener_holded = lambda: obtener_compras_holded(holded_key)
+        else:
+            print("No se configuró HOLDED_API_KEY. Se omitirá el filtrado.")
+
+    if not token:
+        with common.span("orka_login"):
+            token = common.get_orka_token()
 
-    # 4. Obtención de Datos Divakia con common (Token only)
-    token = common.get_orka_token()
-    
     if not token:
         print("❌ No se pudo obtener token de ORKA. Verifica credenciales en .env.")
-        return
+        return resultado
 
     # PARALLEL EXECUTION
     print("Obteniendo datos de Holded y ORKA en paralelo...")
@@ -260,76 +317,94 @@ def main():
     facturas_holded = set()
     data_facturas = None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        future_holded = None
-        if holded_key:
-            future_holded = executor.submit(obtener_compras_holded, holded_key)
-        else:
-            print("No se configuró HOLDED_API_KEY. Se omitirá el filtrado.")
+    with common.span("fetch", source="orka+holded") as sp:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            future_holded = None
+            if obtener_holded:
+                future_holded = executor.submit(common.in_context(obtener_holded))
 
-        future_orka = executor.submit(obtener_facturas, token)
+            future_orka = executor.submit(common.in_context(obtener_facturas), token)
         
-        # Wait for results
-        if future_holded:
+            # Wait for results
+            if future_holded:
+                try:
+                    facturas_holded = future_holded.result()
+                    print(f"Datos Holded recibidos: {len(facturas_holded)} facturas previas.")
+                except Exception as e:
+                    print(f"❌ Error obteniendo datos Holded: {e}")
+
             try:
-                facturas_holded = future_holded.result()
-                print(f"Datos Holded recibidos: {len(facturas_holded)} facturas previas.")
+                data_facturas = future_orka.result()
+                print("Datos ORKA recibidos.")
             except Exception as e:
-                print(f"❌ Error obteniendo datos Holded: {e}")
+                print(f"❌ Error obteniendo datos ORKA: {e}")
 
-        try:
-            data_facturas = future_orka.result()
-            print("Datos ORKA recibidos.")
-        except Exception as e:
-            print(f"❌ Error obteniendo datos ORKA: {e}")
+        sp.set(holded_docs=len(facturas_holded), orka_facturas=len((data_facturas or {}).get("facturas", [])))
 
     if not data_facturas:
         print("❌ No se obtuvieron datos de facturas. Abortando.")
-        return
+        return resultado
 
     # 5. Procesamiento
-    registros = procesar_datos(data_facturas)
+    with common.span("transform") as sp:
+        registros = procesar_datos(data_facturas)
+        sp.set(rows=len(registros))
     
-    if registros:
-        print("Filtrando facturas antiguas (más de 3 meses de antigüedad)...")
-        fecha_limite = datetime.now() - timedelta(days=90)
-        inicial_cnt = len(registros)
+    with common.span("filter") as sp:
+        if registros:
+            print("Filtrando facturas antiguas (más de 3 meses de antigüedad)...")
+            fecha_limite = datetime.now() - timedelta(days=VENTANA_DIAS)
+            inicial_cnt = len(registros)
         
-        registros_filtrados = []
-        for r in registros:
-            d_str = r.get("Fecha dd/mm/yyyy", "")
-            try:
-                # Intentar parsear fecha
-                if d_str:
-                    dt = datetime.strptime(d_str, "%d/%m/%Y")
-                    if dt >= fecha_limite:
-                        registros_filtrados.append(r)
-                else:
+            registros_filtrados = []
+            for r in registros:
+                d_str = r.get("Fecha dd/mm/yyyy", "")
+                try:
+                    # Intentar parsear fecha
+                    if d_str:
+                        dt = datetime.strptime(d_str, "%d/%m/%Y")
+                        if dt >= fecha_limite:
+                            registros_filtrados.append(r)
+                    else:
+                        pass
+                except:
                     pass
-            except:
-                pass
         
-        registros = registros_filtrados
-        final_cnt = len(registros)
+            registros = registros_filtrados
+            final_cnt = len(registros)
         
-        print(f"Se descartaron {inicial_cnt - final_cnt} facturas anteriores a {fecha_limite.strftime('%d/%m/%Y')}.")
+            print(f"Se descartaron {inicial_cnt - final_cnt} facturas anteriores a {fecha_limite.strftime('%d/%m/%Y')}.")
+
+        if registros and facturas_holded:
+            print("Filtrando facturas ya existentes en Holded...")
+            inicial_cnt = len(registros)
+            registros = [r for r in registros if r["Num factura"] not in facturas_holded]
+            final_cnt = len(registros)
+            print(f"Se filtraron {inicial_cnt - final_cnt} facturas que ya existían en Holded.")
 
-    if registros and facturas_holded:
-        print("Filtrando facturas ya existentes en Holded...")
-        inicial_cnt = len(registros)
-        registros = [r for r in registros if r["Num factura"] not in facturas_holded]
-        final_cnt = len(registros)
-        print(f"Se filtraron {inicial_cnt - final_cnt} facturas que ya existían en Holded.")
+        sp.set(rows=len(registros))
 
     # 6. Guardado (Excel)
-    # archivo_salida = archivo_salida.replace(".xlsx", ".csv") # No longer needed
-    guardar_en_excel(registros, archivo_salida)
+    with common.span("write", format="xlsx", rows=len(registros)):
+        escrito = guardar_en_excel(registros, archivo_salida)
+
+    # Sin escritura, un fichero previo con el mismo nombre no es el de esta ejecución
+    if escrito:
+        resultado["facturas"] = len(registros)
+        resultado["archivo"] = archivo_salida
+    return resultado
+
+def main(ctx=None):
+    print("Iniciando proceso de extracción de facturas ATR...")
+    
+    with common.trace_run("divakia_atr"):
+        resultado = ejecutar()
     
     # Trigger download
-    common.trigger_download_via_stdout(archivo_salida)
+    if resultado["archivo"]:
+        common.trigger_download_via_stdout(resultado["archivo"])
     
     print("✅ Proceso finalizado.")
 
 if __name__ == "__main__":
     main()
-
@@ -8,6 +8,7 @@ import unicodedata
 # Ensure we can import common
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import common
+import metrics
 
 # === CONFIGURACIÓN ===
 # Load config from .env
@@ -43,35 +44,87 @@ def convertir_a_float(valor):
     except (ValueError, TypeError):
         return 0.0
 
-def obtener_facturas(token):
-    """Consulta solo las facturas emitidas en los últimos 7 días (ajustable)."""
-    url = "https://www.orkamanager.com/orkapi/facturas/find"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+# Ventana de consulta (días hacia atrás desde hoy)
+VENTANA_DIAS = int(os.getenv("FACTURAS_EMITIDAS_DIAS", "25"))
+# Origen de datos: "orka" (por defecto), "supabase" o "auto" (Supabase si la última sincronización es reciente)
+FUENTE = os.getenv("FACTURAS_EMITIDAS_FUENTE", "orka").lower()
+# Antigüedad máxima (minutos) de la sincronización para considerar Supabase al día
+MAX_EDAD_SYNC_MIN = int(os.getenv("FACTURAS_EMITIDAS_MAX_EDAD_MIN", "30"))
 
+def obtener_facturas(token, dias=None):
+    """Consulta todas las facturas emitidas en los últimos `dias` días (paginado)."""
     hoy = datetime.today()
-    # PRECAUCION: El código original decía 'timedelta(days=25)' aunque el docstring decía '7 días'.
-    # Mantendremos 25 días por seguridad para cubrir el rango esperado.
-    hace_dias = hoy - timedelta(days=25)
+    hace_dias = hoy - timedelta(days=dias or VENTANA_DIAS)
     fecha_desde = hace_dias.strftime("%d/%m/%Y")
     fecha_hasta = hoy.strftime("%d/%m/%Y")
 
-    payload = {
-        "fecha_emision_factura_cliente_desde": fecha_desde,
-        "fecha_emision_factura_cliente_hasta": fecha_hasta,
-        "limite": 1000,
-        "offset": 0
-    }
+    return common.fetch_orka_invoices(token, fecha_desde, fecha_hasta)
+
+def obtener_facturas_supabase(dias=None, max_edad_min=None):
+    """
+    Lee las facturas de la ventana desde la tabla `invoices` (campo raw_data, tal cual
+    las devolvió Orka en la última sincronización).
+    Devuelve None si Supabase no está configurado o la sincronización no es lo bastante reciente.
+    """
+    supabase = common.get_supabase_client()
+    if not supabase:
+        return None
+
+    max_edad = timedelta(minutes=max_edad_min if max_edad_min is not None else MAX_EDAD_SYNC_MIN)
+    hoy = datetime.today()
+    desde = (hoy - timedelta(days=dias or VENTANA_DIAS)).strftime("%Y-%m-%d")
+    hasta = hoy.strftime("%Y-%m-%d")
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        if response.status_code == 200:
-            return response.json().get("facturas", [])
-        else:
-            print(f"Error al consultar facturas: {response.status_code} - {response.text}")
-            return []
+        with metrics.upstream("supabase_read"):
+            ultima = supabase.table("invoices").select("updated_at").order("updated_at", desc=True).limit(1).execute()
+        if not ultima.data:
+            return None
+        # updated_at se guarda con datetime.now().isoformat() en la sincronización
+        ultima_sync = datetime.strptime(ultima.data[0]["updated_at"][:19], "%Y-%m-%dT%H:%M:%S")
+        if datetime.now() - ultima_sync > max_edad:
+            print(f"Última sincronización en Supabase: {ultima_sync:%d/%m/%Y %H:%M}. Demasiado antigua, se consultará ORKA.")
+            return None
+
+        facturas = []
+        offset = 0
+        limit = 1000
+        while True:
+            with metrics.upstream("supabase_read"):
+                response = (
+                    supabase.table("invoices").select("raw_data")
+                    .gte("issue_date", desde).lte("issue_date", hasta)
+                    .range(offset, offset + limit - 1).execute()
+                )
+            batch = response.data or []
+            facturas.extend(r["raw_data"] for r in batch if r.get("raw_data"))
+            if len(batch) < limit:
+                break
+            offset += limit
+
+        print(f"Fuente de facturas: Supabase (FACTURAS_EMITIDAS_FUENTE={FUENTE}, última sincronización {ultima_sync:%d/%m/%Y %H:%M}).")
+        return facturas
     except Exception as e:
-        print(f"Excepción obteniendo facturas: {e}")
-        return []
+        print(f"Excepción leyendo facturas de Supabase: {e}")
+        return None
+
+def cargar_facturas(token=None, dias=None):
+    """Obtiene las facturas de la ventana según FACTURAS_EMITIDAS_FUENTE."""
+    if FUENTE in ("supabase", "auto"):
+        max_edad = None if FUENTE == "auto" else 10 ** 9  # "supabase" fuerza la lectura
+        facturas = obtener_facturas_supabase(dias=dias, max_edad_min=max_edad)
+        if facturas is not None:
+            return facturas
+        if FUENTE == "supabase":
+            print("⚠️ No se pudieron leer facturas de Supabase. Se consultará ORKA.")
+
+    print(f"Fuente de facturas: ORKA (FACTURAS_EMITIDAS_FUENTE={FUENTE}).")
+    if not token:
+        token = common.get_orka_token()
+    if not token:
+        print("❌ No se pudo obtener el token de ORKA. Verifica las credenciales en .env")
+        return None
+    return obtener_facturas(token, dias=dias)
 
 def obtener_facturas_holded():
     if not holded_api_key:
@@ -84,7 +137,8 @@ def obtener_facturas_holded():
     headers = {"accept": "application/json", "key": holded_api_key}
     
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        with metrics.upstream("holded_documents"):
+            response = requests.get(url, headers=headers, timeout=30)
         if response.status_code == 200:
             facturas_holded = response.json()
             # Asegurar que es lista
@@ -107,143 +161,185 @@ def generar_csv_facturas(facturas, facturas_holded, output_path):
         "Cuenta de pago", "Tags separados por -", "Nombre canal de venta", "Cuenta canal de venta", "Moneda", "Cambio de moneda", "Almacen"
     ]
 
-    # Filtrar facturas
-    facturas_filtradas = []
+    with common.span("filter") as sp:
+        # Filtrar facturas
+        facturas_filtradas = []
     
-    current_year = datetime.now().year
+        current_year = datetime.now().year
     
-    for f in facturas:
-        code = f.get("codigo_factura_cliente", "")
-        # Mantener filtro estricto por ahora, asumiendo N{current_year} o N2026?
-        # Original code was "N2026". 
-        if not code.startswith("N2026"):
-            continue
+        for f in facturas:
+            code = f.get("codigo_factura_cliente", "")
+            # Mantener filtro estricto por ahora, asumiendo N{current_year} o N2026?
+            # Original code was "N2026". 
+            if not code.startswith("N2026"):
+                continue
             
-        if f.get("estado_factura") != "Factura cliente emitida":
-            continue
+            if f.get("estado_factura") != "Factura cliente emitida":
+                continue
             
-        if code in facturas_holded:
-            continue
+            if code in facturas_holded:
+                continue
             
-        facturas_filtradas.append(f)
+            facturas_filtradas.append(f)
+
+        sp.set(rows=len(facturas_filtradas))
 
     # Escribir CSV
     try:
-        with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=columnas, delimiter=';') # Excel friendly delimiter
-            writer.writeheader()
+        with common.span("write", format="csv", rows=len(facturas_filtradas)):
+            with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=columnas, delimiter=';') # Excel friendly delimiter
+                writer.writeheader()
             
-            for f in facturas_filtradas:
-                fc = f.get("factura_cliente", {})
-                fecha_emision = fc.get("fecha_emision", "")
+                for f in facturas_filtradas:
+                    fc = f.get("factura_cliente", {})
+                    fecha_emision = fc.get("fecha_emision", "")
                 
-                # Calculo vencimiento +5 dias
-                fecha_venc = ""
-                if fecha_emision:
-                    try:
-                        dt_emision = datetime.strptime(fecha_emision, "%d/%m/%Y")
-                        fecha_venc = (dt_emision + timedelta(days=5)).strftime("%d/%m/%Y")
-                    except:
-                        pass
+                    # Calculo vencimiento +5 dias
+                    fecha_venc = ""
+                    if fecha_emision:
+                        try:
+                            dt_emision = datetime.strptime(fecha_emision, "%d/%m/%Y")
+                            fecha_venc = (dt_emision + timedelta(days=5)).strftime("%d/%m/%Y")
+                        except:
+                            pass
                         
-                descripcion = f"Periodo de medida: {fc.get('fecha_desde', '')} - {fc.get('fecha_hasta', '')}"
+                    descripcion = f"Periodo de medida: {fc.get('fecha_desde', '')} - {fc.get('fecha_hasta', '')}"
                 
-                # Unir nombre
-                parts = [
-                    f.get("nombre_razon_social", ""), 
-                    f.get("nombre", ""), 
-                    f.get("primer_apellido", ""), 
-                    f.get("segundo_apellido", "")
-                ]
-                nombre_contacto = " ".join([p for p in parts if p and p.strip()])
-                nombre_contacto = normalize_text(nombre_contacto) # Normalize name
-
-                importe_total = convertir_a_float(fc.get("importe_total_cliente_euros"))
-                iva_euros = convertir_a_float(fc.get("iva_euros"))
-                iva_reducido = convertir_a_float(fc.get("iva_reducido_euros"))
-
-                precio_unidad = 0.0
-                iva_valor = 0
-
-                # Lógica de desglose IVA inverso
-                if importe_total > 0:
-                    if iva_euros > 0:
-                        iva_valor = 21
-                        precio_unidad = round(importe_total / (1 + iva_valor / 100.0), 2)
-                    elif iva_reducido > 0:
-                        iva_valor = 10
-                        precio_unidad = round(importe_total / (1 + iva_valor / 100.0), 2)
-
-                row = {
-                    "Num factura": f.get("codigo_factura_cliente", ""),
-                    "Formato de numeracion": "2025%%%%", 
-                    "Fecha dd/mm/yyyy": fecha_emision,
-                    "Fecha de vencimiento dd/mm/yyyy": fecha_venc,
-                    "Descripcion": descripcion,
-                    "Nombre del contacto": nombre_contacto,
-                    "NIF del contacto": f.get("identificador", ""),
-                    "Direccion": normalize_text(f.get("direccion_punto_suministro", "")),
-                    "Poblacion": normalize_text(f.get("poblacion", "")),
-                    "Codigo postal": f.get("codigo_postal", ""),
-                    "Provincia": normalize_text(f.get("provincia", "")),
-                    "Pais": normalize_text(f.get("pais", "")),
-                    "Concepto": "",
-                    "Descripcion del producto": "",
-                    "SKU": "",
-                    "Precio unidad": f"{precio_unidad:.2f}", # Dot decimal format
-                    "Unidades": "1",
-                    "Descuento %": "",
-                    "IVA %": str(iva_valor),
-                    "Retencion %": "",
-                    "Rec. de eq. %": "",
-                    "Operacion": "",
-                    "Forma de pago (ID)": "",
-                    "Cantidad cobrada": "",
-                    "Fecha de cobro": "",
-                    "Cuenta de pago": "",
-                    "Tags separados por -": "",
-                    "Nombre canal de venta": "",
-                    "Cuenta canal de venta": "",
-                    "Moneda": "eur",
-                    "Cambio de moneda": "1",
-                    "Almacen": ""
-                }
-                writer.writerow(row)
-        return True
+                    # Unir nombre
+                    parts = [
+                        f.get("nombre_razon_social", ""), 
+                        f.get("nombre", ""), 
+                        f.get("primer_apellido", ""), 
+                        f.get("segundo_apellido", "")
+                    ]
+                    nombre_contacto = " ".join([p for p in parts if p and p.strip()])
+                    nombre_contacto = normalize_text(nombre_contacto) # Normalize name
+
+                    importe_total = convertir_a_float(fc.get("importe_total_cliente_euros"))
+                    iva_euros = convertir_a_float(fc.get("iva_euros"))
+                    iva_reducido = convertir_a_float(fc.get("iva_reducido_euros"))
+
+                    precio_unidad = 0.0
+                    iva_valor = 0
+
+                    # Lógica de desglose IVA inverso
+                    if importe_total > 0:
+                        if iva_euros > 0:
+                            iva_valor = 21
+                            precio_unidad = round(importe_total / (1 + iva_valor / 100.0), 2)
+                        elif iva_reducido > 0:
+                            iva_valor = 10
+                            precio_unidad = round(importe_total / (1 + iva_valor / 100.0), 2)
+
+                    row = {
+                        "Num factura": f.get("codigo_factura_cliente", ""),
+                        "Formato de numeracion": "2025%%%%", 
+                        "Fecha dd/mm/yyyy": fecha_emision,
+                        "Fecha de vencimiento dd/mm/yyyy": fecha_venc,
+                        "Descripcion": descripcion,
+                        "Nombre del contacto": nombre_contacto,
+                        "NIF del contacto": f.get("identificador", ""),
+                        "Direccion": normalize_text(f.get("direccion_punto_suministro", "")),
+                        "Poblacion": normalize_text(f.get("poblacion", "")),
+                        "Codigo postal": f.get("codigo_postal", ""),
+                        "Provincia": normalize_text(f.get("provincia", "")),
+                        "Pais": normalize_text(f.get("pais", "")),
+                        "Concepto": "",
+                        "Descripcion del producto": "",
+                        "SKU": "",
+                        "Precio unidad": f"{precio_unidad:.2f}", # Dot decimal format
+                        "Unidades": "1",
+                        "Descuento %": "",
+                        "IVA %": str(iva_valor),
+                        "Retencion %": "",
+                        "Rec. de eq. %": "",
+                        "Operacion": "",
+                        "Forma de pago (ID)": "",
+                        "Cantidad cobrada": "",
+                        "Fecha de cobro": "",
+                        "Cuenta de pago": "",
+                        "Tags separados por -": "",
+                        "Nombre canal de venta": "",
+                        "Cuenta canal de venta": "",
+                        "Moneda": "eur",
+                        "Cambio de moneda": "1",
+                        "Almacen": ""
+                    }
+                    writer.writerow(row)
+        return len(facturas_filtradas)
     except Exception as e:
         print(f"Error escribiendo CSV: {e}")
         return False
 
-# Alias de compatibilidad
+def ejecutar(token=None, obtener_holded=None, out_path=None, dias=None):
+    """
+    Genera el CSV de facturas emitidas pendientes de importar en Holded.
+    `obtener_holded` es un callable que devuelve el set de números ya existentes
+    (por defecto se consultan las facturas de venta de Holded).
+    `dias` sustituye la ventana por defecto (FACTURAS_EMITIDAS_DIAS).
+    Retorna un dict con 'archivo' (None si no se generó) y 'facturas'.
+    """
+    resultado = {"archivo": None, "facturas": 0}
 
+    with common.span("fetch", source="invoices") as sp:
+        facturas = cargar_facturas(token, dias=dias)
+        sp.set(rows=len(facturas or []))
+    if facturas is None:
+        return resultado
+    print(f"Facturas recuperadas: {len(facturas)}")
 
-def main():
+    if not facturas:
+        print("ℹ️ No se encontraron facturas en el rango de fechas.")
+        return resultado
+
+    with common.span("fetch", source="holded") as sp:
+        facturas_holded = (obtener_holded or obtener_facturas_holded)()
+        sp.set(rows=len(facturas_holded))
+    print(f"Facturas recuperadas de HOLDED: {len(facturas_holded)}")
+
+    if not out_path:
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        out_path = os.path.join(DOWNLOADS_DIR, f"facturas_emitidas_{_ts()}.csv")
+
+    resultado["facturas"] = generar_csv_facturas(facturas, facturas_holded, out_path)
+    if resultado["facturas"] is False:
+        print("❌ Fallo al generar el archivo CSV")
+        resultado["facturas"] = 0
+        return resultado
+    if not resultado["facturas"]:
+        # Solo la cabecera: nada que importar en Holded
+        print("ℹ️ No hay facturas nuevas para importar.")
+        os.remove(out_path)
+        return resultado
+
+    print(f"✅ Archivo CSV generado con éxito: {out_path}")
+    resultado["archivo"] = out_path
+    return resultado
+
+
+def main(ctx=None):
     print("Iniciando generación de facturas emitidas...")
-    
-    token = common.get_orka_token()
-    
-    if token:
-        facturas = obtener_facturas(token)
-        print(f"Facturas recuperadas de ORKA: {len(facturas)}")
+    ctx = ctx or common.ExecutionContext.from_env()
 
-        if facturas:
-            facturas_holded = obtener_facturas_holded()
-            print(f"Facturas recuperadas de HOLDED: {len(facturas_holded)}")
-            
-            os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-            out_path = os.path.join(DOWNLOADS_DIR, f"facturas_emitidas_{_ts()}.csv")
-            
-            if generar_csv_facturas(facturas, facturas_holded, out_path):
-                print(f"✅ Archivo CSV generado con éxito: {out_path}")
-                common.trigger_download_via_stdout(out_path)
-            else:
-                print("❌ Fallo al generar el archivo CSV")
-        else:
-            print("ℹ️ No se encontraron facturas en el rango de fechas.")
+    # Los parámetros de un job llegan tal cual del JSON ("30" o 30)
+    dias = ctx.params.get("dias")
+    if dias not in (None, ""):
+        try:
+            dias = int(dias)
+        except (TypeError, ValueError):
+            raise ValueError(f"Parámetro 'dias' no válido: {dias!r} (se espera un número entero de días)")
+        if dias <= 0:
+            raise ValueError(f"Parámetro 'dias' no válido: {dias} (debe ser mayor que 0)")
     else:
-        print("❌ No se pudo obtener el token de ORKA. Verifica las credenciales en .env")
+        dias = None
+    
+    with common.trace_run("facturas_emitidas"):
+        resultado = ejecutar(dias=dias)
+    
+    if resultado["archivo"]:
+        common.trigger_download_via_stdout(resultado["archivo"])
 
 # === EJECUCIÓN LOCAL ===
 if __name__ == "__main__":
     main()
-
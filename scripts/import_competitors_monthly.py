@@ -0,0 +1,158 @@
+import os
+import re
+import sys
+import csv
+import json
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+from competitors import MONTHLY_FILE
+
+# Importa volúmenes mensuales de comercializadoras (publicaciones CNMC / mercado)
+# al almacén columnar competitors_monthly.json que usa el ranking mensual.
+#
+# Uso:
+#   python scripts/import_competitors_monthly.py datos.csv [--unidad kwh|mwh|gwh]
+#
+# Formatos de CSV aceptados (separador ; o ,  y decimales con coma o punto):
+#   largo:  comercializadora;mes;valor          (una fila por empresa y mes)
+#   ancho:  comercializadora;2024-01;2024-02;... (una columna por mes)
+# Meses como 2024-01, 2024/01, 01/2024 o 202401. Los datos nuevos se fusionan con
+# los existentes: un mes ya importado se sobrescribe solo para las empresas incluidas.
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORE_PATH = os.path.join(BASE_DIR, MONTHLY_FILE)
+
+UNIDADES = {"kwh": 1e-6, "mwh": 1e-3, "gwh": 1.0}
+
+def normalizar_mes(valor):
+    """'2024-01', '2024/01', '01/2024', '202401' -> '2024-01' (None si no es un mes)."""
+    valor = (valor or "").strip()
+    m = re.fullmatch(r"((?:19|20)\d{2})(?:[-/](\d{1,2})|(\d{2}))", valor)
+    if m:
+        año, mes = m.group(1), m.group(2) or m.group(3)
+    else:
+        m = re.fullmatch(r"(\d{1,2})[-/](\d{4})", valor)
+        if not m:
+            return None
+        mes, año = m.groups()
+    if not 1 <= int(mes) <= 12:
+        return None
+    return f"{año}-{int(mes):02d}"
+
+def parsear_numero(valor):
+    valor = (valor or "").strip().replace(" ", "")
+    if not valor:
+        return None
+    if "," in valor:
+        valor = valor.replace(".", "").replace(",", ".")
+    try:
+        return float(valor)
+    except ValueError:
+        return None
+
+def leer_csv(ruta):
+    """Devuelve {(nombre, mes): valor} leyendo formato largo o ancho."""
+    with open(ruta, "r", encoding="utf-8-sig", newline="") as f:
+        muestra = f.read(4096)
+        f.seek(0)
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=";,\t")
+        filas = [fila for fila in csv.reader(f, dialecto) if any(c.strip() for c in fila)]
+
+    if not filas:
+        return {}
+    cabecera = filas[0]
+    meses_cabecera = [normalizar_mes(c) for c in cabecera[1:]]
+    datos = {}
+
+    # Ancho si todas las columnas (salvo la primera) de la cabecera son meses
+    if all(m or not c.strip() for m, c in zip(meses_cabecera, cabecera[1:])) and any(meses_cabecera):
+        # Formato ancho
+        for fila in filas[1:]:
+            nombre = fila[0].strip()
+            for mes, celda in zip(meses_cabecera, fila[1:]):
+                valor = parsear_numero(celda)
+                if nombre and mes and valor is not None:
+                    datos[(nombre, mes)] = valor
+    else:
+        # Formato largo (la primera fila es cabecera si su mes no es válido)
+        inicio = 0 if len(cabecera) > 1 and normalizar_mes(cabecera[1]) else 1
+        for fila in filas[inicio:]:
+            if len(fila) < 3:
+                continue
+            nombre, mes, valor = fila[0].strip(), normalizar_mes(fila[1]), parsear_numero(fila[2])
+            if nombre and mes and valor is not None:
+                datos[(nombre, mes)] = valor
+    return datos
+
+def cargar_almacen(ruta=None):
+    ruta = ruta or STORE_PATH
+    if not os.path.exists(ruta):
+        return {"unit": "GWh", "names": [], "months": [], "columns": {}}
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def fusionar(almacen, datos, factor=1.0):
+    """Añade `datos` {(nombre, mes): valor} al almacén columnar (valores en GWh)."""
+    nombres = list(almacen["names"])
+    posicion = {n: i for i, n in enumerate(nombres)}
+    columnas = {m: list(v) for m, v in almacen["columns"].items()}
+
+    for (nombre, mes), valor in datos.items():
+        if nombre not in posicion:
+            posicion[nombre] = len(nombres)
+            nombres.append(nombre)
+        columna = columnas.setdefault(mes, [])
+        if len(columna) < len(nombres):
+            columna.extend([None] * (len(nombres) - len(columna)))
+        columna[posicion[nombre]] = round(valor * factor, 6)
+
+    # Todas las columnas alineadas con la lista de nombres
+    for columna in columnas.values():
+        columna.extend([None] * (len(nombres) - len(columna)))
+
+    meses = sorted(columnas)
+    return {"unit": "GWh", "names": nombres, "months": meses, "columns": {m: columnas[m] for m in meses}}
+
+def guardar_almacen(almacen, ruta=None):
+    ruta = ruta or STORE_PATH
+    tmp = ruta + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(almacen, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, ruta)
+
+def importar(ruta_csv, unidad="gwh"):
+    factor = UNIDADES[unidad.lower()]
+    datos = leer_csv(ruta_csv)
+    if not datos:
+        print("❌ No se encontraron datos válidos en el CSV.")
+        return None
+
+    almacen = fusionar(cargar_almacen(), datos, factor)
+    guardar_almacen(almacen)
+    meses = sorted({m for _, m in datos})
+    print(f"✅ Importados {len(datos)} valores ({len({n for n, _ in datos})} comercializadoras, {meses[0]} a {meses[-1]}).")
+    print(f"   Almacén: {len(almacen['names'])} comercializadoras, {len(almacen['months'])} meses -> {STORE_PATH}")
+    return almacen
+
+def main(ctx=None):
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    unidad = "gwh"
+    if "--unidad" in sys.argv:
+        unidad = sys.argv[sys.argv.index("--unidad") + 1]
+        args = [a for a in args if a != unidad]
+
+    ctx = ctx or common.ExecutionContext.from_env()
+    ruta = args[0] if args else ctx.input_file("file")
+    if not ruta or not isinstance(ruta, str) or not os.path.exists(ruta):
+        print("❌ Indica la ruta del CSV: python scripts/import_competitors_monthly.py datos.csv [--unidad kwh|mwh|gwh]")
+        return
+    if unidad.lower() not in UNIDADES:
+        print(f"❌ Unidad no válida: {unidad} (kwh, mwh o gwh)")
+        return
+
+    importar(ruta, unidad)
+
+if __name__ == "__main__":
+    main()
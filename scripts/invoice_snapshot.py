@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+import threading
+from array import array
+from datetime import date, datetime
+
+# Binary columnar snapshot of the invoices analytics reads, written to
+# INVOICE_SNAPSHOT_PATH after each sync and memory-mapped on cold starts instead
+# of paging the whole `invoices` table from Supabase.
+#
+# Layout (little-endian):
+#   header   magic "ENXINV01", rows, len(ids), len(clients), len(statuses), len(version)
+#   amount   float64[rows]
+#   kwh      float64[rows]
+#   day      int32[rows]    date.toordinal() of issue_date, 0 = no date
+#   client   uint32[rows]   index into the client dictionary, NULL_CODE = None
+#   status   uint32[rows]   index into the status dictionary, NULL_CODE = None
+#   ids, clients, statuses  UTF-8 strings separated by "\0"
+#   version  dataset version the snapshot was written for ("<count>|<latest updated_at>")
+#
+# Usage:
+#   python scripts/invoice_snapshot.py                            -> snapshot of the current dataset version
+#   python scripts/invoice_snapshot.py export.json [destino.bin]  -> convert a legacy export (date, total, consumption...)
+
+MAGIC = b"ENXINV01"
+HEADER = struct.Struct("<8sIIIII")
+NULL_CODE = 0xFFFFFFFF
+INVOICE_SNAPSHOT_PATH = os.getenv("INVOICE_SNAPSHOT_PATH") or os.path.join(tempfile.gettempdir(), "enex_invoices_snapshot.bin")
+
+def _encode(values):
+    """Dictionary-encode values -> (codes, dictionary)."""
+    positions = {}
+    codes = array("I")
+    for value in values:
+        if value is None:
+            codes.append(NULL_CODE)
+            continue
+        value = str(value)
+        code = positions.get(value)
+        if code is None:
+            code = positions[value] = len(positions)
+        codes.append(code)
+    return codes, list(positions)
+
+def _join(strings):
+    return "\0".join(s.replace("\0", "") for s in strings).encode("utf-8")
+
+def _split(blob):
+    return blob.decode("utf-8").split("\0")
+
+def _day(issue_date):
+    try:
+        return date.fromisoformat(str(issue_date)[:10]).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+def write_snapshot(rows, path=INVOICE_SNAPSHOT_PATH, version=""):
+    """Write invoice rows (Supabase column names) to `path` atomically. Returns the row count."""
+    ids = [str(r.get("id") or "") for r in rows]
+    amount = array("d", (float(r.get("amount") or 0) for r in rows))
+    kwh = array("d", (float(r.get("consumption_kwh") or 0) for r in rows))
+    day = array("i", (_day(r.get("issue_date")) for r in rows))
+    client, clients = _encode(r.get("client_name") for r in rows)
+    status, statuses = _encode(r.get("status") for r in rows)
+
+    blobs = [_join(ids), _join(clients), _join(statuses), version.encode("utf-8")]
+    columns = [amount, kwh, day, client, status]
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(rows), *(len(b) for b in blobs)))
+        for column in columns:
+            column.tofile(f)
+        for blob in blobs:
+            f.write(blob)
+    # Unmap our copy first: Windows can't replace a file that is still mapped
+    _release(path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    return len(rows)
+
+class InvoiceSnapshot:
+    """Read-only view over a snapshot file; numeric columns stay in the mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self._state_lock = threading.Lock()
+        self._readers = 0
+        self._closing = False
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        if len(self._mm) < HEADER.size:
+            raise ValueError(f"{path}: snapshot truncado")
+        magic, self.rows, *blob_sizes = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: no es un snapshot de facturas")
+
+        view = self._view = memoryview(self._mm)
+        offset = HEADER.size
+        n = self.rows
+        self.amount, offset = self._column(view, offset, "d", 8 * n)
+        self.kwh, offset = self._column(view, offset, "d", 8 * n)
+        self.day, offset = self._column(view, offset, "i", 4 * n)
+        self.client, offset = self._column(view, offset, "I", 4 * n)
+        self.status, offset = self._column(view, offset, "I", 4 * n)
+
+        blobs = []
+        for size in blob_sizes:
+            blobs.append(bytes(view[offset:offset + size]))
+            offset += size
+        if offset > len(self._mm):
+            raise ValueError(f"{path}: snapshot truncado")
+        self.ids, self.clients, self.statuses = (_split(b) for b in blobs[:3])
+        self.version = blobs[3].decode("utf-8")
+
+    def close(self):
+        """Unmap the file, or as soon as the conversions in progress finish."""
+        with self._state_lock:
+            self._closing = True
+            if self._readers:
+                return
+        self._unmap()
+
+    def _unmap(self):
+        for column in (self.amount, self.kwh, self.day, self.client, self.status):
+            if isinstance(column, memoryview):
+                column.release()
+        self._view.release()
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+
+    @staticmethod
+    def _column(view, offset, typecode, size):
+        column = view[offset:offset + size]
+        if sys.byteorder == "little":
+            column = column.cast(typecode)
+        else:
+            column = array(typecode, column)
+            column.byteswap()
+        return column, offset + size
+
+    def to_legacy(self):
+        """Invoices in the legacy analytics format (same dicts as analytics._fetch_invoices)."""
+        with self._state_lock:
+            if self._closing:
+                raise ValueError(f"{self.path}: snapshot cerrado")
+            self._readers += 1
+        try:
+            return self._to_legacy()
+        finally:
+            with self._state_lock:
+                self._readers -= 1
+                unmap = self._closing and not self._readers
+            if unmap:
+                self._unmap()
+
+    def _to_legacy(self):
+        dates = {0: ""}
+        clients, statuses = self.clients, self.statuses
+        invoices = []
+        for i in range(self.rows):
+            day = self.day[i]
+            date_legacy = dates.get(day)
+            if date_legacy is None:
+                date_legacy = dates[day] = date.fromordinal(day).strftime("%d/%m/%Y")
+            client, status = self.client[i], self.status[i]
+            invoices.append({
+                "id": self.ids[i],
+                "date": date_legacy,
+                "total": self.amount[i],
+                "consumption": self.kwh[i],
+                "status": None if status == NULL_CODE else statuses[status],
+                "client": None if client == NULL_CODE else clients[client],
+            })
+        return invoices
+
+_snapshots = {}  # path -> InvoiceSnapshot
+_lock = threading.Lock()
+
+def _release(path):
+    """Drop and unmap the snapshot loaded from `path`, if any."""
+    with _lock:
+        snapshot = _snapshots.pop(path, None)
+    if snapshot:
+        snapshot.close()
+
+def load_snapshot(path):
+    """Snapshot at `path`, mapped once per process and reloaded when the file changes (None if missing/invalid)."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    snapshot = _snapshots.get(path)
+    if snapshot and snapshot.mtime == mtime:
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshots.get(path)
+        if snapshot and snapshot.mtime == mtime:
+            return snapshot
+        try:
+            snapshot = InvoiceSnapshot(path)
+        except (OSError, ValueError) as e:
+            print(f"Error reading invoice snapshot {path}: {e}")
+            return None
+        previous = _snapshots.get(path)
+        _snapshots[path] = snapshot
+    if previous:
+        previous.close()
+    return snapshot
+
+def find_snapshot(version, path=INVOICE_SNAPSHOT_PATH):
+    """Snapshot from the last sync if it was written for dataset `version` (None otherwise)."""
+    snapshot = load_snapshot(path)
+    if snapshot and snapshot.version == version:
+        return snapshot
+    return None
+
+def from_legacy(invoices):
+    """Legacy dicts (date DD/MM/YYYY, total, consumption...) -> rows with Supabase column names."""
+    rows = []
+    for inv in invoices:
+        issue_date = None
+        try:
+            issue_date = datetime.strptime(inv.get("date") or "", "%d/%m/%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+        rows.append({
+            "id": inv.get("id"),
+            "issue_date": issue_date,
+            "amount": inv.get("total"),
+            "consumption_kwh": inv.get("consumption"),
+            "client_name": inv.get("client"),
+            "status": inv.get("status"),
+        })
+    return rows
+
+def main(ctx=None):
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if not args:
+        import analytics
+
+        total = analytics.materialize_invoice_snapshot()
+        if not total:
+            print("❌ No se pudo leer la versión o las facturas (revisa SUPABASE_URL/KEY o ANALYTICS_BACKEND).")
+            return
+        print(f"✅ {total} facturas -> {INVOICE_SNAPSHOT_PATH} ({os.path.getsize(INVOICE_SNAPSHOT_PATH) / 1024:.0f} KB)")
+        return
+
+    if not os.path.exists(args[0]):
+        print(f"❌ No existe {args[0]}. Uso: python scripts/invoice_snapshot.py [export.json [destino.bin]]")
+        return
+
+    with open(args[0], "r", encoding="utf-8") as f:
+        invoices = json.load(f)
+    destino = args[1] if len(args) > 1 else os.path.splitext(args[0])[0] + ".bin"
+    total = write_snapshot(from_legacy(invoices), destino)
+    print(f"✅ {total} facturas -> {destino} ({os.path.getsize(destino) / 1024:.0f} KB, antes {os.path.getsize(args[0]) / 1024:.0f} KB)")
+
+if __name__ == "__main__":
+    import common
+
+    common.load_config()
+    main()
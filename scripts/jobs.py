@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import socket
+import collections
+import uuid
+import sqlite3
+import tempfile
+import threading
+import contextlib
+import concurrent.futures
+from datetime import datetime
+
+# Same module object as api/index.py's runner, so the warm module cache is shared
+from scripts import runner
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH") or os.path.join(tempfile.gettempdir(), "enex_jobs.sqlite3")
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "4"))
+# Max simultaneous runs of the same script (different parameters)
+JOBS_PER_SCRIPT_LIMIT = int(os.getenv("JOBS_PER_SCRIPT_LIMIT", "1"))
+# Each process renews the lease of the queued/running jobs it owns; jobs whose
+# lease expired belong to a process that died and are recovered by another one
+JOBS_LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS", "60"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    script TEXT NOT NULL,
+    params TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    error TEXT,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key, status);
+CREATE TABLE IF NOT EXISTS job_logs (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+class JobStore:
+    """SQLite persistence for jobs and their output (survives restarts)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            # Databases created before job leases
+            existing = {r["name"] for r in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, sql_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {sql_type}")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock, so the read-then-write steps
+        # below are atomic across every process sharing the file
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def insert_unless_active(self, job):
+        """Insert `job` unless one with its dedup_key is queued or running. Returns (job, coalesced)."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE dedup_key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                (job["dedup_key"], *ACTIVE_STATUSES),
+            ).fetchone()
+            if row is not None:
+                return self._to_dict(row), True
+            conn.execute(
+                "INSERT INTO jobs (id, script, params, dedup_key, status, created_at, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["script"], json.dumps(job["params"]), job["dedup_key"], job["status"], job["created_at"],
+                 job["owner"], job["lease_until"]),
+            )
+        return job, False
+
+    def start(self, job_id, owner):
+        """Mark a queued job owned by `owner` as running. False if another process took it."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued' AND owner = ?",
+                (_now(), job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def renew_leases(self, owner, lease_until):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)",
+                (lease_until, owner, *ACTIVE_STATUSES),
+            )
+
+    def claim_expired(self, owner, lease_until):
+        """Take over the queued/running jobs whose lease expired (their process is gone)."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND (lease_until IS NULL OR lease_until < ?) ORDER BY created_at",
+                (*ACTIVE_STATUSES, time.time()),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ?",
+                [(owner, lease_until, r["id"]) for r in rows],
+            )
+        return [self._to_dict(r) for r in rows]
+
+    def update(self, job_id, **fields):
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def list(self, statuses=None, limit=50):
+        query = "SELECT * FROM jobs"
+        args = []
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            args.extend(statuses)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        return [self._to_dict(r) for r in rows]
+
+    def append_log(self, job_id, seq, line):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO job_logs (job_id, seq, line) VALUES (?, ?, ?)", (job_id, seq, line))
+
+    def read_log(self, job_id, offset=0):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT line FROM job_logs WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, offset)
+            ).fetchall()
+        return [r["line"] for r in rows]
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+class JobManager:
+    """
+    Background execution of dashboard scripts.
+    Identical submissions (same script + params) join the job already queued or
+    running instead of starting a new one, also across processes sharing the DB.
+    """
+
+    def __init__(self, scripts_dir, db_path=JOBS_DB_PATH, max_workers=JOBS_MAX_WORKERS,
+                 per_script_limit=JOBS_PER_SCRIPT_LIMIT):
+        self.scripts_dir = scripts_dir
+        self.store = JobStore(db_path)
+        self.per_script_limit = per_script_limit
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._submit_lock = threading.Lock()
+        # Per-script dispatch: a job only reaches the executor once its script has a
+        # free slot, so queued runs of one script never tie up pool workers waiting
+        self._dispatch_lock = threading.Lock()
+        self._running = {}  # script -> runs handed to the executor
+        self._pending = {}  # script -> deque of job ids waiting for a slot
+        # job_id -> input_files (spooled uploads) until the job picks them up
+        self._inputs = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._recover()
+        threading.Thread(target=self._heartbeat, name="jobs-lease", daemon=True).start()
+
+    def _lease(self):
+        return time.time() + JOBS_LEASE_SECONDS
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOBS_LEASE_SECONDS / 3)
+            try:
+                self.store.renew_leases(self.owner, self._lease())
+                self._recover()
+            except Exception as e:
+                print(f"Error renovando los jobs: {e}")
+
+    def _recover(self):
+        # Only jobs whose owner stopped renewing the lease: runs cut short cannot be
+        # resumed, queued ones are picked up again
+        for job in self.store.claim_expired(self.owner, self._lease()):
+            if job["status"] == "running":
+                self.store.append_log(job["id"], len(self.store.read_log(job["id"])), "\n[INTERRUPTED] Reinicio del servidor durante la ejecución.")
+                self.store.update(job["id"], status="interrupted", finished_at=_now())
+            else:
+                self._dispatch(job["id"], job["script"])
+
+    def _dispatch(self, job_id, script):
+        """Hand the job to the executor if `script` has a free slot, otherwise queue it behind the others."""
+        with self._dispatch_lock:
+            if self._running.get(script, 0) >= self.per_script_limit:
+                self._pending.setdefault(script, collections.deque()).append(job_id)
+                return
+            self._running[script] = self._running.get(script, 0) + 1
+        self._executor.submit(self._run_slot, job_id, script)
+
+    def _run_slot(self, job_id, script):
+        # The slot passes straight to the next pending job of the same script
+        while job_id is not None:
+            try:
+                self._run(job_id)
+            finally:
+                with self._dispatch_lock:
+                    pending = self._pending.get(script)
+                    if pending:
+                        job_id = pending.popleft()
+                    else:
+                        job_id = None
+                        self._running[script] -= 1
+
+    def submit(self, script, params=None, input_files=None):
+        """
+        Queue a run of `script`. Returns (job, coalesced).
+        `input_files` (file-like uploads) stay in memory until the job runs; on a
+        coalesced submission they are not used and the caller keeps ownership.
+        """
+        params = params or {}
+        dedup_key = f"{script}:{json.dumps(params, sort_keys=True)}"
+
+        with self._submit_lock:
+            job, coalesced = self.store.insert_unless_active({
+                "id": uuid.uuid4().hex,
+                "script": script,
+                "params": params,
+                "dedup_key": dedup_key,
+                "status": "queued",
+                "created_at": _now(),
+                "owner": self.owner,
+                "lease_until": self._lease(),
+            })
+            if coalesced:
+                return job, True
+            if input_files:
+                self._inputs[job["id"]] = input_files
+
+        self._dispatch(job["id"], script)
+        return self.store.get(job["id"]), False
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def read_log(self, job_id, offset=0):
+        return self.store.read_log(job_id, offset)
+
+    def list(self, limit=50):
+        return self.store.list(limit=limit)
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        if not job or job["status"] != "queued":
+            return
+
+        if not self.store.start(job_id, self.owner):
+            return
+
+        input_files = self._inputs.pop(job_id, None)
+        if job["params"].get("input_sha256") and not input_files:
+            # Uploads only live in memory: a job re-queued after a restart lost its file
+            self.store.append_log(job_id, 0, "[CRITICAL FAIL] El archivo subido no está disponible tras el reinicio. Vuelve a cargarlo.")
+            self.store.update(job_id, status="failed", finished_at=_now(), error="input file lost")
+            return
+        seq = 0
+        result = {}
+        try:
+            script_path = os.path.join(self.scripts_dir, job["script"])
+            self.store.append_log(job_id, seq, f"Iniciando {job['script']}...\n")
+            seq += 1
+            for line in runner.stream_script(script_path, params=job["params"], input_files=input_files, result=result):
+                self.store.append_log(job_id, seq, line)
+                seq += 1
+            if result.get("ok"):
+                self.store.update(job_id, status="succeeded", finished_at=_now())
+            else:
+                self.store.update(job_id, status="failed", finished_at=_now(), error=result.get("error") or "sin resultado")
+        except Exception as e:
+            self.store.append_log(job_id, seq, f"\n[CRITICAL FAIL] {e}")
+            self.store.update(job_id, status="failed", finished_at=_now(), error=str(e))
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_manager(scripts_dir):
+    """Process-wide JobManager (created on first use)."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(scripts_dir)
+        return _manager
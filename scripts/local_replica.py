@@ -0,0 +1,283 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+import metrics
+
+# Local SQLite replica of the Supabase `invoices` table (without raw_data), used
+# as a read backend by analytics (ANALYTICS_BACKEND=local|auto) so dashboards
+# work offline and in development. Kept up to date by sync_divakia_sales (rows
+# written as they are upserted) or by pulling from Supabase:
+#   python scripts/local_replica.py          -> incremental pull (updated_at), or a full
+#                                               reconcile every LOCAL_REPLICA_RECONCILE_HOURS
+#   python scripts/local_replica.py --full   -> full re-pull, removing rows deleted in Supabase
+# Incremental pulls can't see deletions; the periodic full reconcile drops them.
+
+LOCAL_REPLICA_PATH = os.getenv("LOCAL_REPLICA_PATH") or os.path.join(tempfile.gettempdir(), "enex_invoices.sqlite3")
+LOCAL_REPLICA_RECONCILE_HOURS = float(os.getenv("LOCAL_REPLICA_RECONCILE_HOURS", "24"))
+PULL_PAGE_SIZE = 1000
+
+# Same columns as sync_divakia_sales.procesar_facturas (raw_data excluded)
+COLUMNS = (
+    ("id", "TEXT PRIMARY KEY"),
+    ("issue_date", "TEXT"),
+    ("amount", "REAL"),
+    ("consumption_kwh", "REAL"),
+    ("client_name", "TEXT"),
+    ("nif", "TEXT"),
+    ("address", "TEXT"),
+    ("municipality", "TEXT"),
+    ("province", "TEXT"),
+    ("status", "TEXT"),
+    ("updated_at", "TEXT"),
+    ("cnae", "TEXT"),
+    ("cups", "TEXT"),
+    ("price_type", "TEXT"),
+    ("payment_method", "TEXT"),
+    ("access_tariff", "TEXT"),
+    ("self_consumption_type", "TEXT"),
+    ("distributor", "TEXT"),
+    ("fiscal_address", "TEXT"),
+    ("shipping_address", "TEXT"),
+    ("contract_reference_atr", "TEXT"),
+    ("contract_reference", "TEXT"),
+    ("invoice_reference_atr", "TEXT"),
+    ("contract_end_date", "TEXT"),
+    ("p1_kw", "REAL"),
+    ("p2_kw", "REAL"),
+    ("p3_kw", "REAL"),
+    ("p4_kw", "REAL"),
+    ("p5_kw", "REAL"),
+    ("p6_kw", "REAL"),
+    ("fc_start_date", "TEXT"),
+    ("fc_end_date", "TEXT"),
+    ("fc_days", "INTEGER"),
+    ("fc_invoice_type", "TEXT"),
+    ("fc_energy_cost", "REAL"),
+    ("fc_power_cost", "REAL"),
+    ("fc_rental_cost", "REAL"),
+    ("fc_tax_electricity", "REAL"),
+    ("fc_iva_cost", "REAL"),
+    ("fc_total_energy", "REAL"),
+    ("fc_total_power", "REAL"),
+    ("fc_excess_power", "REAL"),
+    ("fc_excess_reactive", "REAL"),
+    ("fc_surplus_energy", "REAL"),
+    ("fc_surplus_compens", "REAL"),
+    ("fc_virtual_battery", "REAL"),
+    ("fc_social_bonus", "REAL"),
+    ("fc_other_services", "REAL"),
+    ("fc_invoice_total", "REAL"),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS invoices (
+    {", ".join(f"{name} {sql_type}" for name, sql_type in COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_issue_date ON invoices (issue_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_cups ON invoices (cups);
+CREATE INDEX IF NOT EXISTS idx_invoices_nif ON invoices (nif);
+CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices (status);
+CREATE INDEX IF NOT EXISTS idx_invoices_updated_at ON invoices (updated_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_province ON invoices (province);
+CREATE INDEX IF NOT EXISTS idx_invoices_distributor ON invoices (distributor);
+CREATE INDEX IF NOT EXISTS idx_invoices_access_tariff ON invoices (access_tariff);
+CREATE TABLE IF NOT EXISTS replica_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class LocalReplica:
+    """SQLite copy of `invoices` with the same column names as Supabase."""
+
+    def __init__(self, path=LOCAL_REPLICA_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def upsert(self, rows):
+        """Insert or replace invoice rows (dicts with Supabase column names)."""
+        placeholders = ", ".join("?" for _ in COLUMN_NAMES)
+        values = [tuple(row.get(name) for name in COLUMN_NAMES) for row in rows if row.get("id")]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO invoices ({', '.join(COLUMN_NAMES)}) VALUES ({placeholders})", values
+            )
+        return len(values)
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+
+    def select(self, columns=("*",)):
+        return self.query(f"SELECT {', '.join(columns)} FROM invoices")
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def version(self):
+        """(row count, latest updated_at), as get_dataset_version reads it from Supabase."""
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), MAX(updated_at) FROM invoices").fetchone()
+        return row[0], row[1] or ""
+
+    def get_state(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM replica_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO replica_state (key, value) VALUES (?, ?)", (key, value))
+
+    def pull(self, supabase, full=False):
+        """
+        Copy rows from Supabase changed since the last pull (updated_at), or all
+        of them with full=True, which also deletes local rows no longer in
+        Supabase. Returns the number of rows written.
+        """
+        if full:
+            return self._pull_full(supabase)
+
+        since = self.get_state("last_pulled_updated_at")
+        columns = ",".join(COLUMN_NAMES)
+        written = 0
+        latest = since or ""
+        offset = 0
+        while True:
+            query = supabase.table("invoices").select(columns).order("updated_at").order("id")
+            if since:
+                query = query.gt("updated_at", since)
+            with metrics.upstream("supabase_read"):
+                batch = query.range(offset, offset + PULL_PAGE_SIZE - 1).execute().data
+            if batch:
+                written += self.upsert(batch)
+                latest = max(latest, max(r.get("updated_at") or "" for r in batch))
+            if not batch or len(batch) < PULL_PAGE_SIZE:
+                break
+            offset += PULL_PAGE_SIZE
+
+        if latest:
+            self.set_state("last_pulled_updated_at", latest)
+        return written
+
+    def _pull_full(self, supabase):
+        # Paged by id (keyset) so rows updated or inserted meanwhile don't shift
+        # the pages and make a live row look deleted
+        columns = ",".join(COLUMN_NAMES)
+        # Rows written meanwhile by incremental pulls or the sync are newer than this mark
+        mark = self.get_state("last_pulled_updated_at")
+        seen = set()
+        written = 0
+        latest = ""
+        last_id = None
+        while True:
+            query = supabase.table("invoices").select(columns).order("id")
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            with metrics.upstream("supabase_read"):
+                batch = query.limit(PULL_PAGE_SIZE).execute().data
+            if batch:
+                written += self.upsert(batch)
+                seen.update(r["id"] for r in batch)
+                latest = max(latest, max(r.get("updated_at") or "" for r in batch))
+                last_id = batch[-1]["id"]
+            if not batch or len(batch) < PULL_PAGE_SIZE:
+                break
+
+        # Unseen rows are deleted in Supabase, unless they were written after the pull started
+        mark = mark or latest
+        stale = [(r["id"],) for r in self.query("SELECT id, updated_at FROM invoices")
+                 if r["id"] not in seen and (r["updated_at"] or "") <= mark]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM invoices WHERE id = ?", stale)
+        if stale:
+            print(f"Réplica local: {len(stale)} facturas ya no están en Supabase, eliminadas.")
+
+        if latest:
+            self.set_state("last_pulled_updated_at", max(latest, self.get_state("last_pulled_updated_at") or ""))
+        self.set_state("last_full_pull", datetime.now(timezone.utc).isoformat())
+        return written
+
+    def reconcile_due(self):
+        """True if the replica was never fully pulled or the last full pull is older than LOCAL_REPLICA_RECONCILE_HOURS."""
+        last = self.get_state("last_full_pull")
+        if not last:
+            return True
+        return datetime.now(timezone.utc) - datetime.fromisoformat(last) > timedelta(hours=LOCAL_REPLICA_RECONCILE_HOURS)
+
+    def refresh(self, supabase):
+        """Incremental pull, or a full reconcile when one is due. Returns (rows written, full)."""
+        full = self.reconcile_due()
+        return self.pull(supabase, full=full), full
+
+_replica = None
+_replica_lock = threading.Lock()
+
+def get_replica():
+    """Process-wide replica (created on first use)."""
+    global _replica
+    with _replica_lock:
+        if _replica is None:
+            _replica = LocalReplica()
+        return _replica
+
+_background_pull = {"thread": None}
+_background_lock = threading.Lock()
+
+def pull_in_background(full=False):
+    """
+    Pull from Supabase in a daemon thread, so requests don't wait for a cold load
+    or a reconcile. Returns False if a background pull is already running.
+    """
+    with _background_lock:
+        thread = _background_pull["thread"]
+        if thread is not None and thread.is_alive():
+            return False
+
+        def run():
+            try:
+                supabase = common.get_supabase_client()
+                if supabase:
+                    get_replica().pull(supabase, full=full)
+            except Exception as e:
+                print(f"Error actualizando la réplica local en segundo plano: {e}")
+
+        thread = threading.Thread(target=run, name="local-replica-pull", daemon=True)
+        _background_pull["thread"] = thread
+        thread.start()
+        return True
+
+def main(ctx=None):
+    replica = get_replica()
+    full = ("--full" in sys.argv or str((ctx.params if ctx else {}).get("full", "")).lower() in ("1", "true")
+            or replica.reconcile_due())
+    print(f"Actualizando réplica local de facturas ({'completa' if full else 'incremental'})...")
+
+    supabase = common.get_supabase_client()
+    if not supabase:
+        print("❌ Error de configuración Supabase (SUPABASE_URL/KEY faltantes).")
+        return
+
+    with common.trace_run("local_replica"):
+        with common.span("pull", full=full) as sp:
+            written = replica.pull(supabase, full=full)
+            sp.set(rows=written)
+
+    print(f"✅ {written} facturas copiadas. Réplica: {replica.count()} facturas en {replica.path}")
+
+if __name__ == "__main__":
+    common.load_config()
+    main()
@@ -0,0 +1,287 @@
+import os
+import sys
+import bisect
+import threading
+from itertools import accumulate
+from datetime import date, datetime, timedelta, timezone
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+import metrics
+import analytics
+from cache import TTLCache
+
+# Gross margin over ATR: client invoices (sales, `invoices` table) matched with
+# the distributor's ATR invoices (purchases, from Orka) by CUPS and overlapping
+# billing period. Each purchase is split between the sales it overlaps in
+# proportion to the days shared, so a sale's ATR cost is the sum of those shares.
+#   ventas       sale amount without IVA or impuesto eléctrico
+#   compras_atr  ATR cost without IVA (tolls and charges; OMIE energy is not included)
+#   margen       ventas - compras_atr
+# Results are grouped per invoice, CUPS, client and month (/api/margins?by=...).
+# Purchases are taken from the Orka invoices the sales sync already downloaded
+# (materialize_purchases) and stored in `atr_purchases`; requests read that table.
+# divakia_atr is imported where used: at import time it reloads .env and logging.
+
+MARGIN_HISTORY_DAYS = int(os.getenv("MARGIN_HISTORY_DAYS", "730"))
+MARGIN_CACHE_TTL = int(os.getenv("MARGIN_CACHE_TTL", "3600"))
+ATR_PURCHASES_TABLE = "atr_purchases"
+PURCHASE_COLUMNS = ("id", "cups", "fecha_desde", "fecha_hasta", "tipo", "importe")
+PAGE_SIZE = 1000
+
+SALE_COLUMNS = (
+    "id", "cups", "client_name", "nif", "issue_date", "fc_start_date", "fc_end_date",
+    "amount", "fc_iva_cost", "fc_tax_electricity", "consumption_kwh",
+)
+GROUPS = ("month", "client", "cups", "invoice")
+
+margin_cache = TTLCache("margins", maxsize=4, ttl=MARGIN_CACHE_TTL)
+_compute_lock = threading.Lock()
+
+def _ordinal(value):
+    try:
+        return date.fromisoformat(str(value)[:10]).toordinal()
+    except (TypeError, ValueError):
+        return None
+
+class PurchaseIndex:
+    """
+    ATR purchases per CUPS sorted by period start, with the running maximum of
+    period ends, so the purchases overlapping [start, end] are found by bisecting
+    the starts and walking back only while an earlier period can still reach `start`.
+    """
+
+    def __init__(self, purchases):
+        by_cups = {}
+        for p in purchases:
+            if p["cups"] and p["start"] is not None and p["end"] is not None and p["end"] >= p["start"]:
+                by_cups.setdefault(p["cups"], []).append(p)
+
+        self._index = {}
+        for cups, items in by_cups.items():
+            items.sort(key=lambda p: p["start"])
+            starts = [p["start"] for p in items]
+            max_end = list(accumulate((p["end"] for p in items), max))
+            self._index[cups] = (starts, max_end, items)
+
+    def overlapping(self, cups, start, end):
+        entry = self._index.get(cups)
+        if not entry:
+            return []
+        starts, max_end, items = entry
+        i = bisect.bisect_right(starts, end)
+        found = []
+        while i > 0 and max_end[i - 1] >= start:
+            i -= 1
+            if items[i]["end"] >= start:
+                found.append(items[i])
+        return found
+
+def _purchase(compra):
+    return {
+        "id": compra["id"],
+        "cups": compra.get("cups"),
+        "start": _ordinal(compra.get("fecha_desde")),
+        "end": _ordinal(compra.get("fecha_hasta")),
+        "importe": float(compra.get("importe") or 0),
+        "asignado": 0.0,
+    }
+
+def _net_sale(row):
+    """Sale amount without IVA or impuesto eléctrico (amount / 1.21 if the breakdown is missing)."""
+    amount = float(row.get("amount") or 0)
+    iva = float(row.get("fc_iva_cost") or 0)
+    if not iva:
+        return amount / 1.21
+    return amount - iva - float(row.get("fc_tax_electricity") or 0)
+
+def _summary(ventas, compras, **extra):
+    margen = ventas - compras
+    return dict(extra,
+                ventas=round(ventas, 2),
+                compras_atr=round(compras, 2),
+                margen=round(margen, 2),
+                margen_pct=round(margen / ventas * 100, 2) if ventas else None)
+
+def compute_margins(sales, compras):
+    """
+    Match sales rows (SALE_COLUMNS) with ATR purchases (divakia_atr.procesar_compras)
+    in one pass. Returns per-invoice rows, the month/client/CUPS groupings and totals.
+    """
+    # Latest record wins for duplicated ATR invoices
+    purchases = list({c["id"]: _purchase(c) for c in compras}.values())
+    index = PurchaseIndex(purchases)
+
+    invoices = []
+    groups = {"month": {}, "client": {}, "cups": {}}
+    sin_atr = {"facturas": 0, "ventas": 0.0}
+
+    for row in sales:
+        ventas = _net_sale(row)
+        start, end = _ordinal(row.get("fc_start_date")), _ordinal(row.get("fc_end_date"))
+        compras_atr = 0.0
+        matched = []
+        if row.get("cups") and start is not None and end is not None:
+            for p in index.overlapping(row["cups"], start, end):
+                share = (min(end, p["end"]) - max(start, p["start"]) + 1) / (p["end"] - p["start"] + 1)
+                cost = p["importe"] * share
+                p["asignado"] += cost
+                compras_atr += cost
+                matched.append(p["id"])
+
+        if not matched:
+            sin_atr["facturas"] += 1
+            sin_atr["ventas"] += ventas
+
+        month = (row.get("issue_date") or "")[:7]
+        client_key = row.get("nif") or row.get("client_name") or ""
+        invoices.append({
+            "id": row.get("id"),
+            "cups": row.get("cups"),
+            "client": row.get("client_name"),
+            "nif": row.get("nif"),
+            "month": month,
+            "ventas": ventas,
+            "compras_atr": compras_atr,
+            "atr": sorted(matched),
+        })
+        for name, key in (("month", month), ("client", client_key), ("cups", row.get("cups") or "")):
+            group = groups[name].get(key)
+            if group is None:
+                group = groups[name][key] = {"facturas": 0, "ventas": 0.0, "compras_atr": 0.0, "client": row.get("client_name")}
+            group["facturas"] += 1
+            group["ventas"] += ventas
+            group["compras_atr"] += compras_atr
+
+    total_ventas = sum(i["ventas"] for i in invoices)
+    total_compras = sum(i["compras_atr"] for i in invoices)
+    atr_sin_venta = [p for p in purchases if p["importe"] and abs(p["importe"] - p["asignado"]) >= 0.01]
+
+    result = {
+        "invoice": [
+            _summary(i["ventas"], i["compras_atr"], id=i["id"], cups=i["cups"], client=i["client"],
+                     nif=i["nif"], month=i["month"], atr=i["atr"])
+            for i in invoices
+        ],
+        "month": [
+            _summary(g["ventas"], g["compras_atr"], month=k, facturas=g["facturas"])
+            for k, g in sorted(groups["month"].items())
+        ],
+        "client": [
+            _summary(g["ventas"], g["compras_atr"], nif=k, client=g["client"], facturas=g["facturas"])
+            for k, g in sorted(groups["client"].items(), key=lambda kv: kv[1]["ventas"] - kv[1]["compras_atr"], reverse=True)
+        ],
+        "cups": [
+            _summary(g["ventas"], g["compras_atr"], cups=k, client=g["client"], facturas=g["facturas"])
+            for k, g in sorted(groups["cups"].items(), key=lambda kv: kv[1]["ventas"] - kv[1]["compras_atr"], reverse=True)
+        ],
+        "totals": _summary(total_ventas, total_compras, facturas=len(invoices), facturas_atr=len(purchases)),
+        "sin_atr": {"facturas": sin_atr["facturas"], "ventas": round(sin_atr["ventas"], 2)},
+        "atr_sin_venta": {
+            "facturas": len(atr_sin_venta),
+            "importe": round(sum(p["importe"] - p["asignado"] for p in atr_sin_venta), 2),
+        },
+    }
+    return result
+
+def load_purchases(token=None):
+    """ATR purchases from Orka over the last MARGIN_HISTORY_DAYS (same window as the sales sync)."""
+    import divakia_atr
+
+    token = token or common.get_orka_token()
+    if not token:
+        raise RuntimeError("No se pudo obtener token de Orka")
+    hoy = datetime.today()
+    facturas = common.fetch_orka_invoices(
+        token,
+        (hoy - timedelta(days=MARGIN_HISTORY_DAYS)).strftime("%d/%m/%Y"),
+        (hoy + timedelta(days=1)).strftime("%d/%m/%Y"))
+    return divakia_atr.procesar_compras(facturas)
+
+def materialize_purchases(facturas=None, token=None):
+    """
+    Store the ATR purchases in `atr_purchases` (run after each sync). `facturas` are
+    the Orka invoices the sync already fetched; without them they are downloaded.
+    Returns the count.
+    """
+    import divakia_atr
+
+    supabase = common.get_supabase_client()
+    if not supabase:
+        raise RuntimeError("Supabase no configurado")
+    compras = divakia_atr.procesar_compras(facturas) if facturas is not None else load_purchases(token)
+    # Latest record wins for duplicated ATR invoices (one upsert can't repeat a key)
+    compras = list({c["id"]: c for c in compras}.values())
+    synced_at = datetime.now(timezone.utc).isoformat()
+    rows = [dict({k: c.get(k) for k in PURCHASE_COLUMNS}, synced_at=synced_at) for c in compras]
+    for i in range(0, len(rows), PAGE_SIZE):
+        with metrics.upstream("supabase_upsert"):
+            supabase.table(ATR_PURCHASES_TABLE).upsert(rows[i:i + PAGE_SIZE]).execute()
+    return len(rows)
+
+def read_purchases():
+    """ATR purchases stored by materialize_purchases."""
+    supabase = common.get_supabase_client()
+    if not supabase:
+        raise RuntimeError("Supabase no configurado")
+    compras = []
+    offset = 0
+    while True:
+        with metrics.upstream("supabase_read"):
+            batch = (
+                supabase.table(ATR_PURCHASES_TABLE).select(",".join(PURCHASE_COLUMNS))
+                .order("id").range(offset, offset + PAGE_SIZE - 1).execute().data
+            )
+        compras.extend(batch or [])
+        if not batch or len(batch) < PAGE_SIZE:
+            return compras
+        offset += PAGE_SIZE
+
+def get_purchases_version():
+    """'<count>|<latest synced_at>' of `atr_purchases` for ETag validation, or None."""
+    supabase = common.get_supabase_client()
+    if not supabase:
+        return None
+    try:
+        with metrics.upstream("supabase_read"):
+            response = (
+                supabase.table(ATR_PURCHASES_TABLE).select("synced_at", count="exact")
+                .order("synced_at", desc=True).limit(1).execute()
+            )
+    except Exception as e:
+        print(f"Error reading {ATR_PURCHASES_TABLE} version: {e}")
+        return None
+    latest = response.data[0]["synced_at"] if response.data else ""
+    return f"{response.count or 0}|{latest}"
+
+def get_margins(version, by="month"):
+    """
+    Margin rows grouped `by` (month, client, cups or invoice) plus totals, computed
+    once per `version` (dataset version + get_purchases_version).
+    """
+    result = margin_cache.get(version) if version is not None else None
+    if result is None:
+        with _compute_lock:
+            result = margin_cache.get(version) if version is not None else None
+            if result is None:
+                try:
+                    compras = read_purchases()
+                    if not compras:
+                        # Not materialised yet (no sync since deploy): read them from Orka once
+                        print(f"{ATR_PURCHASES_TABLE} vacía, se leen las compras ATR de Orka.")
+                        compras = load_purchases()
+                    sales = analytics.fetch_invoice_rows(SALE_COLUMNS)
+                    result = compute_margins(sales, compras)
+                except Exception as e:
+                    return {"error": str(e)}
+                if version is not None:
+                    margin_cache.set(version, result)
+
+    return {
+        "by": by,
+        "rows": result[by],
+        "totals": result["totals"],
+        "sin_atr": result["sin_atr"],
+        "atr_sin_venta": result["atr_sin_venta"],
+    }
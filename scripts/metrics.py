@@ -0,0 +1,134 @@
+import time
+import bisect
+import threading
+import contextlib
+
+# In-process latency histograms and counters, exported at /api/metrics.
+# Recording is a lock + bisect per observation, cheap enough to stay on in production.
+# Import this module as top-level `metrics` (scripts dir on sys.path) so that the
+# API and the scripts share one registry.
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "enex_route_seconds": "Flask route latency (time until the response is returned).",
+    "enex_upstream_seconds": "Latency of calls to Orka, Holded and Supabase.",
+    "enex_upstream_errors_total": "Upstream calls that raised an exception.",
+    "enex_cache_requests_total": "Cache lookups by cache and result (hit/miss).",
+    "enex_singleflight_shared_total": "Calls served by joining an identical in-flight upstream call.",
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+_counters = {}    # (name, labels) -> value
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def observe(name, seconds, **labels):
+    """Record one latency observation (in seconds)."""
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        state = _histograms.get(key)
+        if state is None:
+            state = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        state[0][index] += 1
+        state[1] += seconds
+        state[2] += 1
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Time a block into histogram `name`; exceptions also bump the matching *_errors_total counter."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(name.replace("_seconds", "_errors_total"), **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def upstream(call):
+    """Shortcut for timing an upstream call type (orka_login, supabase_read, ...)."""
+    return timer("enex_upstream_seconds", call=call)
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def _copy():
+    with _lock:
+        histograms = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    return histograms, counters
+
+def snapshot():
+    """JSON-friendly view: per series count, sum, mean and approximate p50/p95/p99."""
+    histograms, counters = _copy()
+    result = {"histograms": [], "counters": []}
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        entry = {"name": name, "labels": dict(labels), "count": count, "sum": round(total, 6),
+                 "mean": round(total / count, 6) if count else 0}
+        for q in (0.5, 0.95, 0.99):
+            entry[f"p{int(q * 100)}"] = _quantile(buckets, count, q)
+        result["histograms"].append(entry)
+
+    for (name, labels), value in sorted(counters.items()):
+        result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+    return result
+
+def _quantile(buckets, count, q):
+    """Upper bound of the bucket holding the q-quantile (None if beyond the last bucket)."""
+    if not count:
+        return 0
+    target = q * count
+    running = 0
+    for bound, n in zip(BUCKETS, buckets):
+        running += n
+        if running >= target:
+            return bound
+    return None
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def render_prometheus():
+    """Prometheus text exposition format (version 0.0.4)."""
+    histograms, counters = _copy()
+    lines = []
+    seen = set()
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        running = 0
+        for bound, n in zip(BUCKETS, buckets):
+            running += n
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(bound))])} {running}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -5,17 +5,19 @@ import requests
 import os
 import re
 import sys
-import openpyxl
+from datetime import datetime
 
 # Ensure we can import common
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import common
+import metrics
 
 # Cargar variables de entorno
 common.load_config()
 
 # ==== CONFIGURACIÓN ====
-HOLD_API_URL = "https://api.holded.com/api/invoicing/v1/documents/purchase?contactid=665574e36c21a403930ada24"
+HOLD_CONTACT_ID = "665574e36c21a403930ada24"  # OMI POLO ESPAÑOL
+HOLD_API_URL = f"https://api.holded.com/api/invoicing/v1/documents/purchase?contactid={HOLD_CONTACT_ID}"
 HOLD_API_KEY = os.getenv("HOLDED_API_KEY") 
 GENERAR_FILTRANDO_HOLDED = True  # pon False si no quieres filtrar duplicados
 CARPETA_DESCARGAS = common.get_downloads_dir()
@@ -83,6 +85,7 @@ def encontrar_zip_mas_reciente():
     return os.path.join(CARPETA_DESCARGAS, archivos[0])
 
 def procesar_zip(ruta_zip):
+    """`ruta_zip` puede ser una ruta o un objeto de fichero (subida en memoria)."""
     with zipfile.ZipFile(ruta_zip, 'r') as zip_ref:
         json_filename = next((name for name in zip_ref.namelist() if name.endswith('.json')), None)
         if not json_filename:
@@ -157,10 +160,12 @@ def procesar_zip(ruta_zip):
     return facturas_data
 
 def guardar_en_excel(datos, archivo_salida):
-    """Guarda los datos en un archivo XLSX usando openpyxl."""
+    """Guarda los datos en un archivo XLSX usando openpyxl. Devuelve True si se escribió."""
+    import openpyxl
+
     if not datos:
         print("Lista de datos vacía, no se generará archivo XLSX.")
-        return
+        return False
 
     try:
         output_dir = os.path.dirname(archivo_salida)
@@ -182,14 +187,17 @@ def guardar_en_excel(datos, archivo_salida):
             
         wb.save(archivo_salida)
         print(f"Archivo XLSX guardado exitosamente en: {archivo_salida}")
+        return True
 
     except Exception as e:
         print(f"Error al guardar el archivo XLSX: {e}")
+        return False
 
 def obtener_facturas_holded():
     headers = {"accept": "application/json", "key": HOLD_API_KEY}
     try:
-        response = requests.get(HOLD_API_URL, headers=headers, timeout=20)
+        with metrics.upstream("holded_documents"):
+            response = requests.get(HOLD_API_URL, headers=headers, timeout=20)
         if response.status_code == 200:
             holded_data = response.json()
             if isinstance(holded_data, list):
@@ -202,43 +210,102 @@ def obtener_facturas_holded():
         print(f"Excepción obteniendo facturas Holded: {e}")
         return set()
 
+def fecha_mas_antigua(ruta_zip):
+    """Fecha de emisión más antigua de las compras del ZIP (None si no hay fechas válidas)."""
+    fechas = []
+    for f in procesar_zip(ruta_zip):
+        try:
+            fechas.append(datetime.strptime(f["Fecha dd/mm/yyyy"], "%d/%m/%Y"))
+        except (TypeError, ValueError):
+            continue
+    if hasattr(ruta_zip, "seek"):
+        ruta_zip.seek(0)
+    return min(fechas) if fechas else None
+
+def numeros_de_contacto(documentos):
+    """Números de las compras de OMIE dentro de una descarga de Holded de todas las compras."""
+    return {d.get("docNumber") for d in documentos if d.get("contact") == HOLD_CONTACT_ID and d.get("docNumber")}
+
 # ==== PROGRAMA PRINCIPAL ====
-def main():
-    try:
-        # Check if file was provided via upload (env var)
-        uploaded_file = os.getenv('INPUT_FILE_PATH')
-        
-        if uploaded_file and os.path.exists(uploaded_file):
-            ruta_zip = uploaded_file
-            print(f"📥 Usando archivo subido: {ruta_zip}")
-        else:
-            try:
-                ruta_zip = encontrar_zip_mas_reciente()
-            except FileNotFoundError:
-                 print("❌ No se encontró archivo ZIP. Asegúrate de cargarlo.")
-                 return
+def localizar_zip(ctx=None):
+    """
+    Devuelve el ZIP subido en el contexto de ejecución (ruta u objeto de fichero
+    ya en memoria) o el más reciente en descargas.
+    """
+    ctx = ctx or common.ExecutionContext.from_env()
+    uploaded_file = ctx.input_file("file")
+
+    if hasattr(uploaded_file, "read"):
+        print(f"📥 Usando archivo subido: {ctx.params.get('input_filename', 'ZIP')}")
+        uploaded_file.seek(0)
+        return uploaded_file
+    if uploaded_file and os.path.exists(uploaded_file):
+        print(f"📥 Usando archivo subido: {uploaded_file}")
+        return uploaded_file
+    return encontrar_zip_mas_reciente()
 
+def ejecutar(ruta_zip=None, obtener_holded=None, output_filename=None):
+    """
+    Procesa el ZIP de OMIE, filtra las compras ya existentes en Holded y genera el XLSX.
+    `obtener_holded` es un callable que devuelve el set de números ya existentes.
+    Retorna un dict con 'archivo' (None si no se generó) y 'facturas'.
+    """
+    resultado = {"archivo": None, "facturas": 0}
 
+    if not ruta_zip:
+        ruta_zip = localizar_zip()
+
+    if isinstance(ruta_zip, str):
         print(f"📂 Procesando archivo: {ruta_zip}")
 
+    with common.span("transform", source="omie_zip") as sp:
         facturas = procesar_zip(ruta_zip)
+        sp.set(rows=len(facturas))
+
+    if obtener_holded is None and GENERAR_FILTRANDO_HOLDED and HOLD_API_KEY:
+        obtener_holded = obtener_facturas_holded
 
-        if GENERAR_FILTRANDO_HOLDED and HOLD_API_KEY:
-            facturas_holded = obtener_facturas_holded()
+    if obtener_holded:
+        with common.span("fetch", source="holded") as sp:
+            facturas_holded = obtener_holded()
+            sp.set(rows=len(facturas_holded))
+        with common.span("filter") as sp:
             inicial_count = len(facturas)
             facturas = [f for f in facturas if f["Num factura"] not in facturas_holded]
-            print(f"🔍 Facturas nuevas tras filtrar: {len(facturas)} (de {inicial_count})")
-        elif not HOLD_API_KEY:
-            print("⚠️ HOLDED_API_KEY no configurado. No se filtrarán duplicados.")
+            sp.set(rows=len(facturas))
+        print(f"🔍 Facturas nuevas tras filtrar: {len(facturas)} (de {inicial_count})")
+    elif not HOLD_API_KEY:
+        print("⚠️ HOLDED_API_KEY no configurado. No se filtrarán duplicados.")
 
-        if facturas:
-            output_filename = os.path.join(CARPETA_DESCARGAS, "compras_omie.xlsx")
-            
-            guardar_en_excel(facturas, output_filename)
-                
-            common.trigger_download_via_stdout(output_filename)
-        else:
-            print("ℹ️ No hay facturas nuevas para procesar.")
+    if not facturas:
+        print("ℹ️ No hay facturas nuevas para procesar.")
+        return resultado
+
+    if not output_filename:
+        output_filename = os.path.join(CARPETA_DESCARGAS, "compras_omie.xlsx")
+    
+    with common.span("write", format="xlsx", rows=len(facturas)):
+        escrito = guardar_en_excel(facturas, output_filename)
+
+    # Sin escritura, un fichero previo con el mismo nombre no es el de esta ejecución
+    if escrito:
+        resultado["facturas"] = len(facturas)
+        resultado["archivo"] = output_filename
+    return resultado
+
+def main(ctx=None):
+    try:
+        try:
+            ruta_zip = localizar_zip(ctx)
+        except FileNotFoundError:
+             print("❌ No se encontró archivo ZIP. Asegúrate de cargarlo.")
+             return
+
+        with common.trace_run("omie_holded"):
+            resultado = ejecutar(ruta_zip)
+
+        if resultado["archivo"]:
+            common.trigger_download_via_stdout(resultado["archivo"])
             
     except FileNotFoundError as e:
         print(f"❌ Error archivo no encontrado: {e}")
@@ -248,4 +315,3 @@ def main():
 # ==== PROGRAMA PRINCIPAL ====
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,159 @@
+import io
+import os
+import sys
+import queue
+import inspect
+import threading
+import importlib.util
+import traceback
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+
+# Lines buffered between the script thread and the HTTP response.
+# When full, the script blocks on print() until the client catches up.
+MAX_PENDING_LINES = 1000
+
+_EOF = object()
+
+class QueueWriter(io.TextIOBase):
+    """
+    File-like object that splits written text into lines and pushes each
+    complete line to a bounded queue as soon as it is printed.
+    """
+
+    def __init__(self, line_queue, cancelled):
+        self._queue = line_queue
+        self._cancelled = cancelled
+        self._partial = ""
+        # Scripts may print from their own worker threads: splitting the buffer
+        # and queueing its lines must happen as one step so lines keep their order
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self._lock:
+            self._partial += text
+            if "\n" in self._partial:
+                *lines, self._partial = self._partial.split("\n")
+                for line in lines:
+                    self._put(line + "\n")
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._partial:
+                self._put(self._partial)
+                self._partial = ""
+
+    def _put(self, item):
+        # Drop output once the reader has gone away instead of blocking forever
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+# Warm modules: script_path -> (mtime, module). Each script is imported once
+# per process and only re-executed when its file changes on disk.
+_module_cache = {}
+_module_cache_lock = threading.Lock()
+
+def load_script(script_path):
+    """Return the loaded module for `script_path`, reloading it only if its mtime changed."""
+    mtime = os.path.getmtime(script_path)
+    with _module_cache_lock:
+        cached = _module_cache.get(script_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        module_name = "enex_script_" + os.path.splitext(os.path.basename(script_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _module_cache[script_path] = (mtime, module)
+        return module
+
+def _execute(script_path, ctx):
+    # Output is routed per thread through ctx.output instead of redirecting
+    # the process-wide sys.stdout, so concurrent runs don't mix their logs.
+    common.install_output_router()
+    with ctx.activate():
+        try:
+            module = load_script(script_path)
+            if hasattr(module, 'main'):
+                if inspect.signature(module.main).parameters:
+                    module.main(ctx)
+                else:
+                    module.main()
+            else:
+                print("⚠️ Script execution: main() function not found.")
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                print(f"Error executing script: exit code {e.code}")
+                raise RuntimeError(f"exit code {e.code}")
+        except Exception as e:
+            print(f"Error executing script: {e}")
+            traceback.print_exc()
+            raise
+        finally:
+            ctx.output.flush()
+
+def stream_script(script_path, params=None, input_files=None, result=None):
+    """
+    Run a script's main() in a worker thread and yield its output line by line
+    while it runs. The final item is "\\n[EXITO] Proceso finalizado." or a
+    "[CRITICAL FAIL]" message if main() raised (or called sys.exit with an error code).
+    If `result` is a dict it receives "ok" (bool) and "error" (message or None).
+    `params` and `input_files` are handed to main(ctx) through a per-run
+    common.ExecutionContext; a params["input_file"] path becomes input_files["file"].
+    File-like inputs belong to the run and are closed when it ends.
+    """
+    params = dict(params or {})
+    input_files = dict(input_files or {})
+    if params.get("input_file"):
+        input_files.setdefault("file", params.pop("input_file"))
+
+    scripts_dir = os.path.dirname(script_path)
+    if scripts_dir not in sys.path:
+        sys.path.insert(0, scripts_dir)
+
+    line_queue = queue.Queue(maxsize=MAX_PENDING_LINES)
+    cancelled = threading.Event()
+    writer = QueueWriter(line_queue, cancelled)
+    ctx = common.ExecutionContext(params=params, input_files=input_files, output=writer)
+    failure = []
+
+    def target():
+        try:
+            _execute(script_path, ctx)
+        except Exception as e:
+            failure.append(e)
+        finally:
+            ctx.close_inputs()
+            writer._put(_EOF)
+
+    worker = threading.Thread(target=target, name=f"run-{os.path.basename(script_path)}", daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            item = line_queue.get()
+            if item is _EOF:
+                break
+            yield item
+    finally:
+        # Client disconnected or stream finished: unblock the worker
+        cancelled.set()
+
+    if result is not None:
+        result["ok"] = not failure
+        result["error"] = str(failure[0]) if failure else None
+    if failure:
+        yield f"\n[CRITICAL FAIL] {str(failure[0])}"
+    else:
+        yield "\n[EXITO] Proceso finalizado."
@@ -0,0 +1,110 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Ensure we can import common
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import common
+import metrics
+# Top-level like api/index.py, so the prefetch shares the API's module copy:
+# one Orka rate limiter, token lock and SIPS cache for both
+import sips_service
+
+# Load config
+common.load_config()
+
+# Enriquecimiento SIPS de toda la cartera: CUPS distintos de `invoices` ->
+# consulta Orka en paralelo -> resumen en la tabla `sips_snapshots`.
+# Solo se vuelven a consultar los CUPS sin snapshot correcto o con más de
+# SIPS_SNAPSHOT_MAX_AGE_DAYS días (params["forzar"] refresca todos).
+SNAPSHOT_TABLE = sips_service.SNAPSHOT_TABLE
+SNAPSHOT_MAX_AGE_DAYS = int(os.getenv("SIPS_SNAPSHOT_MAX_AGE_DAYS", "30"))
+BATCH_SIZE = 200
+PAGE_SIZE = 1000
+
+def _leer_paginado(supabase, tabla, columnas, filtro=None):
+    filas = []
+    offset = 0
+    while True:
+        query = supabase.table(tabla).select(columnas)
+        if filtro:
+            query = filtro(query)
+        with metrics.upstream("supabase_read"):
+            batch = query.range(offset, offset + PAGE_SIZE - 1).execute().data
+        filas.extend(batch or [])
+        if not batch or len(batch) < PAGE_SIZE:
+            return filas
+        offset += PAGE_SIZE
+
+def obtener_cups_cartera(supabase):
+    """CUPS distintos presentes en las facturas sincronizadas."""
+    filas = _leer_paginado(supabase, "invoices", "cups")
+    cups = {sips_service.normalize_cups(f.get("cups")) for f in filas}
+    cups.discard("")
+    return sorted(cups)
+
+def obtener_cups_recientes(supabase, max_edad_dias):
+    """
+    CUPS con snapshot correcto más reciente que `max_edad_dias`. Los snapshots sin
+    consumo_12m_periodo (anteriores a la columna) se vuelven a consultar.
+    """
+    limite = (datetime.now(timezone.utc) - timedelta(days=max_edad_dias)).isoformat()
+    filas = _leer_paginado(
+        supabase, SNAPSHOT_TABLE, "cups",
+        lambda q: q.eq("status", 200).gte("fetched_at", limite).not_.is_("consumo_12m_periodo", "null")
+    )
+    return {f["cups"] for f in filas}
+
+def guardar_snapshots(supabase, filas):
+    with common.span("write", target="supabase", rows=len(filas)), metrics.upstream("supabase_upsert"):
+        supabase.table(SNAPSHOT_TABLE).upsert(filas).execute()
+
+def prefetch(ctx=None):
+    params = ctx.params if ctx else {}
+    forzar = str(params.get("forzar", "")).lower() in ("1", "true")
+
+    supabase = common.get_supabase_client()
+    if not supabase:
+        print("❌ Error de configuración Supabase (SUPABASE_URL/KEY faltantes).")
+        return
+
+    with common.span("fetch", source="supabase") as sp:
+        cartera = obtener_cups_cartera(supabase)
+        recientes = set() if forzar else obtener_cups_recientes(supabase, SNAPSHOT_MAX_AGE_DAYS)
+        pendientes = [c for c in cartera if c not in recientes]
+        sp.set(rows=len(cartera), pending=len(pendientes))
+
+    print(f"CUPS en cartera: {len(cartera)} | Actualizados: {len(cartera) - len(pendientes)} | A consultar: {len(pendientes)}")
+    if not pendientes:
+        print("✅ Todos los snapshots SIPS están al día.")
+        return
+
+    ok = 0
+    errores = 0
+    lote = []
+    with common.span("fetch", source="orka_sips", rows=len(pendientes)):
+        # refresh=True: a stale snapshot must not be rebuilt from an older cached lookup
+        for i, (cups, result, status_code) in enumerate(sips_service.search_cups_batch(pendientes, refresh=True), 1):
+            lote.append(sips_service.snapshot_row(cups, result, status_code))
+            if status_code == 200:
+                ok += 1
+            else:
+                errores += 1
+            if len(lote) >= BATCH_SIZE:
+                guardar_snapshots(supabase, lote)
+                lote = []
+            if i % 25 == 0 or i == len(pendientes):
+                print(f"  {i}/{len(pendientes)} consultados ({errores} con error)")
+    if lote:
+        guardar_snapshots(supabase, lote)
+
+    print(f"✅ Snapshots SIPS actualizados: {ok} correctos, {errores} con error.")
+
+def main(ctx=None):
+    print("Iniciando prefetch SIPS de la cartera (Supabase > Orka > sips_snapshots)...")
+
+    with common.trace_run("sips_prefetch"):
+        prefetch(ctx)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,89 @@
 import os
-import requests
+import re
+import sys
 import base64
 import time
-from dotenv import load_dotenv
+import threading
+import concurrent.futures
+from datetime import datetime, timezone
+
+# Ensure we can import metrics
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import metrics
+from cache import TTLCache, SingleFlight
+
+# Processed SIPS results keyed by CUPS. Repeat lookups skip both the Orka call
+# and the consumption processing. SIPS_CACHE_DIR adds a disk layer.
+sips_cache = TTLCache(
+    "sips",
+    maxsize=int(os.environ.get("SIPS_CACHE_SIZE", "512")),
+    ttl=int(os.environ.get("SIPS_CACHE_TTL", str(12 * 3600))),
+    disk_dir=os.environ.get("SIPS_CACHE_DIR") or None,
+)
+
+# Bulk lookups (/api/sips/batch)
+SIPS_BATCH_MAX = int(os.environ.get("SIPS_BATCH_MAX", "500"))
+SIPS_BATCH_WORKERS = int(os.environ.get("SIPS_BATCH_WORKERS", "8"))
+# Max Orka cups calls per second for the whole process (0 = unlimited)
+SIPS_RATE_LIMIT = float(os.environ.get("SIPS_RATE_LIMIT", "10"))
+
+CUPS_RE = re.compile(r"\bES[A-Z0-9]{18,20}\b")
+
+class RateLimiter:
+    """Spaces out calls to at most `rate` per second across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+orka_rate_limiter = RateLimiter(SIPS_RATE_LIMIT)
+
+# Portfolio SIPS summaries written by scripts/sips_prefetch.py
+SNAPSHOT_TABLE = "sips_snapshots"
+
+# Concurrent lookups of the same CUPS share one Orka call
+cups_flights = SingleFlight()
 
 # Cache for token
 orka_token_cache = {
     "token": None,
     "expires_at": 0
 }
+# Only one login runs at a time; the others wait and reuse its token
+orka_token_lock = threading.Lock()
 
 def get_orka_token():
     now = time.time()
     if orka_token_cache["token"] and orka_token_cache["expires_at"] > now:
         return orka_token_cache["token"]
 
+    with orka_token_lock:
+        now = time.time()
+        if orka_token_cache["token"] and orka_token_cache["expires_at"] > now:
+            return orka_token_cache["token"]
+        return _login(now)
+
+def invalidate_orka_token(token):
+    """Drop `token` if it is still the cached one (e.g. after a 401)."""
+    with orka_token_lock:
+        if orka_token_cache["token"] == token:
+            orka_token_cache["token"] = None
+            orka_token_cache["expires_at"] = 0
+
+def _login(now):
+    import requests
+
     username = os.environ.get("ORKA_USER")
     password = os.environ.get("ORKA_PASSWORD")
 
@@ -34,7 +103,8 @@ def get_orka_token():
     }
 
     try:
-        resp = requests.post("https://www.orkamanager.com/orkapi/login", data=payload, headers=headers, timeout=10)
+        with metrics.upstream("orka_login"):
+            resp = requests.post("https://www.orkamanager.com/orkapi/login", data=payload, headers=headers, timeout=10)
     except requests.exceptions.RequestException as e:
          raise Exception(f"Error de conexión con Orka: {e}")
 
@@ -53,10 +123,74 @@ def get_orka_token():
     
     return orka_token_cache["token"]
 
-def search_cups_data(cups):
+# Response sections for ?fields= (lean = every section except raw)
+FIELD_SECTIONS = {
+    "summary": ("cups", "direccion", "municipio", "provincia", "codigo_postal", "tarifa",
+                "distribuidor", "titular", "consumo_anual_total", "fechas"),
+    "powers": ("potencia_contratada", "potencias_contratadas"),
+    "consumption": ("consumos", "consumos_anuales_periodo", "total_consumos"),
+    "penalties": ("penalizaciones_reactiva",),
+    "technical": ("datos_tecnicos",),
+    "raw": ("raw_data",),
+}
+LEAN_SECTIONS = ("summary", "powers", "consumption", "penalties", "technical")
+
+def parse_fields(fields=None, lean=False):
+    """
+    Sections requested via `fields` ("summary,powers" or a list) and/or lean mode.
+    Returns None for the full payload. Raises ValueError on unknown sections.
+    """
+    if isinstance(fields, str):
+        fields = [f.strip() for f in fields.split(",") if f.strip()]
+    sections = set(fields or ())
+    unknown = sections - set(FIELD_SECTIONS)
+    if unknown:
+        raise ValueError(f"Secciones desconocidas: {', '.join(sorted(unknown))} (disponibles: {', '.join(FIELD_SECTIONS)})")
+    if lean:
+        sections.update(LEAN_SECTIONS)
+    return sections or None
+
+def project_fields(result, sections):
+    """Copy of a processed result with only the keys of `sections` (cached results are never modified)."""
+    if not sections:
+        return result
+    keys = [k for section in FIELD_SECTIONS if section in sections for k in FIELD_SECTIONS[section]]
+    return {k: result[k] for k in keys if k in result}
+
+def normalize_cups(cups):
+    return (cups or "").strip().upper()
+
+def search_cups_data(cups, refresh=False):
+    """
+    Processed SIPS data for a CUPS, as (result, status_code).
+    Successful results are cached; refresh=True bypasses (and renews) the cache.
+    """
+    cups = normalize_cups(cups)
     if not cups:
         return {"error": "CUPS no proporcionado"}, 400
 
+    if not refresh:
+        cached = sips_cache.get(cups)
+        if cached is not None:
+            metrics.inc("enex_cache_requests_total", cache="sips", result="hit")
+            return cached, 200
+    metrics.inc("enex_cache_requests_total", cache="sips", result="miss")
+
+    def fetch_and_cache():
+        result, status_code = fetch_cups_data(cups)
+        if status_code == 200:
+            sips_cache.set(cups, result)
+        return result, status_code
+
+    (result, status_code), shared = cups_flights.do(cups, fetch_and_cache)
+    if shared:
+        metrics.inc("enex_singleflight_shared_total", call="orka_cups")
+    return result, status_code
+
+def fetch_cups_data(cups):
+    """Live Orka lookup + processing (no cache)."""
+    import requests
+
     try:
         token = get_orka_token()
     except Exception as e:
@@ -68,11 +202,17 @@ def search_cups_data(cups):
        "User-Agent": "Enex-Control-Center/1.0" 
     }
     
+    orka_rate_limiter.wait()
     try:
-        resp = requests.get(url, headers=headers, timeout=15)
+        with metrics.upstream("orka_cups"):
+            resp = requests.get(url, headers=headers, timeout=15)
     except requests.exceptions.RequestException as e:
         return {"error": f"Error de conexión con Orka: {e}"}, 502
 
+    if resp.status_code == 401:
+        # Token revoked before its expiry: force a new login on the next lookup
+        invalidate_orka_token(token)
+
     if resp.status_code == 404:
          return {"error": "CUPS no encontrado"}, 404
          
@@ -80,137 +220,366 @@ def search_cups_data(cups):
         return {"error": f"Error upstream: {resp.text}"}, resp.status_code
         
     raw_data = resp.json()
-    
+
     try:
-        # --- Processing Logic ---
-        
-        # 1. Extract Consumptions
-        consumos = []
-        consumo_anual_periodo = {}
-        penalizaciones_reactiva = {}
-        total_consumos = {
-            "consumo_total_kWh": 0,
-            "consumo_anual_kWh": 0,
-            "consumo_anual_porcentaje": 0
-        }
+        return process_cups_data(raw_data, cups), 200
+    except Exception as e:
+        return {"error": f"Error procesando datos: {str(e)}"}, 500
+
+def parse_cups_list(text):
+    """Distinct CUPS found in pasted text or CSV content, in order of appearance."""
+    seen = []
+    for cups in CUPS_RE.findall((text or "").upper()):
+        if cups not in seen:
+            seen.append(cups)
+    return seen
+
+def search_cups_batch(cups_list, refresh=False, max_workers=None):
+    """
+    Look up many CUPS concurrently. Yields (cups, result, status_code) as each
+    lookup completes (completion order, not input order). Cached results come
+    back immediately; Orka calls go through the shared rate limiter.
+    """
+    max_workers = max_workers or SIPS_BATCH_WORKERS
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sips") as executor:
+        futures = {executor.submit(search_cups_data, cups, refresh): cups for cups in cups_list}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                cups = futures[future]
+                try:
+                    result, status_code = future.result()
+                except Exception as e:
+                    result, status_code = {"error": str(e)}, 500
+                yield cups, result, status_code
+        finally:
+            # Client went away: don't start the lookups still queued
+            for future in futures:
+                future.cancel()
+
+def summary_row(cups, result, status_code):
+    """Flat row for the batch table / XLSX export."""
+    if status_code != 200:
+        return {"cups": cups, "estado": result.get("error", f"Error {status_code}")}
+    row = {
+        "cups": result.get("cups", cups),
+        "estado": "OK",
+        "tarifa": result.get("tarifa"),
+        "distribuidor": result.get("distribuidor"),
+        "municipio": result.get("municipio"),
+        "provincia": result.get("provincia"),
+        "consumo_anual_kWh": result.get("consumo_anual_total"),
+    }
+    for periodo, valor in sorted((result.get("potencias_contratadas") or {}).items()):
+        row[f"potencia_{periodo}"] = valor
+    for periodo, valor in sorted((result.get("consumos_anuales_periodo") or {}).items()):
+        row[f"kWh_{periodo}"] = valor
+    row["penalizacion_reactiva_euros"] = sum((result.get("penalizaciones_reactiva") or {}).values())
+    return row
+
+def snapshot_row(cups, result, status_code):
+    """
+    Row for the sips_snapshots table (summary only, no consumption history).
+    consumo_12m_periodo keeps the last 12 months per period for the tariff
+    simulator; consumos_anuales_periodo covers the whole SIPS history.
+    """
+    import tariff_simulator
+
+    row = {
+        "cups": cups,
+        "status": status_code,
+        "fetched_at": datetime.now(timezone.utc).isoformat(),
+        "error": None,
+        "tarifa": None,
+        "distribuidor": None,
+        "municipio": None,
+        "provincia": None,
+        "consumo_anual_kwh": None,
+        "consumos_anuales_periodo": None,
+        "consumo_12m_periodo": None,
+        "potencias_contratadas": None,
+        "penalizaciones_reactiva": None,
+    }
+    if status_code != 200:
+        row["error"] = result.get("error")
+        return row
+    row.update({
+        "tarifa": result.get("tarifa"),
+        "distribuidor": result.get("distribuidor"),
+        "municipio": result.get("municipio"),
+        "provincia": result.get("provincia"),
+        "consumo_anual_kwh": result.get("consumo_anual_total"),
+        "consumos_anuales_periodo": result.get("consumos_anuales_periodo"),
+        "potencias_contratadas": result.get("potencias_contratadas"),
+        "penalizaciones_reactiva": result.get("penalizaciones_reactiva"),
+    })
+    consumo_12m = tariff_simulator.annual_consumption(result)
+    if consumo_12m is not None:
+        row["consumo_12m_periodo"] = dict(zip(tariff_simulator.PERIODS, consumo_12m))
+    return row
+
+def _read_snapshots(supabase, cups=None):
+    rows = []
+    offset = 0
+    limit = 1000
+    while True:
+        query = supabase.table(SNAPSHOT_TABLE).select("*").eq("status", 200)
+        if cups:
+            query = query.eq("cups", cups)
+        with metrics.upstream("supabase_read"):
+            batch = query.range(offset, offset + limit - 1).execute().data
+        rows.extend(batch or [])
+        if not batch or len(batch) < limit:
+            return rows
+        offset += limit
+
+def get_snapshots_version():
+    """(version, last_modified_utc) of sips_snapshots for ETag validation, or (None, None)."""
+    import common
+
+    supabase = common.get_supabase_client()
+    if not supabase:
+        return None, None
+    try:
+        with metrics.upstream("supabase_read"):
+            response = (
+                supabase.table(SNAPSHOT_TABLE).select("fetched_at", count="exact")
+                .order("fetched_at", desc=True).limit(1).execute()
+            )
+        latest = response.data[0]["fetched_at"] if response.data else ""
+        last_modified = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        if latest:
+            last_modified = datetime.strptime(latest[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+        return f"{response.count or 0}|{latest}", last_modified
+    except Exception as e:
+        print(f"Error reading SIPS snapshot version: {e}")
+        return None, None
+
+def get_portfolio(cups=None):
+    """
+    Portfolio view built from sips_snapshots (no Orka calls): totals and
+    breakdowns by tariff and distributor, plus one row per CUPS.
+    With `cups`, only that supply point's snapshot.
+    """
+    import common
+
+    supabase = common.get_supabase_client()
+    if not supabase:
+        return {"error": "Supabase no configurado"}
+    try:
+        rows = _read_snapshots(supabase, normalize_cups(cups) or None)
+    except Exception as e:
+        common.supabase_health_check()
+        return {"error": f"Error leyendo {SNAPSHOT_TABLE}: {e}"}
+
+    por_tarifa = {}
+    por_distribuidor = {}
+    consumo_periodo = {}
+    for r in rows:
+        kwh = r.get("consumo_anual_kwh") or 0
+        for grupo, clave in ((por_tarifa, r.get("tarifa")), (por_distribuidor, r.get("distribuidor"))):
+            entry = grupo.setdefault(clave or "No disponible", {"cups": 0, "consumo_anual_kwh": 0})
+            entry["cups"] += 1
+            entry["consumo_anual_kwh"] += kwh
+        for periodo, valor in (r.get("consumos_anuales_periodo") or {}).items():
+            consumo_periodo[periodo] = consumo_periodo.get(periodo, 0) + valor
+
+    return {
+        "total_cups": len(rows),
+        "consumo_anual_kwh": sum(r.get("consumo_anual_kwh") or 0 for r in rows),
+        "consumos_anuales_periodo": consumo_periodo,
+        "por_tarifa": por_tarifa,
+        "por_distribuidor": por_distribuidor,
+        "ultima_actualizacion": max((r.get("fetched_at") or "" for r in rows), default=None),
+        "cups": rows,
+    }
+
+def simulate_offers(offers, cups_list=None, portfolio=False, refresh=False):
+    """
+    Price an offer catalogue for the given CUPS (live/cached SIPS lookups) or, with
+    portfolio=True, for every CUPS in sips_snapshots. Returns (result, status_code).
+    """
+    import tariff_simulator
+
+    try:
+        tariff_simulator.compile_offers(offers)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    errores = []
+    if portfolio:
+        data = get_portfolio()
+        if data.get("error"):
+            return data, 500
+        results = data["cups"]
+    else:
+        results = []
+        for cups, result, status_code in search_cups_batch(cups_list or [], refresh=refresh):
+            if status_code == 200:
+                results.append(result)
+            else:
+                errores.append({"cups": cups, "error": result.get("error"), "status": status_code})
+
+    profiles = []
+    for r in results:
+        profile = tariff_simulator.supply_profile(r)
+        if profile["energia_kwh"] is None:
+            errores.append({"cups": r.get("cups"), "error": "Sin consumo de los últimos 12 meses (snapshot anterior a consumo_12m_periodo: vuelve a ejecutar sips_prefetch)", "status": 422})
+        else:
+            profiles.append(profile)
+    simulation = tariff_simulator.simulate(profiles, offers)
+    simulation["errores"] = errores
+    return simulation, 200
+
+def build_batch_xlsx(rows):
+    """XLSX workbook (bytes) with one summary row per CUPS."""
+    import io
+    from openpyxl import Workbook
+
+    columns = []
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "SIPS"
+    ws.append(columns)
+    for row in rows:
+        ws.append([row.get(c) for c in columns])
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+def process_cups_data(raw_data, cups):
+    """Turn an orkapi/cups document into the structure rendered by the /sips page."""
+    # --- Processing Logic ---
+    
+    # 1. Extract Consumptions
+    consumos = []
+    consumo_anual_periodo = {}
+    penalizaciones_reactiva = {}
+    total_consumos = {
+        "consumo_total_kWh": 0,
+        "consumo_anual_kWh": 0,
+        "consumo_anual_porcentaje": 0
+    }
+    
+    # Gather all consumption sources
+    sources = [
+        raw_data.get('puntos_suministro', []),
+        raw_data.get('consumos', []),
+        raw_data.get('consumos_historicos', []),
+        raw_data.get('lecturas', [])
+    ]
+    
+    all_consumos_data = []
+    # Handle puntos_suministro separately as it wraps consumos
+    if isinstance(sources[0], list):
+         for p in sources[0]:
+             if isinstance(p.get('consumos'), list):
+                 all_consumos_data.extend(p['consumos'])
+
+    # Add others
+    for s in sources[1:]:
+         if isinstance(s, list):
+             all_consumos_data.extend(s)
+
+    # Process
+    for c in all_consumos_data:
+        fecha_inicio = c.get('fecha_lectura_inicio') or c.get('fecha_desde') or c.get('fecha')
+        fecha_fin = c.get('fecha_lectura_fin') or c.get('fecha_hasta') or c.get('fecha')
         
-        # Gather all consumption sources
-        sources = [
-            raw_data.get('puntos_suministro', []),
-            raw_data.get('consumos', []),
-            raw_data.get('consumos_historicos', []),
-            raw_data.get('lecturas', [])
-        ]
+        # Active Energy
+        energia_data = c.get('energia_activa_kWh') or c.get('energia_activa') or c.get('consumo_periodos') or {}
+        if not isinstance(energia_data, dict): 
+            # Sometimes it might not be a dict?
+            energia_data = {}
+
+        consumo_total_record = 0
+        consumo_detallado = {}
         
-        all_consumos_data = []
-        # Handle puntos_suministro separately as it wraps consumos
-        if isinstance(sources[0], list):
-             for p in sources[0]:
-                 if isinstance(p.get('consumos'), list):
-                     all_consumos_data.extend(p['consumos'])
-
-        # Add others
-        for s in sources[1:]:
-             if isinstance(s, list):
-                 all_consumos_data.extend(s)
-
-        # Process
-        for c in all_consumos_data:
-            fecha_inicio = c.get('fecha_lectura_inicio') or c.get('fecha_desde') or c.get('fecha')
-            fecha_fin = c.get('fecha_lectura_fin') or c.get('fecha_hasta') or c.get('fecha')
-            
-            # Active Energy
-            energia_data = c.get('energia_activa_kWh') or c.get('energia_activa') or c.get('consumo_periodos') or {}
-            if not isinstance(energia_data, dict): 
-                # Sometimes it might not be a dict?
-                energia_data = {}
-
-            consumo_total_record = 0
-            consumo_detallado = {}
+        for periodo, valor in energia_data.items():
+            val_num = 0
+            if isinstance(valor, str):
+                try: val_num = float(valor.replace(',', '.'))
+                except: val_num = 0
+            elif isinstance(valor, (int, float)):
+                val_num = valor
             
-            for periodo, valor in energia_data.items():
-                val_num = 0
-                if isinstance(valor, str):
-                    try: val_num = float(valor.replace(',', '.'))
+            if val_num > 0:
+                consumo_total_record += val_num
+                consumo_detallado[periodo] = val_num
+                consumo_anual_periodo[periodo] = consumo_anual_periodo.get(periodo, 0) + val_num
+
+        # Reactive Penalties
+        pen_data = c.get('penalizacion_reactiva_euros') or c.get('penalizaciones') or {}
+        pen_record = {}
+        if isinstance(pen_data, dict):
+            for p, v in pen_data.items():
+                 val_num = 0
+                 if isinstance(v, str):
+                    try: val_num = float(v.replace(',', '.'))
                     except: val_num = 0
-                elif isinstance(valor, (int, float)):
-                    val_num = valor
-                
-                if val_num > 0:
-                    consumo_total_record += val_num
-                    consumo_detallado[periodo] = val_num
-                    consumo_anual_periodo[periodo] = consumo_anual_periodo.get(periodo, 0) + val_num
-
-            # Reactive Penalties
-            pen_data = c.get('penalizacion_reactiva_euros') or c.get('penalizaciones') or {}
-            pen_record = {}
-            if isinstance(pen_data, dict):
-                for p, v in pen_data.items():
-                     val_num = 0
-                     if isinstance(v, str):
-                        try: val_num = float(v.replace(',', '.'))
-                        except: val_num = 0
-                     elif isinstance(v, (int, float)):
-                        val_num = v
-                     
-                     if val_num > 0:
-                         pen_record[p] = val_num
-                         penalizaciones_reactiva[p] = penalizaciones_reactiva.get(p, 0) + val_num
-
-            if consumo_total_record > 0:
-                total_consumos["consumo_total_kWh"] += consumo_total_record
-                consumos.append({
-                    "fecha": fecha_fin or fecha_inicio,
-                    "consumo": consumo_total_record,
-                    "consumo_detallado": consumo_detallado,
-                    "penalizacion_reactiva_euros": pen_record
-                })
-
-        # Calculate Totals
-        total_anual = sum(consumo_anual_periodo.values())
-        total_consumos["consumo_anual_kWh"] = total_consumos["consumo_total_kWh"] 
+                 elif isinstance(v, (int, float)):
+                    val_num = v
+                 
+                 if val_num > 0:
+                     pen_record[p] = val_num
+                     penalizaciones_reactiva[p] = penalizaciones_reactiva.get(p, 0) + val_num
+
+        if consumo_total_record > 0:
+            total_consumos["consumo_total_kWh"] += consumo_total_record
+            consumos.append({
+                "fecha": fecha_fin or fecha_inicio,
+                "consumo": consumo_total_record,
+                "consumo_detallado": consumo_detallado,
+                "penalizacion_reactiva_euros": pen_record
+            })
+
+    # Calculate Totals
+    total_anual = sum(consumo_anual_periodo.values())
+    total_consumos["consumo_anual_kWh"] = total_consumos["consumo_total_kWh"] 
+    
+    # Potencias Contratadas parsing
+    potencias_raw = raw_data.get('potencias_contratadas', {}).get('potencias_kW', {})
+    potencias_clean = {}
+    for k, v in potencias_raw.items():
+         if isinstance(v, str):
+             try: potencias_clean[k] = float(v.replace(',', '.'))
+             except: pass
+         else:
+             potencias_clean[k] = v
+
+    # Construct Response
+    transformed = {
+        "cups": raw_data.get('cups', cups),
+        "direccion": raw_data.get('localizacion', {}).get('direccion', "No disponible"),
+        "municipio": raw_data.get('localizacion', {}).get('municipio', "No disponible"),
+        "provincia": raw_data.get('localizacion', {}).get('provincia', "No disponible"),
+        "codigo_postal": raw_data.get('localizacion', {}).get('codigo_postal', "No disponible"),
+        "tarifa": raw_data.get('potencias_contratadas', {}).get('tarifa', "No disponible"),
         
-        # Potencias Contratadas parsing
-        potencias_raw = raw_data.get('potencias_contratadas', {}).get('potencias_kW', {})
-        potencias_clean = {}
-        for k, v in potencias_raw.items():
-             if isinstance(v, str):
-                 try: potencias_clean[k] = float(v.replace(',', '.'))
-                 except: pass
-             else:
-                 potencias_clean[k] = v
-
-        # Construct Response
-        transformed = {
-            "cups": raw_data.get('cups', cups),
-            "direccion": raw_data.get('localizacion', {}).get('direccion', "No disponible"),
-            "municipio": raw_data.get('localizacion', {}).get('municipio', "No disponible"),
-            "provincia": raw_data.get('localizacion', {}).get('provincia', "No disponible"),
-            "codigo_postal": raw_data.get('localizacion', {}).get('codigo_postal', "No disponible"),
-            "tarifa": raw_data.get('potencias_contratadas', {}).get('tarifa', "No disponible"),
-            
-            "potencia_contratada": potencias_clean.get("periodo_1"), 
-            "potencias_contratadas": potencias_clean,
-            
-            "consumo_anual_total": total_anual,
-            "distribuidor": raw_data.get("distribuidor", "No disponible"),
-            
-            "titular": {
-                "tipo_actividad": raw_data.get("titular", {}).get("tipo_actividad"),
-                "tipo_identificador": raw_data.get("titular", {}).get("tipo_identificador")
-            },
-            
-            "datos_tecnicos": raw_data.get("datos", {}), # Pass mostly as is
-            "fechas": raw_data.get("fechas", {}),
-            
-            "consumos": consumos,
-            "consumos_anuales_periodo": consumo_anual_periodo,
-            "penalizaciones_reactiva": penalizaciones_reactiva,
-            "total_consumos": total_consumos,
-            "raw_data": raw_data
-        }
+        "potencia_contratada": potencias_clean.get("periodo_1"), 
+        "potencias_contratadas": potencias_clean,
         
-        return transformed, 200
-
-    except Exception as e:
-        return {"error": f"Error procesando datos: {str(e)}"}, 500
+        "consumo_anual_total": total_anual,
+        "distribuidor": raw_data.get("distribuidor", "No disponible"),
+        
+        "titular": {
+            "tipo_actividad": raw_data.get("titular", {}).get("tipo_actividad"),
+            "tipo_identificador": raw_data.get("titular", {}).get("tipo_identificador")
+        },
+        
+        "datos_tecnicos": raw_data.get("datos", {}), # Pass mostly as is
+        "fechas": raw_data.get("fechas", {}),
+        
+        "consumos": consumos,
+        "consumos_anuales_periodo": consumo_anual_periodo,
+        "penalizaciones_reactiva": penalizaciones_reactiva,
+        "total_consumos": total_consumos,
+        "raw_data": raw_data
+    }
+    
+    return transformed
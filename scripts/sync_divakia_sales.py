@@ -1,5 +1,3 @@
-import requests
-import json
 import os
 import sys
 from datetime import datetime, timedelta
@@ -7,15 +5,38 @@ from datetime import datetime, timedelta
 # Ensure we can import common
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import common
+import metrics
+import analytics
+import local_replica
+import margin_engine
 
 # Load config
 common.load_config()
 
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Derived data refreshed after a successful sync: (name, callable(facturas)),
+# where facturas are the raw Orka invoices this sync downloaded
+POST_SYNC_HOOKS = [
+    # Incremental pull, or a full reconcile that drops invoices deleted in Supabase
+    ("local_replica", lambda facturas: local_replica.get_replica().refresh(common.get_supabase_client())),
+    ("invoice_snapshot", lambda facturas: analytics.materialize_invoice_snapshot()),
+    ("ranking_snapshot", lambda facturas: analytics.materialize_ranking_snapshot(BASE_DIR)),
+    # ATR purchases for /api/margins, from the same download (no second Orka fetch)
+    ("atr_purchases", lambda facturas: margin_engine.materialize_purchases(facturas)),
+]
+
+def ejecutar_post_sync(facturas):
+    for nombre, hook in POST_SYNC_HOOKS:
+        try:
+            with common.span(nombre):
+                hook(facturas)
+            print(f"✅ Post-sync: {nombre} actualizado.")
+        except Exception as e:
+            print(f"⚠️ Post-sync: error en {nombre}: {e}")
+
 def obtener_facturas(token):
     """Consulta todas las facturas emitidas (cliente) con paginación."""
-    url = "https://www.orkamanager.com/orkapi/facturas/find"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
     # Rango amplio para traer historial (ajustar segun necesidad, aqui ponemos ~2 años)
     hoy = datetime.today()
     hace_dias = hoy - timedelta(days=730) 
@@ -25,48 +46,7 @@ def obtener_facturas(token):
     manana = hoy + timedelta(days=1)
     fecha_hasta = manana.strftime("%d/%m/%Y")
 
-    all_facturas = []
-    offset = 0
-    limit = 1000
-    more_available = True
-    
-    print(f"Consultando facturas desde {fecha_desde} hasta {fecha_hasta}...")
-
-    while more_available:
-        payload = {
-            "fecha_emision_factura_cliente_desde": fecha_desde,
-            "fecha_emision_factura_cliente_hasta": fecha_hasta,
-            "limite": limit, 
-            "offset": offset
-        }
-        
-        try:
-            print(f"  Solicitando offset={offset} limit={limit}...")
-            response = requests.post(url, headers=headers, json=payload, timeout=45)
-            
-            if response.status_code == 200:
-                data = response.json()
-                page_results = data.get("facturas", [])
-                
-                if not page_results:
-                    more_available = False
-                else:
-                    all_facturas.extend(page_results)
-                    print(f"  Recibidas {len(page_results)} facturas. Total acumulado: {len(all_facturas)}")
-                    
-                    if len(page_results) < limit:
-                        more_available = False # Less than limit means last page
-                    else:
-                        offset += limit # Next page
-            else:
-                print(f"Error al consultar facturas: {response.status_code} - {response.text}")
-                more_available = False # Stop on error
-                
-        except Exception as e:
-            print(f"Excepción obteniendo facturas: {e}")
-            more_available = False
-            
-    return all_facturas
+    return common.fetch_orka_invoices(token, fecha_desde, fecha_hasta)
 
 def procesar_facturas(facturas):
     datos_export = []
@@ -193,10 +173,9 @@ def procesar_facturas(facturas):
         
     return datos_export
 
-def main():
-    print("Iniciando sincronización de ventas (Divakia > Supabase)...")
-    
-    token = common.get_orka_token()
+def sincronizar():
+    with common.span("orka_login"):
+        token = common.get_orka_token()
     if not token:
         print("❌ Error de autenticación Orka.")
         return
@@ -206,11 +185,15 @@ def main():
         print("❌ Error de configuración Supabase (SUPABASE_URL/KEY faltantes).")
         return
 
-    facturas = obtener_facturas(token)
+    with common.span("fetch", source="orka") as sp:
+        facturas = obtener_facturas(token)
+        sp.set(rows=len(facturas))
     print(f"Facturas obtenidas: {len(facturas)}")
     
     if facturas:
-        data = procesar_facturas(facturas)
+        with common.span("transform") as sp:
+            data = procesar_facturas(facturas)
+            sp.set(rows=len(data))
         
         if not data:
              print("No hay facturas procesables.")
@@ -220,18 +203,37 @@ def main():
         
         # Supabase upsert batching
         BATCH_SIZE = 100
+        enviados = 0
         for i in range(0, len(data), BATCH_SIZE):
             batch = data[i:i+BATCH_SIZE]
             try:
                 # upsert matches on PRIMARY KEY (id)
-                supabase.table("invoices").upsert(batch).execute()
+                with common.span("write", target="supabase", rows=len(batch)), metrics.upstream("supabase_upsert"):
+                    supabase.table("invoices").upsert(batch).execute()
                 print(f"  Lote {i}-{i+len(batch)} enviado.")
+                enviados += len(batch)
             except Exception as e:
                 print(f"❌ Error enviando lote {i}: {e}")
+                continue
+
+            # Keep the local analytics replica in step with what Supabase accepted
+            try:
+                with common.span("write", target="local_replica", rows=len(batch)):
+                    local_replica.get_replica().upsert(batch)
+            except Exception as e:
+                print(f"⚠️ Error actualizando la réplica local (lote {i}): {e}")
                 
         print(f"✅ Sincronización completada.")
+        if enviados:
+            ejecutar_post_sync(facturas)
     else:
         print("No se encontraron facturas.")
 
+def main(ctx=None):
+    print("Iniciando sincronización de ventas (Divakia > Supabase)...")
+
+    with common.trace_run("sync_divakia_sales"):
+        sincronizar()
+
 if __name__ == "__main__":
     main()
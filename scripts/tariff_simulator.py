@@ -0,0 +1,163 @@
+import re
+from operator import mul
+from datetime import datetime, timedelta
+
+# Tariff simulation: annual cost of every candidate offer for one or many CUPS.
+#
+# Each CUPS is reduced to two 6-element vectors (kWh per period over the last
+# year of SIPS history, contracted kW per period) and the offer catalogue to two
+# price matrices, so the whole portfolio x catalogue is priced in one pass of
+# dot products without re-reading the SIPS documents per offer.
+#
+# Offer format:
+#   {"id": "fija-2025", "nombre": "...", "tarifa": "2.0TD" (optional, only CUPS on that tariff),
+#    "energia": {"P1": 0.15, ...}  €/kWh,
+#    "potencia": {"P1": 30.5, ...} €/kW·año,
+#    "cuota_fija": 0 €/año (optional)}
+
+PERIODS = ("P1", "P2", "P3", "P4", "P5", "P6")
+
+# Impuesto especial sobre la electricidad and IVA applied to the simulated total
+IMPUESTO_ELECTRICO = 0.0511269632
+IVA = 0.21
+TAX_FACTOR = (1 + IMPUESTO_ELECTRICO) * (1 + IVA)
+
+_PERIOD_RE = re.compile(r"(\d)")
+
+def _period_index(key):
+    """'P1', 'p1', 'periodo_1', 'energia_P3'... -> 0..5 (None if not a period)."""
+    match = _PERIOD_RE.search(str(key))
+    if not match:
+        return None
+    index = int(match.group(1)) - 1
+    return index if 0 <= index < len(PERIODS) else None
+
+def _vector(values):
+    vector = [0.0] * len(PERIODS)
+    for key, value in (values or {}).items():
+        index = _period_index(key)
+        if index is None:
+            continue
+        try:
+            vector[index] += float(value or 0)
+        except (TypeError, ValueError):
+            pass
+    return vector
+
+def _parse_date(value):
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(str(value)[:10], fmt)
+        except ValueError:
+            continue
+    return None
+
+def annual_consumption(result):
+    """
+    kWh per period over the 365 days before the latest reading in the history.
+    sips_snapshots rows keep no readings, only this vector (consumo_12m_periodo),
+    computed by sips_service.snapshot_row. None if neither is available.
+    """
+    readings = []
+    for c in result.get("consumos") or []:
+        fecha = _parse_date(c.get("fecha"))
+        if fecha:
+            readings.append((fecha, c.get("consumo_detallado") or {}))
+
+    if not readings:
+        if result.get("consumo_12m_periodo"):
+            return _vector(result["consumo_12m_periodo"])
+        return None
+
+    desde = max(f for f, _ in readings) - timedelta(days=365)
+    vector = [0.0] * len(PERIODS)
+    for fecha, detalle in readings:
+        if fecha > desde:
+            for i, kwh in enumerate(_vector(detalle)):
+                vector[i] += kwh
+    return vector
+
+def supply_profile(result):
+    """
+    Compact input for the engine from a processed SIPS result (or a snapshot row).
+    energia_kwh is None when the last year of consumption is unknown.
+    """
+    return {
+        "cups": result.get("cups"),
+        "tarifa": result.get("tarifa"),
+        "energia_kwh": annual_consumption(result),
+        "potencia_kw": _vector(result.get("potencias_contratadas")),
+    }
+
+def compile_offers(offers):
+    """Validate the offer catalogue and turn it into price matrices. Raises ValueError."""
+    if not offers:
+        raise ValueError("No se han indicado ofertas")
+    compiled = {"ids": [], "tarifas": [], "energia": [], "potencia": [], "fija": []}
+    for i, offer in enumerate(offers):
+        if not isinstance(offer, dict) or not offer.get("energia"):
+            raise ValueError(f"Oferta {i + 1}: falta 'energia' (precios €/kWh por periodo)")
+        offer_id = str(offer.get("id") or offer.get("nombre") or f"oferta_{i + 1}")
+        if offer_id in compiled["ids"]:
+            # Results are keyed by id: a repeated one would overwrite the other offer's costs
+            raise ValueError(f"Oferta {i + 1}: id repetido '{offer_id}'")
+        compiled["ids"].append(offer_id)
+        compiled["tarifas"].append(offer.get("tarifa"))
+        compiled["energia"].append(_vector(offer.get("energia")))
+        compiled["potencia"].append(_vector(offer.get("potencia")))
+        compiled["fija"].append(float(offer.get("cuota_fija") or 0))
+    return compiled
+
+def price_profiles(profiles, compiled):
+    """
+    Cost matrix: for each profile, the annual cost (taxes included) of every offer,
+    None where the offer's tariff doesn't match the CUPS. Returns a list of rows.
+    """
+    offers = list(zip(compiled["tarifas"], compiled["energia"], compiled["potencia"], compiled["fija"]))
+    rows = []
+    for profile in profiles:
+        energia = profile["energia_kwh"]
+        potencia = profile["potencia_kw"]
+        tarifa = profile.get("tarifa")
+        row = []
+        for offer_tarifa, precios_energia, precios_potencia, fija in offers:
+            if offer_tarifa and tarifa and offer_tarifa != tarifa:
+                row.append(None)
+                continue
+            base = sum(map(mul, energia, precios_energia)) + sum(map(mul, potencia, precios_potencia)) + fija
+            row.append(round(base * TAX_FACTOR, 2))
+        rows.append(row)
+    return rows
+
+def simulate(profiles, offers):
+    """
+    Price every profile against every offer.
+    Returns {"ofertas": [...ids], "resultados": [per CUPS costs + best offer], "totales": per offer}.
+    """
+    compiled = compile_offers(offers)
+    costs = price_profiles(profiles, compiled)
+    ids = compiled["ids"]
+
+    resultados = []
+    totales = [0.0] * len(ids)
+    for profile, row in zip(profiles, costs):
+        priced = [(c, ids[i]) for i, c in enumerate(row) if c is not None]
+        mejor = min(priced)[1] if priced else None
+        for i, c in enumerate(row):
+            if c is not None:
+                totales[i] += c
+        resultados.append({
+            "cups": profile["cups"],
+            "tarifa": profile.get("tarifa"),
+            "consumo_anual_kwh": round(sum(profile["energia_kwh"]), 2),
+            "energia_kwh": dict(zip(PERIODS, profile["energia_kwh"])),
+            "potencia_kw": dict(zip(PERIODS, profile["potencia_kw"])),
+            "costes": dict(zip(ids, row)),
+            "mejor_oferta": mejor,
+        })
+
+    return {
+        "ofertas": ids,
+        "resultados": resultados,
+        "totales": {i: round(t, 2) for i, t in zip(ids, totales)},
+    }
@@ -29,7 +29,8 @@ async function searchCups() {
         const response = await fetch('/api/sips/search', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ cups: cups })
+            // lean: everything the page renders, without the raw upstream document
+            body: JSON.stringify({ cups: cups, lean: true })
         });
 
         const data = await response.json();
@@ -258,3 +259,100 @@ function parseDate(dateStr) {
     const d = new Date(dateStr);
     return isNaN(d) ? null : d;
 }
+
+// --- Batch lookup (/api/sips/batch streams one NDJSON line per CUPS) ---
+
+function batchFormData() {
+    const form = new FormData();
+    form.append('cups', document.getElementById('batchInput').value);
+    const file = document.getElementById('batchFile').files[0];
+    if (file) form.append('file', file);
+    return form;
+}
+
+async function searchBatch() {
+    const errorMsg = document.getElementById('batch-error');
+    const progress = document.getElementById('batch-progress');
+    const table = document.getElementById('batch-table');
+    const tbody = table.querySelector('tbody');
+
+    errorMsg.textContent = "";
+    tbody.innerHTML = "";
+    progress.textContent = "Consultando...";
+
+    try {
+        const response = await fetch('/api/sips/batch', { method: 'POST', body: batchFormData() });
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || `Error ${response.status}`);
+        }
+
+        table.style.display = 'table';
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let received = 0;
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const item = JSON.parse(line);
+                if (item.done) {
+                    progress.textContent = `${item.ok} de ${item.total} CUPS consultados correctamente.`;
+                    continue;
+                }
+                received++;
+                progress.textContent = `${received} recibidos...`;
+                appendBatchRow(tbody, item.summary);
+            }
+        }
+    } catch (error) {
+        console.error(error);
+        errorMsg.textContent = error.message;
+        progress.textContent = "";
+    }
+}
+
+function appendBatchRow(tbody, row) {
+    const tr = document.createElement('tr');
+    const cells = [row.cups, row.estado, row.tarifa, row.distribuidor, formatNumber(row.consumo_anual_kWh)];
+    cells.forEach((value, i) => {
+        const td = document.createElement('td');
+        td.textContent = value || "-";
+        if (i === 4) td.style.textAlign = 'right';
+        tr.appendChild(td);
+    });
+    tbody.appendChild(tr);
+}
+
+async function exportBatch() {
+    const errorMsg = document.getElementById('batch-error');
+    const progress = document.getElementById('batch-progress');
+    errorMsg.textContent = "";
+    progress.textContent = "Generando Excel...";
+
+    try {
+        const response = await fetch('/api/sips/batch/export', { method: 'POST', body: batchFormData() });
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || `Error ${response.status}`);
+        }
+        const blob = await response.blob();
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(blob);
+        link.download = 'sips_lote.xlsx';
+        link.click();
+        URL.revokeObjectURL(link.href);
+        progress.textContent = "";
+    } catch (error) {
+        console.error(error);
+        errorMsg.textContent = error.message;
+        progress.textContent = "";
+    }
+}